@@ -14,6 +14,7 @@ ORC_PORT = ""
 SERVER_MAP = {}
 INVENTORY_MAP = {}
 EXPERIMENT_ARGS_LEN = 13
+INVENTORY_PAGE_SIZE = 1000
 
 def range_to_list(range_string):
     items = []
@@ -189,13 +190,23 @@ def download_inventory_map(inv_id=None):
                 
     print("Downloading inventory map from Orchestrator...")
     servers_url = f'{ORC_URL}/inventory'
-    servers_resp = requests.get(servers_url)
-    if servers_resp.ok:
-        # If the response status code is 200 (OK), parse the response as JSON
-        # global INVENTORY_MAP
-        json_obj = servers_resp.json()
-        for item in json_obj:
-            INVENTORY_MAP[item['id']] = item
+    # Download one keyset page at a time instead of the whole map in a single response
+    after_id = None
+    with requests.Session() as session:
+        while True:
+            params = {"limit": INVENTORY_PAGE_SIZE}
+            if after_id is not None:
+                params["after_id"] = after_id
+            servers_resp = session.get(servers_url, params=params)
+            if not servers_resp.ok:
+                break
+            # If the response status code is 200 (OK), parse the response as JSON
+            page = servers_resp.json()
+            for item in page["items"]:
+                INVENTORY_MAP[item['id']] = item
+            after_id = page["next_after_id"]
+            if after_id is None:
+                break
 
 def pair_servers():
     print_servers()
@@ -233,15 +244,30 @@ def disable_server():
     else:
         print("Error sending request")
 
+def search_inventory():
+    # Filtering and ranking happen on the orchestrator (/inventory/search), only the top results are downloaded
+    params = {
+        "section": input("Section (Press ENTER for any): ") or None,
+        "max_price": input("Maximum price (Press ENTER for any): ") or None,
+        "min_desirability": input("Minimum desirability (Press ENTER for any): ") or None,
+        "sort": input("Sort by desirability or price (Press ENTER for desirability): ") or "desirability",
+        "limit": input("Number of seats (Press ENTER for 5): ") or 5,
+    }
+    search_resp = requests.get(f'{ORC_URL}/inventory/search', params=params)
+    if not search_resp.ok:
+        print("Error searching inventory:", search_resp.text)
+        return []
+    seats = search_resp.json()
+    for seat in seats:
+        INVENTORY_MAP[seat['id']] = seat
+    return seats
+
 def view_search_inventory():
     global INVENTORY_MAP
-    download_inventory_map()
-    print('\n-- Inventory Preview --')
-    preview_max = max(0, len(INVENTORY_MAP))
-    preview_min = min(preview_max, 5)
-    # Print the first 5 key-value pairs
-    for _, seat in list(INVENTORY_MAP.items())[:preview_min]:
-        inv_summary = f'Seat ID {seat["id"]}) Section {seat["section"]} Row {seat["row"]} Seat {seat["seat"]} - Location: {seat["location"]} - Status: {seat["availability"]}'
+    seats = search_inventory()
+    print('\n-- Inventory Search Results --')
+    for seat in seats:
+        inv_summary = f'Seat ID {seat["id"]}) Section {seat["section"]} Row {seat["row"]} Seat {seat["seat"]} - Desirability: {seat["desirability"]} - Price: {seat["price"]} - Location: {seat["location"]} - Status: {seat["availability"]}'
         print(inv_summary)
     while True:
         seat_id = input("Enter an inventory id for details or type q to quit: ")
@@ -0,0 +1,33 @@
+import bisect
+
+# Relinquished inventory arrives at /initiate-recovery as [[first, last], ...] runs of ids in id order
+# (the server's statements.id_ranges_statement), a failover can hand back millions of ids in a few runs
+
+def iter_id_ranges(ranges):
+    for first, last in ranges:
+        yield from range(first, last + 1)
+
+
+def count_id_ranges(ranges):
+    return sum(last - first + 1 for first, last in ranges)
+
+
+# Runs of a list of ids, for senders that still send the full list
+def id_ranges_of(ids):
+    ranges = []
+    for id in sorted(set(ids)):
+        if ranges and ranges[-1][1] == id - 1:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    return ranges
+
+
+# Membership test against the runs without expanding them, by binary search over their first ids
+def id_ranges_predicate(ranges):
+    firsts = [first for first, _ in ranges]
+
+    def contains(id):
+        index = bisect.bisect_right(firsts, id) - 1
+        return index >= 0 and id <= ranges[index][1]
+    return contains
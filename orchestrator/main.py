@@ -1,21 +1,40 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, BackgroundTasks, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Annotated, Optional
+from typing import List, Annotated, Literal, Optional
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 import socket
 from database import db_session, engine
 import models
+import migrations
+import wire
+import id_ranges
+from schemas import JSONResponseClass, dumps_json, InventoryItem, ServerInfo, INVENTORY_MAP_RESPONSES, NDJSON_MEDIA_TYPE
 import requests
 import time
 import string
+from itertools import islice
 import random
 from models import Server, Inventory, Reservation, RegistryEntry
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Before serving (see migrations.upgrade)
+    migrations.upgrade(engine)
+    yield
+
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponseClass)
+app.add_middleware(wire.AdvertiseFormats)
 models.Base.metadata.create_all(bind=engine)
 
 TRANSACT_ID_LENGTH = 10
+INVENTORY_PAGE_MAX = 5000
+INVENTORY_STREAM_BATCH = 1000
+INVENTORY_SEARCH_DEFAULT = 20
+INVENTORY_SEARCH_MAX = 500
 
 def list_difference(list1, list2):
     set1 = set(list1)
@@ -97,7 +116,7 @@ def retrieve_registry(key, default=None):
     return default
 
 
-@app.post("/autoregister")
+@app.post("/autoregister", response_model=ServerInfo)
 def auto_register(request: Request, background_tasks: BackgroundTasks, hostname: Optional[str] = None, port: Optional[str] = "80"):
     host_ip = request.client.host
     server = db_session.query(Server).filter(Server.hostname==hostname, Server.ip_address==host_ip, Server.port==port).first()
@@ -105,9 +124,9 @@ def auto_register(request: Request, background_tasks: BackgroundTasks, hostname:
         server = Server(hostname=hostname, ip_address=host_ip, port=port)
         db_session.add(server)
         db_session.commit()
-        server = server.as_dict()
-        db_session.close()
         # return {"host_ip": host_ip, "hostname": hostname, "server_id": server.id}
+    server = server.as_dict()
+    db_session.close()
     servers = db_session.query(Server).all()
     for server_obj in servers:
         background_tasks.add_task(send_server_map, server_obj.id)
@@ -122,10 +141,10 @@ def sync_all_servers(background_tasks: BackgroundTasks):
     db_session.close()
     return {"Status": "Queued"}
 
-@app.get("/servers")
+@app.get("/servers", response_model=List[ServerInfo])
 def get_servers():
     servers = db_session.query(Server).all()
-    return servers
+    return [server.as_dict() for server in servers]
 
 @app.post("/servers")
 def create_server(host_ip: str, request: Request, background_tasks: BackgroundTasks, hostname: Optional[str] = None, port: Optional[str] = "80"):
@@ -159,15 +178,17 @@ def start_pair_servers(server1_id: int, server2_id: int, background_tasks: Backg
         # Pair nodes together now that inventory is deactivated
         server1 = db_session.query(Server).filter(Server.id == server1_id).first()
         server2 = db_session.query(Server).filter(Server.id == server2_id).first()
-        server1_url = f'http://{server1.ip_address}:{server1.port}/partner?partner_id={server2_id}'
+        epoch = next_epoch(server1, server2)
+        server1_url = f'http://{server1.ip_address}:{server1.port}/partner?partner_id={server2_id}&epoch={epoch}'
         response = requests.request("PUT", server1_url)
         if response.ok:
-            server2_url = f'http://{server2.ip_address}:{server2.port}/partner?partner_id={server1_id}'
+            server2_url = f'http://{server2.ip_address}:{server2.port}/partner?partner_id={server1_id}&epoch={epoch}'
             response = requests.request("PUT", server2_url)
             if response.ok:
                 print("Updating partners")
                 server1.partner_id = int(server2_id)
                 server2.partner_id = int(server1_id)
+                server1.epoch = server2.epoch = epoch
         print("Committing to database")
         db_session.commit()
         db_session.close()
@@ -181,30 +202,100 @@ def start_pair_servers(server1_id: int, server2_id: int, background_tasks: Backg
     else:
         return {"Status": "Server(s) not found"}
 
-@app.get("/server/{server_id}")
+@app.get("/server/{server_id}", response_model=Optional[ServerInfo])
 def get_server_status(server_id: int):
     update_server_status(server_id)
     server = db_session.query(Server).filter(Server.id == server_id).first()
     if server:
-        return server
+        return server.as_dict()
     else:
         return None
 
-@app.get("/inventory")
-def get_inventory_map():
-    db_session.commit()
-    inventory = db_session.query(Inventory).all()
-    return inventory
+def inventory_map_statement(after_id, location, section, availability):
+    statement = select(Inventory.__table__).order_by(Inventory.id, Inventory.committed)
+    if after_id is not None:
+        statement = statement.where(Inventory.id > after_id)
+    if location is not None:
+        statement = statement.where(Inventory.location == location)
+    if section is not None:
+        statement = statement.where(Inventory.section == section)
+    if availability is not None:
+        statement = statement.where(Inventory.availability == availability)
+    return statement
+
+def stream_inventory_rows(statement, ndjson):
+    # Runs in the threadpool with its own session so the response outlives the request's scoped session
+    with Session(engine) as session:
+        # Server-side cursor, only one batch of rows is held in memory at a time
+        result = session.execute(statement.execution_options(yield_per=INVENTORY_STREAM_BATCH))
+        separator = b"\n" if ndjson else b","
+        first = True
+        if not ndjson:
+            yield b"["
+        for partition in result.partitions():
+            chunk = separator.join(dumps_json(Inventory.row_as_dict(row)) for row in partition)
+            if ndjson:
+                yield chunk + b"\n"
+            else:
+                yield chunk if first else b"," + chunk
+            first = False
+        if not ndjson:
+            yield b"]"
+
+# Without limit/stream the whole map is returned as one JSON array (streamed from the cursor),
+# ?limit=N returns one keyset page with the after_id of the next one, ?stream=true returns NDJSON
+# Rows are encoded directly (no per-row validation), INVENTORY_MAP_RESPONSES documents the three shapes
+@app.get("/inventory", response_model=None, responses=INVENTORY_MAP_RESPONSES)
+def get_inventory_map(request: Request, after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                      location: Optional[int] = None, section: Optional[str] = None, availability: Optional[str] = None):
+    statement = inventory_map_statement(after_id, location, section, availability)
+    if limit is not None:
+        limit = min(limit, INVENTORY_PAGE_MAX)
+        rows = db_session.execute(statement.limit(limit + 1)).all()
+        db_session.close()
+        next_after_id = None
+        if len(rows) > limit:
+            if rows[limit].id != rows[limit - 1].id:
+                rows = rows[:limit]
+            next_after_id = rows[-1].id
+        return JSONResponseClass({"items": [Inventory.row_as_dict(row) for row in rows], "next_after_id": next_after_id})
+
+    ndjson = stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    media_type = NDJSON_MEDIA_TYPE if ndjson else "application/json"
+    return StreamingResponse(stream_inventory_rows(statement, ndjson), media_type=media_type)
+
+# Top N seats across every server (or one with ?location=), best desirability (or lowest price) first
+# e.g. /inventory/search?max_price=300&limit=4 for the best 4 available seats under $300
+@app.get("/inventory/search", response_model=List[InventoryItem])
+def search_inventory(section: Optional[str] = None, min_price: Optional[int] = None, max_price: Optional[int] = None,
+                     min_desirability: Optional[int] = None, availability: str = "Available", location: Optional[int] = None,
+                     sort: Literal["desirability", "price"] = "desirability", limit: int = INVENTORY_SEARCH_DEFAULT):
+    # Same leading column as the ix_inventory_search_* indexes
+    statement = select(Inventory.__table__).where(Inventory.availability == availability)
+    if location is not None:
+        statement = statement.where(Inventory.location == location)
+    if section is not None:
+        statement = statement.where(Inventory.section == section)
+    if min_price is not None:
+        statement = statement.where(Inventory.price >= min_price)
+    if max_price is not None:
+        statement = statement.where(Inventory.price <= max_price)
+    if min_desirability is not None:
+        statement = statement.where(Inventory.desirability >= min_desirability)
+    limit = max(1, min(limit, INVENTORY_SEARCH_MAX))
+    rows = db_session.execute(statement.order_by(*Inventory.search_order(sort)).limit(limit)).all()
+    db_session.close()
+    return [Inventory.row_as_dict(row) for row in rows]
 
 @app.get("/latency/{nil}")
 def latency_test(nil: Optional[str]):
     return {"row":"1","section":"101","seat":"1","location":1,"availability":"Available","transaction_id":None,"is_dirty":False,"desirability":8,"id":1,"price":457,"description":None,"on_backup":False}
 
-@app.get("/inventory/{item_id}")
+@app.get("/inventory/{item_id}", response_model=Optional[InventoryItem])
 def get_item_status(item_id: int):
     db_session.commit()
     inventory = db_session.query(Inventory).filter(Inventory.id == item_id).first()
-    return inventory
+    return inventory.as_dict() if inventory else None
 
 @app.put("/inventory/transfer")
 def initiate_transfer(ids: List[int], destination: int, background_tasks: BackgroundTasks):
@@ -225,8 +316,20 @@ def initiate_transfer(ids: List[int], destination: int, background_tasks: Backgr
     db_session.close()
     return {"Status": "Queued"}
 
+# A new authority epoch for a pair, above anything either server was part of before
+def next_epoch(*servers):
+    return max(server.epoch or 0 for server in servers) + 1
+
+# Moves the failed server's seats to the backup after /failure answered, the backup already owns them by then
+def reassign_locations(failed_server_id, backup_server_id):
+    db_session.query(Inventory).filter(Inventory.location == failed_server_id, Inventory.write_locked != True).update({ Inventory.location: backup_server_id }, synchronize_session=False)
+    db_session.commit()
+    db_session.close()
+
+# The backup only asks once the failed server's ownership lease expired (see the server's lease module), so the grant
+# just records the new epoch and the inventory map catches up in the background
 @app.put("/failure")
-def report_failure(failed_server_id: int, backup_server_id: int):
+def report_failure(failed_server_id: int, backup_server_id: int, background_tasks: BackgroundTasks):
     print("Failure reported!")
     failed_server = db_session.query(Server).filter(Server.id == failed_server_id).first()
     backup_server = db_session.query(Server).filter(Server.id == backup_server_id).first()
@@ -247,14 +350,16 @@ def report_failure(failed_server_id: int, backup_server_id: int):
             # Updating hashmap to reflect backup server inheriting failed node's keys
             # Only if this is the first time the node has requested authority
             if backup_server.partner_id:
-                db_session.query(Inventory).filter(Inventory.location == failed_server_id, Inventory.write_locked != True).update({ Inventory.location: backup_server_id }, synchronize_session=False)
+                failed_server.epoch = backup_server.epoch = next_epoch(failed_server, backup_server)
+                background_tasks.add_task(reassign_locations, failed_server_id, backup_server_id)
 
             # Promoting/reverting (reporting) backup server to solo mode
             backup_server.partner_id = None
 
             db_session.commit()
+            epoch = backup_server.epoch
             db_session.close()
-            return {"Status": "Granted"}
+            return {"Status": "Granted", "epoch": epoch}
         
         
         
@@ -293,7 +398,9 @@ def send_inventory(server_id):
         inventory_list.append(item.as_dict())
 
     server_url = f'http://{server.ip_address}:{server.port}/inventory/update'
-    response = requests.request("PUT", server_url, headers={}, json = inventory_list)
+    content, headers = wire.encode_body(inventory_list, server_url)
+    response = requests.request("PUT", server_url, headers=headers, data = content)
+    wire.note_response(response)
     if response.ok:
         # db_session.query(Inventory).filter(Inventory.id.in_(reserved_ids)).update({Inventory.location: server_id}, synchronize_session=False)
         server.last_updated = datetime.utcnow()
@@ -301,7 +408,7 @@ def send_inventory(server_id):
     db_session.close()
 
 
-def post_recovery(relinquished_ids, deactivated_ids, unchanged_deactivated_ids, src_server_id, dest_server_id):
+def post_recovery(relinquished_ranges, deactivated_ids, unchanged_deactivated_ids, src_server_id, dest_server_id):
     # Pair servers
     print("post_recovery: Re-Pairing Servers")
     pair_servers(dest_server_id, src_server_id)
@@ -309,8 +416,10 @@ def post_recovery(relinquished_ids, deactivated_ids, unchanged_deactivated_ids,
 
     # Optimized reactivation: Reactivate keys that haven't been changed since the timeout
     print("post_recovery: Re-activating unchanged inventory (Optimized)")
-    unchanged_relinquished_ids = common_elements(unchanged_deactivated_ids, relinquished_ids)
-    unchanged_remaining_ids = list_difference(unchanged_deactivated_ids, relinquished_ids)
+    # Relinquished ids stay [[first, last], ...] runs (see id_ranges.id_ranges_predicate), a failover can hand back millions
+    relinquished = id_ranges.id_ranges_predicate(relinquished_ranges)
+    unchanged_relinquished_ids = [id for id in unchanged_deactivated_ids if relinquished(id)]
+    unchanged_remaining_ids = [id for id in unchanged_deactivated_ids if not relinquished(id)]
     print("Length of unchanged_relinquished_ids: " + str(len(unchanged_relinquished_ids)))
     print("Length of unchanged_remaining_ids: " + str(len(unchanged_remaining_ids)))
 
@@ -319,12 +428,11 @@ def post_recovery(relinquished_ids, deactivated_ids, unchanged_deactivated_ids,
     reactivate_clean_data(src_server_id, dest_server_id, src_server_id, unchanged_remaining_ids)
     
     remaining_ids = list_difference(deactivated_ids, unchanged_deactivated_ids)
-    remaining_relinquished_ids = list_difference(relinquished_ids, unchanged_relinquished_ids)
     print("Length of remaining_ids: " + str(len(remaining_ids)))
-    print("Length of remaining_relinquished_ids: " + str(len(remaining_relinquished_ids)))
+    print("Length of remaining_relinquished_ids: " + str(id_ranges.count_id_ranges(relinquished_ranges) - len(set(unchanged_relinquished_ids))))
 
     # Sync inventory
-    sync_inventory(remaining_relinquished_ids, remaining_ids, src_server_id, dest_server_id)
+    sync_inventory(relinquished_ranges, remaining_ids, src_server_id, dest_server_id, set(unchanged_relinquished_ids))
 
 
 def pair_servers(failed_server_id, backup_server_id):
@@ -332,14 +440,16 @@ def pair_servers(failed_server_id, backup_server_id):
     backup_server = db_session.query(Server).filter(Server.id == backup_server_id).first()
 
     # Pair servers together
-    backup_server_url = f'http://{backup_server.ip_address}:{backup_server.port}/partner?partner_id={failed_server_id}'
+    epoch = next_epoch(failed_server, backup_server)
+    backup_server_url = f'http://{backup_server.ip_address}:{backup_server.port}/partner?partner_id={failed_server_id}&epoch={epoch}'
     backup_server_resp = requests.request("PUT", backup_server_url)
     if backup_server_resp.ok:
-        failed_server_url = f'http://{failed_server.ip_address}:{failed_server.port}/partner?partner_id={backup_server_id}'
+        failed_server_url = f'http://{failed_server.ip_address}:{failed_server.port}/partner?partner_id={backup_server_id}&epoch={epoch}'
         failed_server_resp = requests.request("PUT", failed_server_url)
         if failed_server_resp.ok:
             failed_server.partner_id = backup_server_id
             backup_server.partner_id = failed_server_id
+            failed_server.epoch = backup_server.epoch = epoch
             db_session.commit()
             db_session.close()
             
@@ -373,9 +483,9 @@ def reactivate_clean_data(src_server_id, dest_server_id, new_location, unchanged
 # Relinquished IDs are the keys the previously failed node is requesting to regain
 # Deactivated IDs are all the keys successfully (deactivated)
 # The remaining deactivated keys are ones to be assigned to the src_server
-def sync_inventory(relinquished_ids, deactivated_ids, src_server_id, dest_server_id):
-    print("sync_inventory - relinquished_ids: " + str(relinquished_ids))
-    print("sync_inventory - deactivated_ids: " + str(deactivated_ids))
+def sync_inventory(relinquished_ranges, deactivated_ids, src_server_id, dest_server_id, synced_ids=()):
+    print("sync_inventory - relinquished_ids: " + str(id_ranges.count_id_ranges(relinquished_ranges)) + " in " + str(len(relinquished_ranges)) + " ranges")
+    print("sync_inventory - deactivated_ids: " + str(len(deactivated_ids)))
     print("sync_inventory - src_server_id: " + str(src_server_id))
     print("sync_inventory - dest_server_id: " + str(dest_server_id))
 
@@ -387,23 +497,25 @@ def sync_inventory(relinquished_ids, deactivated_ids, src_server_id, dest_server
     
     CHUNK_SIZE = 1000
 
-    curr_idx = 0
-    while curr_idx < len(relinquished_ids):
-        chunk = relinquished_ids[curr_idx:curr_idx+CHUNK_SIZE]
+    # Relinquished ids are expanded one chunk at a time, skipping the ones already reactivated (synced_ids)
+    relinquished_ids = (id for id in id_ranges.iter_id_ranges(relinquished_ranges) if id not in synced_ids)
+    chunk = list(islice(relinquished_ids, CHUNK_SIZE))
+    while chunk:
         deactivated_ids_chunk = request_deactivation(src_server_id, chunk, True)
         send_and_activate(dest_server_id, deactivated_ids_chunk)
 
-        curr_idx = (curr_idx+CHUNK_SIZE)
+        chunk = list(islice(relinquished_ids, CHUNK_SIZE))
 
-    remaining_ids = list_difference(deactivated_ids, relinquished_ids)
+    relinquished = id_ranges.id_ranges_predicate(relinquished_ranges)
+    remaining_ids = [id for id in deactivated_ids if not relinquished(id)]
 
-    print("sync_inventory - remaining_ids: " + str(remaining_ids))
+    print("sync_inventory - remaining_ids: " + str(len(remaining_ids)))
     curr_idx = 0
     while curr_idx < len(remaining_ids):
         chunk = remaining_ids[curr_idx:curr_idx+CHUNK_SIZE]
         print("Requesting deactivation of chunk to be sent to backup node")
         deactivated_ids_chunk = request_deactivation(src_server_id, chunk, True)
-        print("sync_inventory - deactivated_ids_chunk: " + str(deactivated_ids_chunk))
+        print("sync_inventory - deactivated_ids_chunk: " + str(len(deactivated_ids_chunk)))
         send_and_activate(src_server_id, deactivated_ids_chunk)
 
         curr_idx = (curr_idx+CHUNK_SIZE)
@@ -425,10 +537,11 @@ def request_deactivation_detailed(server_id, inventory_ids, new_location=0):
     CURR_SERV_IP = curr_serv.ip_address
     CURR_SERV_PORT = curr_serv.port
     curr_url = f'http://{CURR_SERV_IP}:{CURR_SERV_PORT}/inventory/deactivate?new_location={new_location}'
-    response = requests.request("PUT", curr_url, headers={}, json = inventory_ids)
+    content, headers = wire.encode_body(inventory_ids, curr_url)
+    response = requests.request("PUT", curr_url, headers=headers, data = content)
     if response.ok:
-        # If the response status code is 200 (OK), parse the response as JSON
-        json_data = response.json()
+        # If the response status code is 200 (OK), parse the response (JSON or msgpack, see wire)
+        json_data = wire.decode_response(response)
         return json_data
     return None
 
@@ -444,10 +557,11 @@ def request_deactivation(server_id, inventory_ids, write_to_database=False, new_
         chunk = inventory_ids[curr_idx:curr_idx+CHUNK_SIZE]
         # sending chunk
         curr_url = f'http://{CURR_SERV_IP}:{CURR_SERV_PORT}/inventory/deactivate?new_location={new_location}{"&send_data=True" if write_to_database else ""}'
-        response = requests.request("PUT", curr_url, headers={}, json = chunk)
+        content, headers = wire.encode_body(chunk, curr_url)
+        response = requests.request("PUT", curr_url, headers=headers, data = content)
         if response.ok:
-            # If the response status code is 200 (OK), parse the response as JSON
-            json_data = response.json()
+            # If the response status code is 200 (OK), parse the response (JSON or msgpack, see wire)
+            json_data = wire.decode_response(response)
             deactivated_inventory = json_data['deactivated_inventory']
 
             if write_to_database:
@@ -502,27 +616,35 @@ def send_and_activate(destination_server_id, inventory_ids):
         chunk_query = db_session.query(Inventory).filter(Inventory.id.in_(chunk), Inventory.location == destination_server_id)
         chunk_data = chunk_query.all()
         chunk_data = [object.as_dict() for object in chunk_data]
+        back_url = f'http://{BACK_SERV_IP}:{BACK_SERV_PORT}/inventory/update'
+        curr_url = f'http://{CURR_SERV_IP}:{CURR_SERV_PORT}/inventory/update'
+        # Encoded once per format (see wire), the backup and the primary usually get the same body
+        (back_content, back_headers), (chunk_content, chunk_headers) = wire.encode_bodies(chunk_data, (back_url, curr_url))
+        (back_ids_content, back_ids_headers), (ids_content, ids_headers) = wire.encode_bodies(chunk, (back_url, curr_url))
         # if partner, send data chunk to backup (partner)
         # Backup_serv is not transient (db close is above this)
         if BACK_SERV_IP:
-            back_url = f'http://{BACK_SERV_IP}:{BACK_SERV_PORT}/inventory/update'
-            upd_response = s_backup.put(back_url, json = chunk_data)
+            upd_response = s_backup.put(back_url, data = back_content, headers = back_headers)
+            wire.note_response(upd_response)
             # upd_response = requests.request("PUT", back_url, headers={}, json = chunk_data)
             backup_response = (upd_response.ok)
         # sending data chunk to primary
         print(f'Sending chunk of length {len(chunk_data)}: with keys [{chunk[0]} ... {chunk[len(chunk)-1]}]')
-        curr_url = f'http://{CURR_SERV_IP}:{CURR_SERV_PORT}/inventory/update'
-        upd_response = s_current.put(curr_url, json = chunk_data)
+        upd_response = s_current.put(curr_url, data = chunk_content, headers = chunk_headers)
+        wire.note_response(upd_response)
         # upd_response = requests.request("PUT", curr_url, headers={}, json = chunk_data)
+        if upd_response.ok:
+            # Receiver reports rows inserted/updated and how long the bulk upsert took
+            print(f'Chunk ingested by server {destination_server_id}: {upd_response.json()}')
         
         # If unactivated data successfully received by primary (& backup if applicable), send activate command
         if backup_response:
             curr_url = f'http://{BACK_SERV_IP}:{BACK_SERV_PORT}/inventory/activate'
-            active_resp = s_backup.put(curr_url, json = chunk)
+            active_resp = s_backup.put(curr_url, data = back_ids_content, headers = back_ids_headers)
             # active_resp = requests.request("PUT", curr_url, headers={}, json = chunk)
         if upd_response.ok:
             curr_url = f'http://{CURR_SERV_IP}:{CURR_SERV_PORT}/inventory/activate'
-            active_resp = s_current.put(curr_url, json = chunk)
+            active_resp = s_current.put(curr_url, data = ids_content, headers = ids_headers)
             # active_resp = requests.request("PUT", curr_url, headers={}, json = chunk)
             # If activate command received, update DB to reflect activation status
             if active_resp.ok:
@@ -575,10 +697,14 @@ async def initiate_recovery(request: Request, background_tasks: BackgroundTasks)
     # its failure and has already relinquished its old local data
     # Therefore, we can now safely mark it as being in Solo Mode
     print("Recovery request received...")
-    json_data = await request.json()
-    
-    relinquished_ids = json_data["relinquished_ids"]
-    print("Relinquished keys from failed server: " + str(relinquished_ids))
+    json_data = await wire.read_body(request)
+
+    # Servers send [[first, last], ...] runs of ids, older ones the full list
+    if "relinquished_ranges" in json_data:
+        relinquished_ranges = json_data["relinquished_ranges"]
+    else:
+        relinquished_ranges = id_ranges.id_ranges_of(json_data["relinquished_ids"])
+    print("Relinquished keys from failed server: " + str(id_ranges.count_id_ranges(relinquished_ranges)))
     failed_server_id = json_data["server_id"]
 
     failed_server = db_session.query(Server).filter(Server.id == failed_server_id).first()
@@ -608,11 +734,11 @@ async def initiate_recovery(request: Request, background_tasks: BackgroundTasks)
     # (Silently) deactivate data on previous partner
     backup_records = db_session.query(Inventory.id).filter(Inventory.location == backup_server_id).all()
     backup_keys = [obj[0] for obj in backup_records]
-    print("Requesting deactivation for keys: " + str(backup_keys))
+    print("Requesting deactivation for keys: " + str(len(backup_keys)))
     deactivation_data = request_deactivation_detailed(backup_server_id, backup_keys)
     unchanged_deactivated_data = deactivation_data["unchanged_deactivated_data"]
     deactivated_keys = deactivation_data["deactivated_inventory"]
-    print("Silent deactivated keys: " + str(deactivated_keys))
+    print("Silent deactivated keys: " + str(len(deactivated_keys)))
 
 
     # Temporarily mark successfully deactivated keys as belonging to Orchestrator (location = 0)
@@ -641,7 +767,7 @@ async def initiate_recovery(request: Request, background_tasks: BackgroundTasks)
     # as the failed partner has assumedly already deactivated all of its inventory
 
     # sync_inventory(relinquished_ids, deactivated_keys, backup_server_id, failed_server_id)
-    background_tasks.add_task(post_recovery, relinquished_ids, deactivated_keys, unchanged_deactivated_data, backup_server_id, failed_server_id)
+    background_tasks.add_task(post_recovery, relinquished_ranges, deactivated_keys, unchanged_deactivated_data, backup_server_id, failed_server_id)
     # background_tasks.add_task(sync_inventory, relinquished_ids, deactivated_keys, backup_server_id, failed_server_id)
     return {"Status": "Queued: Begin Operating"}
 
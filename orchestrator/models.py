@@ -1,7 +1,30 @@
-from sqlalchemy import ForeignKey, func, String, Boolean, Column, Integer, PickleType, DateTime
+from sqlalchemy import ForeignKey, func, String, Boolean, Column, Integer, PickleType, DateTime, Index
 from database import Base
 from sqlalchemy.orm import column_property, relationship
 from datetime import datetime, time, timedelta, date
+from operator import attrgetter
+
+# Row to dict serializer built once per model, as_dict used to walk __table__.columns for every row
+class RowSerializer:
+    def __init__(self, model, isoformat_columns=()):
+        self.columns = tuple(column.name for column in model.__table__.columns)
+        self.values_of = attrgetter(*self.columns)
+        self.isoformat_columns = isoformat_columns
+
+    def from_object(self, obj):
+        self_dict = dict(zip(self.columns, self.values_of(obj)))
+        for name in self.isoformat_columns:
+            value = self_dict[name]
+            self_dict[name] = None if not value else value.isoformat()
+        return self_dict
+
+    # Same output for rows returned by Core statements (e.g. INSERT ... RETURNING)
+    def from_row(self, row):
+        self_dict = dict(row._mapping)
+        for name in self.isoformat_columns:
+            value = self_dict.get(name)
+            self_dict[name] = None if not value else value.isoformat()
+        return self_dict
 
 class RegistryEntry(Base):
     __tablename__ = 'registry_entries'
@@ -14,7 +37,7 @@ class RegistryEntry(Base):
     datetime_value = Column(DateTime(), nullable=True)
 
     def as_dict(self):
-       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+       return self.serializer.from_object(self)
 
 class ActivityLog(Base):
     __tablename__ = 'activity_log'
@@ -24,7 +47,7 @@ class ActivityLog(Base):
     description = Column(String(), nullable=True)
 
     def as_dict(self):
-       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+       return self.serializer.from_object(self)
 
 class Server(Base):
     __tablename__ = 'servers'
@@ -39,12 +62,11 @@ class Server(Base):
     in_failure = Column(Boolean(), nullable=True)
     timeout_reported = Column(DateTime(), nullable=True)
     description = Column(String(), nullable=True)
+    # Authority epoch of the server's pair, moved on pairing and on every failover grant (see /failure)
+    epoch = Column(Integer(), nullable=True, default=0)
 
     def as_dict(self):
-      self_dict = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-      self_dict["last_updated"] = None if not self.last_updated else self.last_updated.isoformat()
-      self_dict["timeout_reported"] = None if not self.timeout_reported else self.timeout_reported.isoformat()
-      return self_dict
+      return self.serializer.from_object(self)
 
 class Inventory(Base):
    __tablename__ = 'inventory'
@@ -71,10 +93,29 @@ class Inventory(Base):
    # status_last_updated = Column(DateTime(), nullable=True)
    # last_write = Column(DateTime(), nullable=True)
 
+   # Indexes for the hot paths, databases created before they were added get them from migrations.upgrade
+   __table_args__ = (
+      # Per-server inventory (pairing, sync, recovery transfers) and id lookups scoped to an owner
+      Index('ix_inventory_location', 'location', 'id'),
+      # Seat search (/inventory/search), one per ordering so the top N rows are read straight off the index
+      Index('ix_inventory_search_desirability', availability, desirability.desc().nulls_last(), price, id),
+      Index('ix_inventory_search_price', availability, price, desirability.desc().nulls_last(), id),
+   )
+
    def as_dict(self):
-      self_dict = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-      self_dict["last_modified_date"] = None if not self.last_modified_date else self.last_modified_date.isoformat()
-      return self_dict
+      return self.serializer.from_object(self)
+
+   # Same output as as_dict for rows returned by Core statements (e.g. INSERT ... RETURNING)
+   @staticmethod
+   def row_as_dict(row):
+      return Inventory.serializer.from_row(row)
+
+   # Orderings for /inventory/search, each matches one of the ix_inventory_search_* indexes
+   @classmethod
+   def search_order(cls, sort):
+      if sort == "price":
+         return (cls.price, cls.desirability.desc().nulls_last(), cls.id)
+      return (cls.desirability.desc().nulls_last(), cls.price, cls.id)
    
    def copy(self, new_object):
       for col in self.__table__.columns:
@@ -91,7 +132,7 @@ class WorkerTask(Base):
     ip_address = Column(String(), nullable=True)
     port = Column(String(), nullable=True)
     def as_dict(self):
-       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+       return self.serializer.from_object(self)
 
 class Reservation(Base):
     __tablename__ = 'inventory_reservations'
@@ -106,5 +147,12 @@ class Reservation(Base):
     forwarded = Column(Boolean(), nullable=True)
 
     def as_dict(self):
-       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
-    
+       return self.serializer.from_object(self)
+
+
+RegistryEntry.serializer = RowSerializer(RegistryEntry)
+ActivityLog.serializer = RowSerializer(ActivityLog)
+Server.serializer = RowSerializer(Server, ("last_updated", "timeout_reported"))
+Inventory.serializer = RowSerializer(Inventory, ("last_modified_date",))
+WorkerTask.serializer = RowSerializer(WorkerTask)
+Reservation.serializer = RowSerializer(Reservation)
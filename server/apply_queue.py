@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+import metrics
+from partner_client import async_partner_client
+from registry import retrieve_registry, refresh_registry
+from shared_state import SharedIdQueue
+
+# Coalesced apply pipeline to the backup partner
+# Ids applied on the primary are queued instead of sent one request per transaction,
+# the queue is drained either by the next prepare batch (piggybacked, see group_commit)
+# or by a periodic /apply call, failed sends are re-queued and retried with backoff.
+# Ids the partner prepared but the primary dropped afterwards (e.g. a seat block it only partly accepted)
+# go through the same pipeline with the discard action (discard_queue_for), so they don't stay prepared there
+# The queue is shared by every API worker on this host (see shared_state.SharedIdQueue): a payment served by
+# another worker than its reservation carries the reservation's apply in its own prepare, instead of reaching
+# the partner while the reservation is still tentative there
+
+APPLY_FLUSH_INTERVAL = float(os.environ.get("ANTIHERO_APPLY_FLUSH_INTERVAL_MS", "20")) / 1000
+APPLY_RETRY_BACKOFF = float(os.environ.get("ANTIHERO_APPLY_RETRY_BACKOFF_MS", "100")) / 1000
+APPLY_RETRY_BACKOFF_MAX = float(os.environ.get("ANTIHERO_APPLY_RETRY_BACKOFF_MAX_MS", "5000")) / 1000
+APPLY_QUEUE_CAPACITY = int(os.environ.get("ANTIHERO_APPLY_QUEUE_CAPACITY", "65536"))
+
+
+class ApplyQueue:
+    def __init__(self, model, action="apply"):
+        self.model = model
+        self.action = action
+        self.route_slug = f'/{model.__qualname__.lower()}/{action}'
+        self.metric_prefix = f'{model.__tablename__}_{action}'
+        # id -> wall clock time it was first queued, the same in every process
+        self.pending = SharedIdQueue(f'{model.__tablename__}-{action}-queue', APPLY_QUEUE_CAPACITY)
+        # Ids that didn't fit in the shared queue stay with this process until its next send
+        self.overflow = {}
+        self.backoff = 0
+        self.retry_at = 0
+        self.task = None
+        metrics.register_gauge(f'{self.metric_prefix}_queue_depth', self.depth)
+        metrics.register_gauge(f'{self.metric_prefix}_queue_lag_seconds', self.lag)
+
+    def depth(self):
+        return len(self.pending) + len(self.overflow)
+
+    def lag(self):
+        oldest = min(self.overflow.values(), default=None)
+        shared_oldest = self.pending.oldest()
+        if shared_oldest is not None and (oldest is None or shared_oldest < oldest):
+            oldest = shared_oldest
+        if oldest is None:
+            return 0.0
+        return time.time() - oldest
+
+    def enqueue(self, ids):
+        queued_at = time.time()
+        self.requeue({id: queued_at for id in ids})
+
+    # Removes every pending id (with its queue time) so the caller can send them
+    def take(self):
+        taken = self.pending.take()
+        for id, queued_at in self.overflow.items():
+            taken[id] = min(queued_at, taken.get(id, queued_at))
+        self.overflow = {}
+        return taken
+
+    def requeue(self, taken):
+        if not taken:
+            return
+        for id, queued_at in self.pending.merge(taken).items():
+            self.overflow[id] = min(queued_at, self.overflow.get(id, queued_at))
+
+    def sent(self, taken, piggybacked=False):
+        self.backoff = 0
+        self.retry_at = 0
+        if piggybacked:
+            metrics.increment(f'{self.metric_prefix}_ids_piggybacked', len(taken))
+        else:
+            metrics.increment(f'{self.metric_prefix}_batches_sent')
+            metrics.increment(f'{self.metric_prefix}_ids_sent', len(taken))
+
+    def failed(self, taken):
+        self.requeue(taken)
+        self.backoff = min(self.backoff * 2, APPLY_RETRY_BACKOFF_MAX) if self.backoff else APPLY_RETRY_BACKOFF
+        self.retry_at = time.monotonic() + self.backoff
+        metrics.increment(f'{self.metric_prefix}_retries')
+
+    async def flush(self):
+        # Runs outside any request, the registry is brought up to date first (see registry.RegistryCache)
+        await refresh_registry()
+        partner_id = retrieve_registry("Partner_ID", 0)
+        in_backup = retrieve_registry("In_Backup", False)
+        taken = self.take()
+        if not taken:
+            return
+        if in_backup or not partner_id:
+            # No partner to send to anymore, recovery reconciles whatever it missed
+            metrics.increment(f'{self.metric_prefix}_ids_dropped', len(taken))
+            return
+
+        request_body = {
+            "request_time": datetime.utcnow().isoformat(),
+            "model": self.model.__qualname__,
+            "ids": list(taken)
+        }
+        try:
+            response = await async_partner_client.request("PUT", partner_id, self.route_slug, request_body)
+            succeeded = response is not None and response.is_success
+        except Exception as error:
+            print(f"{self.action.capitalize()} batch failed:", error)
+            succeeded = False
+
+        if succeeded:
+            self.sent(taken)
+        else:
+            self.failed(taken)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(APPLY_FLUSH_INTERVAL)
+            if self.depth() and time.monotonic() >= self.retry_at:
+                try:
+                    await self.flush()
+                except Exception as error:
+                    print(f"{self.action.capitalize()} queue flush error:", error)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    # Stops the periodic flush and makes one last attempt to drain the queue
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+
+apply_queues = {}
+
+
+def apply_queue_for(model):
+    queue = apply_queues.get(model)
+    if queue is None:
+        queue = ApplyQueue(model)
+        apply_queues[model] = queue
+    return queue
+
+
+discard_queues = {}
+
+
+def discard_queue_for(model):
+    queue = discard_queues.get(model)
+    if queue is None:
+        queue = ApplyQueue(model, "discard")
+        discard_queues[model] = queue
+    return queue
@@ -0,0 +1,64 @@
+import os
+from sqlalchemy import select
+import metrics
+from models import Inventory
+from shared_state import SharedRegion, HostPresence
+
+# In-memory availability of the seats on this server, one byte per inventory id in shared memory
+# so every API worker sees the same index. It only turns away requests for seats known to be gone
+# before a transaction is opened: unknown and available seats still go to the database, and paths that
+# could make a seat available again record the state they wrote (or forget the seat) instead of guessing
+
+AVAILABILITY_CAPACITY = int(os.environ.get("ANTIHERO_AVAILABILITY_CAPACITY", str(1 << 22)))
+
+UNKNOWN = 0
+AVAILABLE = 1
+UNAVAILABLE = 2
+
+
+class AvailabilityIndex:
+    def __init__(self, region: SharedRegion, presence: HostPresence):
+        self.region = region
+        self.presence = presence
+        self.capacity = region.size
+
+    # rows: (id, availability) of committed rows as they are now in the database
+    def mark(self, rows):
+        buffer = self.region.buffer
+        for id, availability in rows:
+            if 0 <= id < self.capacity:
+                buffer[id] = AVAILABLE if availability == "Available" else UNAVAILABLE
+
+    def forget(self, ids):
+        buffer = self.region.buffer
+        for id in ids:
+            if 0 <= id < self.capacity:
+                buffer[id] = UNKNOWN
+
+    def forget_all(self):
+        self.region.buffer[:] = bytes(self.capacity)
+
+    def is_unavailable(self, id):
+        return 0 <= id < self.capacity and self.region.buffer[id] == UNAVAILABLE
+
+    # Requested ids minus the ones known to be taken
+    def candidates(self, ids):
+        remaining = [id for id in ids if not self.is_unavailable(id)]
+        metrics.increment("availability_ids_filtered", len(ids) - len(remaining))
+        return remaining
+
+    # Rebuilt from the committed rows this server owns by the first API worker to start on this host,
+    # workers started while it runs wait for that load and then share the index the others keep current
+    async def load(self, session, server_id):
+        if not self.presence.arrive():
+            return
+        try:
+            self.forget_all()
+            result = await session.execute(select(Inventory.id, Inventory.availability)
+                                           .where(Inventory.location == server_id, Inventory.committed == True))
+            self.mark(result.all())
+        finally:
+            self.presence.settle()
+
+
+availability_index = AvailabilityIndex(SharedRegion("availability", AVAILABILITY_CAPACITY), HostPresence("availability-workers"))
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import Base, engine, async_engine
+from migrations import upgrade
+from statements import VERSIONED_STORAGE
+import wire
+from worker import take_over_inventory, release_inventory
+
+# Failover time versus inventory size
+# For each size, seeds that many synthetic seats split between a failed server and its backup in blocks
+# (the way transfer_inventory hands them out), 0.1% of them with an in-flight tentative write, then times
+# the backup taking over (worker.take_over_inventory) and the failed server relinquishing its inventory
+# (worker.release_inventory, including the /initiate-recovery payload it produces).
+# Everything runs in a transaction that is rolled back, so the synthetic seats never persist
+#
+#   python failover_benchmark.py                              10k, 100k and 1M seats
+#   python failover_benchmark.py --seats 50000 2000000        other sizes
+#
+# The Postgres version and the settings that move these timings are printed first, so a run can be compared
+# with another. Reference run (shadow storage, blocks of 1000), PostgreSQL 16.2 with its default settings
+# (shared_buffers 128MB, work_mem 4MB, maintenance_work_mem 64MB, synchronous_commit on, fsync on) on the
+# same host as the client, 1 vCPU and 5GB of RAM:
+#
+#        seats      seed   takeover   relinquish   ranges    payload      id list
+#        10000     0.16s     0.099s       0.156s        6         77        32047
+#       100000     2.24s     1.210s       1.828s       51        476       349048
+#      1000000    23.64s    11.546s      20.067s      501       5426      3951049
+
+# Settings printed with the results
+REPORTED_SETTINGS = ("shared_buffers", "work_mem", "maintenance_work_mem", "effective_cache_size", "synchronous_commit",
+                     "fsync", "random_page_cost", "max_parallel_workers_per_gather", "jit")
+
+
+def seed_failover_seats(seats, block, failed_server_id, backup_server_id):
+    seed = text('''
+        INSERT INTO inventory (id, section, "row", seat, desirability, location, price, availability, transaction_id,
+                               committed, on_backup, activated, write_locked)
+        SELECT base.max_id + g, 'S' || (g % 50), (g % 40)::text, (g % 30)::text, g % 10,
+               CASE WHEN (g / :block) % 2 = 0 THEN :failed ELSE :backup END, 100 + g % 400, 'Available', NULL,
+               true, false, true, false
+        FROM generate_series(1, :seats) AS g, (SELECT coalesce(max(id), 0) AS max_id FROM inventory) AS base
+        RETURNING id
+    ''').bindparams(seats=seats, block=block, failed=failed_server_id, backup=backup_server_id)
+    if VERSIONED_STORAGE:
+        tentative = text('''
+            UPDATE inventory SET pending = '{"availability": "Reserved"}'::jsonb
+            WHERE id = ANY(:ids) AND committed
+        ''')
+    else:
+        tentative = text('''
+            INSERT INTO inventory (id, section, "row", seat, desirability, location, price, availability, transaction_id,
+                                   committed, on_backup, activated, write_locked)
+            SELECT id, section, "row", seat, desirability, location, price, 'Reserved', 'BENCH', false, on_backup, activated, write_locked
+            FROM inventory WHERE id = ANY(:ids) AND committed
+        ''')
+    return seed, tentative
+
+
+async def timed(conn, step):
+    # Each step starts from the freshly seeded seats
+    savepoint = await conn.begin_nested()
+    session = AsyncSession(bind=conn)
+    try:
+        started = time.perf_counter()
+        result = await step(session)
+        return time.perf_counter() - started, result
+    finally:
+        await session.close()
+        await savepoint.rollback()
+
+
+async def benchmark(seats, block, failed_server_id, backup_server_id):
+    async with async_engine.connect() as conn:
+        transaction = await conn.begin()
+        try:
+            seed, tentative = seed_failover_seats(seats, block, failed_server_id, backup_server_id)
+            started = time.perf_counter()
+            ids = (await conn.execute(seed)).scalars().all()
+            in_flight_ids = ids[::1000]
+            await conn.execute(tentative, {"ids": in_flight_ids})
+            await conn.execute(text("ANALYZE inventory"))
+            seed_time = time.perf_counter() - started
+
+            takeover_time, _ = await timed(conn, lambda session: take_over_inventory(session, backup_server_id, failed_server_id, in_flight_ids))
+            relinquish_time, ranges = await timed(conn, lambda session: release_inventory(session, failed_server_id, backup_server_id, in_flight_ids))
+        finally:
+            await transaction.rollback()
+
+    # As sent to an orchestrator that reads the configured format
+    recovery_body = {"relinquished_ranges": ranges, "server_id": failed_server_id}
+    payload = wire.dumps(recovery_body) if wire.WIRE_FORMAT == "msgpack" else json.dumps(recovery_body).encode()
+    # The full id list servers sent before the runs
+    relinquished_ids = [id for first, last in ranges for id in range(first, last + 1)]
+    id_list_payload = json.dumps({"relinquished_ids": relinquished_ids, "server_id": failed_server_id})
+    print(f"{seats:>10} {seed_time:>8.2f}s {takeover_time:>9.3f}s {relinquish_time:>11.3f}s {len(ranges):>8} {len(payload):>10} {len(id_list_payload):>12}")
+
+
+async def describe_database():
+    async with async_engine.connect() as conn:
+        print((await conn.execute(text("SELECT version()"))).scalar())
+        settings = await conn.execute(text("SELECT name, setting, unit FROM pg_settings WHERE name = ANY(:names) ORDER BY name"),
+                                      {"names": list(REPORTED_SETTINGS)})
+        print(", ".join(f"{name}={setting}{' ' + unit if unit else ''}" for name, setting, unit in settings))
+    print(f"Client: {os.cpu_count()} CPUs")
+
+
+async def main(args):
+    await describe_database()
+    print(f"Storage mode: {'versioned' if VERSIONED_STORAGE else 'shadow'}, seats in blocks of {args.block}")
+    print(f"{'seats':>10} {'seed':>9} {'takeover':>10} {'relinquish':>12} {'ranges':>8} {'payload':>10} {'id list':>12}")
+    try:
+        for seats in args.seats:
+            await benchmark(seats, args.block, args.failed_server_id, args.backup_server_id)
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seats", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--block", type=int, default=1000)
+    parser.add_argument("--failed-server-id", type=int, default=901)
+    parser.add_argument("--backup-server-id", type=int, default=902)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    upgrade()
+    asyncio.run(main(args))
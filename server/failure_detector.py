@@ -0,0 +1,166 @@
+import math
+import os
+import statistics
+import struct
+import time
+from datetime import timezone
+import metrics
+from heartbeat import heartbeat_state, HEARTBEAT_INTERVAL
+from shared_state import SharedRegion
+
+# Partner failure detectors for worker.py's failure detection
+# A detector looks at the time since the partner's last heartbeat (and the recent inter-arrival times
+# kept by heartbeat_state) and returns a suspicion level, the partner is declared failed once it reaches
+# the detector's threshold. The worker sleeps until the time the threshold would be reached (deadline)
+# and checks again then, a heartbeat arriving in between only moves the deadline later.
+# ANTIHERO_FAILURE_DETECTOR picks one:
+#
+#   phi    phi accrual (Hayashibara et al.), the threshold is a confidence level (phi 8 ~ 1e-8 chance the
+#          partner is still alive), adapts to the heartbeat interval and jitter actually measured
+#   fixed  the partner is failed once no heartbeat arrived for ANTIHERO_HEARTBEAT_TIMEOUT seconds (the level is elapsed / timeout)
+#
+# Detections are recorded in shared memory so the API workers can serve them from /metrics
+
+FAILURE_DETECTOR = os.environ.get("ANTIHERO_FAILURE_DETECTOR", "phi").lower()
+# Longest wait between two checks (e.g. before the first heartbeat after pairing)
+FAILURE_CHECK_INTERVAL = float(os.environ.get("ANTIHERO_FAILURE_CHECK_INTERVAL_MS", "1000")) / 1000
+HEARTBEAT_TIMEOUT = float(os.environ.get("ANTIHERO_HEARTBEAT_TIMEOUT", "10"))
+PHI_THRESHOLD = float(os.environ.get("ANTIHERO_PHI_THRESHOLD", "8"))
+PHI_MIN_STD = float(os.environ.get("ANTIHERO_PHI_MIN_STD_MS", "100")) / 1000
+PHI_ACCEPTABLE_PAUSE = float(os.environ.get("ANTIHERO_PHI_ACCEPTABLE_PAUSE_MS", "0")) / 1000
+# Samples needed before the measured intervals replace the expected one
+PHI_MIN_SAMPLES = int(os.environ.get("ANTIHERO_PHI_MIN_SAMPLES", "5"))
+
+
+class FixedTimeoutDetector:
+    name = "fixed"
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.threshold = 1.0
+
+    def suspicion(self, elapsed, intervals):
+        return elapsed / self.timeout
+
+    def deadline(self, intervals):
+        return self.timeout
+
+
+class PhiAccrualDetector:
+    name = "phi"
+
+    def __init__(self, threshold, expected_interval, min_std, acceptable_pause, min_samples):
+        self.threshold = threshold
+        self.expected_interval = expected_interval
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.min_samples = min_samples
+
+    def distribution(self, intervals):
+        if len(intervals) < self.min_samples:
+            # Until enough heartbeats arrived, assume the configured interval with a wide spread
+            return self.expected_interval, self.expected_interval / 4
+        return statistics.fmean(intervals), max(statistics.pstdev(intervals), self.min_std)
+
+    # -log10 of the probability that a heartbeat still arrives after `elapsed` seconds,
+    # with the logistic approximation of the normal CDF used by Akka/Cassandra
+    def suspicion(self, elapsed, intervals):
+        mean, std = self.distribution(intervals)
+        y = (elapsed - mean - self.acceptable_pause) / std
+        exponent = -y * (1.5976 + 0.070566 * y * y)
+        if exponent > 700:
+            # Far below the mean
+            return 0.0
+        e = math.exp(exponent)
+        if y > 0:
+            # -log10(e / (1 + e)) without underflowing e to 0 far above the mean
+            return -exponent / math.log(10) + math.log10(1.0 + e)
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    # Elapsed time at which the suspicion reaches the threshold (it only grows with elapsed)
+    def deadline(self, intervals):
+        mean, std = self.distribution(intervals)
+        low, high = 0.0, mean + self.acceptable_pause + 40 * std
+        for _ in range(40):
+            middle = (low + high) / 2
+            if self.suspicion(middle, intervals) < self.threshold:
+                low = middle
+            else:
+                high = middle
+        return high
+
+
+def detector_from_env(expected_interval):
+    if FAILURE_DETECTOR == "fixed":
+        return FixedTimeoutDetector(HEARTBEAT_TIMEOUT)
+    if FAILURE_DETECTOR != "phi":
+        print(f"Unknown failure detector {FAILURE_DETECTOR}, using phi")
+    return PhiAccrualDetector(PHI_THRESHOLD, expected_interval, PHI_MIN_STD, PHI_ACCEPTABLE_PAUSE, PHI_MIN_SAMPLES)
+
+
+# detections, last detection latency (seconds from the last heartbeat), suspicion level at the last detection
+DETECTION_FORMAT = "Qdd"
+DETECTION_SIZE = struct.calcsize(DETECTION_FORMAT)
+
+
+class DetectionLog:
+    def __init__(self, region: SharedRegion):
+        self.region = region
+
+    def read(self):
+        return struct.unpack_from(DETECTION_FORMAT, self.region.buffer, 0)
+
+    def record(self, latency, level):
+        with self.region.locked():
+            detections, _, _ = self.read()
+            struct.pack_into(DETECTION_FORMAT, self.region.buffer, 0, detections + 1, latency, level)
+
+
+detection_log = DetectionLog(SharedRegion("failure-detections", DETECTION_SIZE))
+failure_detector = detector_from_env(HEARTBEAT_INTERVAL)
+
+
+# Seconds since the partner's last heartbeat, None if none was received since pairing
+def heartbeat_elapsed(now=None):
+    last_received_at = heartbeat_state.last_received_at()
+    if not last_received_at:
+        last_heartbeat = heartbeat_state.last_received()
+        if last_heartbeat is None:
+            return None
+        # Registry checkpoint (naive UTC)
+        last_received_at = last_heartbeat.replace(tzinfo=timezone.utc).timestamp()
+    return (time.time() if now is None else now) - last_received_at
+
+
+def current_suspicion(detector=failure_detector):
+    elapsed = heartbeat_elapsed()
+    if elapsed is None:
+        return 0.0
+    return detector.suspicion(elapsed, heartbeat_state.intervals())
+
+
+# Seconds until the partner would be suspected if no heartbeat arrives, None before the first heartbeat
+def seconds_until_suspected(detector=failure_detector):
+    elapsed = heartbeat_elapsed()
+    if elapsed is None:
+        return None
+    return max(detector.deadline(heartbeat_state.intervals()) - elapsed, 0.0)
+
+
+# Returns True when the partner should be declared failed, recording the detection
+def partner_failed(detector=failure_detector):
+    elapsed = heartbeat_elapsed()
+    if elapsed is None:
+        return False
+    level = detector.suspicion(elapsed, heartbeat_state.intervals())
+    if level < detector.threshold:
+        return False
+    detection_log.record(elapsed, level)
+    print(f"Partner suspected by the {detector.name} detector: {elapsed:.2f}s since the last heartbeat, suspicion {level:.2f}")
+    return True
+
+
+metrics.register_gauge("failure_detector_suspicion", current_suspicion)
+metrics.register_gauge("failure_detections", lambda: detection_log.read()[0])
+metrics.register_gauge("failure_detection_latency_seconds", lambda: detection_log.read()[1])
+metrics.register_gauge("failure_detection_level", lambda: detection_log.read()[2])
@@ -0,0 +1,119 @@
+import asyncio
+import os
+from datetime import datetime
+import metrics
+import wire
+from apply_queue import apply_queue_for, discard_queue_for
+from partner_client import async_partner_client
+
+# Group commit for tentative writes sent to the backup partner
+# Concurrent reservations/payments arriving within a short window share one /prepare round-trip,
+# each caller gets back only the ids it submitted that the partner accepted, a batch that fails is sent again
+# one caller per request so a single caller's failure stays its own
+
+PREPARE_BATCH_WINDOW = float(os.environ.get("ANTIHERO_PREPARE_BATCH_WINDOW_US", "300")) / 1000000
+PREPARE_BATCH_MAX_ROWS = int(os.environ.get("ANTIHERO_PREPARE_BATCH_MAX_ROWS", "500"))
+
+
+class PrepareBatcher:
+    def __init__(self, model):
+        self.model = model
+        self.route_slug = f'/{model.__qualname__.lower()}/prepare'
+        self.pending = []
+        self.pending_rows = 0
+        self.flush_handle = None
+        # Keeps in-flight sends referenced until they finish
+        self.sending = set()
+
+    # Returns the accepted subset of ids in `data`, None if the partner could not be reached
+    # or answered with an error, raises if the request itself failed
+    async def submit(self, data):
+        if not data:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((data, future))
+        self.pending_rows += len(data)
+        if self.pending_rows >= PREPARE_BATCH_MAX_ROWS:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(PREPARE_BATCH_WINDOW, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch = self.pending
+        self.pending = []
+        self.pending_rows = 0
+        if batch:
+            # The next batch starts filling while this one is in flight
+            task = asyncio.get_running_loop().create_task(self.send(batch))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def send(self, batch):
+        request_body = {
+            "request_time": datetime.utcnow().isoformat(),
+            "model": self.model.__qualname__,
+            "data": [obj for data, _ in batch for obj in data]
+        }
+        # Pending discards and applies ride along and are handled by the partner before the new rows are prepared
+        discard_queue = discard_queue_for(self.model)
+        piggybacked_discards = discard_queue.take()
+        if piggybacked_discards:
+            request_body["discard_ids"] = list(piggybacked_discards)
+        apply_queue = apply_queue_for(self.model)
+        piggybacked = apply_queue.take()
+        if piggybacked:
+            request_body["apply_ids"] = list(piggybacked)
+        print(f"Sending prepare batch: {len(request_body['data'])} rows from {len(batch)} requests")
+        metrics.increment(f'{self.model.__tablename__}_prepare_batches_sent')
+        metrics.increment(f'{self.model.__tablename__}_prepare_rows_sent', len(request_body['data']))
+        failure = None
+        try:
+            response = await async_partner_client.partner_request("PUT", self.route_slug, request_body)
+            accepted_ids = None
+            if response is not None and response.is_success:
+                accepted_ids = set(wire.decode_response(response)['ids'])
+        except Exception as error:
+            failure = error
+            accepted_ids = None
+
+        if accepted_ids is None:
+            discard_queue.requeue(piggybacked_discards)
+            apply_queue.requeue(piggybacked)
+            # One caller's rows (or one lost response) must not fail every request coalesced with it:
+            # each caller is sent again on its own
+            if len(batch) > 1:
+                metrics.increment(f'{self.model.__tablename__}_prepare_batches_split')
+                await asyncio.gather(*(self.send([entry]) for entry in batch))
+                return
+        else:
+            if piggybacked_discards:
+                discard_queue.sent(piggybacked_discards, piggybacked=True)
+            if piggybacked:
+                apply_queue.sent(piggybacked, piggybacked=True)
+
+        for data, future in batch:
+            # A caller that was cancelled while waiting no longer has a future to resolve
+            if future.done():
+                continue
+            if failure is not None:
+                future.set_exception(failure)
+            elif accepted_ids is None:
+                future.set_result(None)
+            else:
+                future.set_result([obj['id'] for obj in data if obj['id'] in accepted_ids])
+
+
+prepare_batchers = {}
+
+
+def prepare_batcher_for(model):
+    batcher = prepare_batchers.get(model)
+    if batcher is None:
+        batcher = PrepareBatcher(model)
+        prepare_batchers[model] = batcher
+    return batcher
@@ -0,0 +1,91 @@
+import os
+import struct
+import time
+from datetime import datetime
+import metrics
+from registry import retrieve_registry
+from shared_state import SharedRegion
+
+# Heartbeat bookkeeping shared by the API workers (receiving /heartbeat) and worker.py (sending and checking)
+# Arrivals are recorded in shared memory, Postgres only gets a Last_Heartbeat checkpoint every
+# HEARTBEAT_CHECKPOINT_INTERVAL seconds so a restarted host still has a recent value to start from.
+# The last HEARTBEAT_SAMPLES inter-arrival times are kept for the failure detector (see failure_detector)
+
+HEARTBEAT_INTERVAL = float(os.environ.get("ANTIHERO_HEARTBEAT_INTERVAL_MS", "2000")) / 1000
+HEARTBEAT_CHECKPOINT_INTERVAL = float(os.environ.get("ANTIHERO_HEARTBEAT_CHECKPOINT_INTERVAL", "30"))
+HEARTBEAT_SAMPLES = int(os.environ.get("ANTIHERO_HEARTBEAT_SAMPLES", "100"))
+
+# last received, last acknowledged (send time of the last heartbeat the partner accepted, see lease),
+# last checkpoint (epoch seconds, 0 when unset), heartbeats received,
+# followed by a ring of inter-arrival times (interval n is in slot n % HEARTBEAT_SAMPLES)
+STATE_FORMAT = "dddQ"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+SAMPLE_FORMAT = "d"
+SAMPLE_SIZE = struct.calcsize(SAMPLE_FORMAT)
+
+
+class HeartbeatState:
+    def __init__(self, region: SharedRegion):
+        self.region = region
+
+    def read(self):
+        return struct.unpack_from(STATE_FORMAT, self.region.buffer, 0)
+
+    def write(self, received_at, acknowledged_at, checkpoint_at, received):
+        struct.pack_into(STATE_FORMAT, self.region.buffer, 0, received_at, acknowledged_at, checkpoint_at, received)
+
+    # Returns True when the arrival should also be checkpointed to the registry
+    def received(self, now=None):
+        now = time.time() if now is None else now
+        with self.region.locked():
+            received_at, acknowledged_at, checkpoint_at, received = self.read()
+            if received and now > received_at:
+                slot = (received - 1) % HEARTBEAT_SAMPLES
+                struct.pack_into(SAMPLE_FORMAT, self.region.buffer, STATE_SIZE + slot * SAMPLE_SIZE, now - received_at)
+            checkpoint_due = now - checkpoint_at >= HEARTBEAT_CHECKPOINT_INTERVAL
+            self.write(now, acknowledged_at, now if checkpoint_due else checkpoint_at, received + 1)
+        metrics.increment("heartbeats_received")
+        if checkpoint_due:
+            metrics.increment("heartbeat_checkpoints")
+        return checkpoint_due
+
+    # Called once the partner accepted a heartbeat, with the time it was sent
+    def acknowledged(self, sent_at):
+        with self.region.locked():
+            received_at, acknowledged_at, checkpoint_at, received = self.read()
+            self.write(received_at, max(sent_at, acknowledged_at), checkpoint_at, received)
+
+    # Pairing, reset: no heartbeat received yet (callers store Last_Heartbeat = None alongside)
+    def clear(self):
+        with self.region.locked():
+            self.write(0, 0, 0, 0)
+
+    def last_received_at(self):
+        return self.read()[0]
+
+    def last_acknowledged_at(self):
+        return self.read()[1]
+
+    def received_count(self):
+        return self.read()[3]
+
+    # Recent inter-arrival times in seconds (oldest first once the ring has wrapped)
+    def intervals(self):
+        received = self.received_count()
+        count = min(max(received - 1, 0), HEARTBEAT_SAMPLES)
+        start = (received - 1 - count) % HEARTBEAT_SAMPLES
+        return [struct.unpack_from(SAMPLE_FORMAT, self.region.buffer, STATE_SIZE + ((start + index) % HEARTBEAT_SAMPLES) * SAMPLE_SIZE)[0]
+                for index in range(count)]
+
+    # Time of the last heartbeat received (naive UTC like the registry), falls back to the
+    # registry checkpoint when shared memory has nothing (e.g. the host restarted)
+    def last_received(self):
+        received_at = self.last_received_at()
+        if received_at:
+            return datetime.utcfromtimestamp(received_at)
+        return retrieve_registry("Last_Heartbeat", None)
+
+
+heartbeat_state = HeartbeatState(SharedRegion("heartbeat", STATE_SIZE + HEARTBEAT_SAMPLES * SAMPLE_SIZE))
+metrics.register_gauge("heartbeat_age_seconds",
+                       lambda: time.time() - heartbeat_state.last_received_at() if heartbeat_state.last_received_at() else 0.0)
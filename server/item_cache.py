@@ -0,0 +1,71 @@
+import os
+import time
+from collections import OrderedDict
+import metrics
+from shared_state import SharedCounters
+
+# Read-through cache for GET /inventory/{item_id}
+# Each process keeps an LRU of serialized item responses (or the owning server for items held elsewhere).
+# Writes bump a shared per-stripe version, an entry is only served while its stripe version is unchanged,
+# so a write in any process (API worker or worker.py) invalidates every process's copy
+
+ITEM_CACHE_SIZE = int(os.environ.get("ANTIHERO_ITEM_CACHE_SIZE", "100000"))
+ITEM_CACHE_TTL = float(os.environ.get("ANTIHERO_ITEM_CACHE_TTL", "30"))
+ITEM_CACHE_STRIPES = 4096
+# Invalidations touching more ids than this bump the global epoch instead of individual stripes
+ITEM_CACHE_BULK_INVALIDATION = 1024
+
+# One counter per stripe plus a final global epoch for bulk invalidation
+item_versions = SharedCounters("item-versions", ITEM_CACHE_STRIPES + 1)
+EPOCH_INDEX = ITEM_CACHE_STRIPES
+
+
+def item_stripe(item_id):
+    return item_id % ITEM_CACHE_STRIPES
+
+
+class ItemCache:
+    def __init__(self, versions: SharedCounters):
+        self.versions = versions
+        # item id -> (server id, kind, value, stripe version, epoch, expiry)
+        self.entries = OrderedDict()
+        metrics.register_gauge("item_cache_size", lambda: len(self.entries))
+
+    # Taken before the database read that fills an entry, so a write racing with the read leaves it stale
+    def version_of(self, item_id):
+        return self.versions.get(item_stripe(item_id)), self.versions.get(EPOCH_INDEX)
+
+    def get(self, item_id, server_id):
+        entry = self.entries.get(item_id)
+        if entry is not None:
+            entry_server_id, kind, value, stripe_version, epoch, expiry = entry
+            if (entry_server_id == server_id and time.monotonic() < expiry
+                    and (stripe_version, epoch) == self.version_of(item_id)):
+                self.entries.move_to_end(item_id)
+                metrics.increment("item_cache_hits")
+                return kind, value
+            del self.entries[item_id]
+        metrics.increment("item_cache_misses")
+        return None
+
+    # kind is "item" (value is the serialized response body) or "owner" (value is the owning server id)
+    def put(self, item_id, server_id, kind, value, version):
+        stripe_version, epoch = version
+        self.entries[item_id] = (server_id, kind, value, stripe_version, epoch, time.monotonic() + ITEM_CACHE_TTL)
+        self.entries.move_to_end(item_id)
+        while len(self.entries) > ITEM_CACHE_SIZE:
+            self.entries.popitem(last=False)
+
+    # Called after the write is committed
+    def invalidate(self, ids):
+        ids = list(ids)
+        if len(ids) > ITEM_CACHE_BULK_INVALIDATION:
+            self.invalidate_all()
+        elif ids:
+            self.versions.bump_many(item_stripe(item_id) for item_id in ids)
+
+    def invalidate_all(self):
+        self.versions.bump(EPOCH_INDEX)
+
+
+item_cache = ItemCache(item_versions)
@@ -0,0 +1,57 @@
+import os
+import time
+import metrics
+from heartbeat import heartbeat_state, HEARTBEAT_INTERVAL
+from registry import retrieve_registry
+
+# Ownership leases between partners
+# A paired server may only sell its own inventory while it holds its ownership lease, which runs for
+# LEASE_DURATION from the moment the last heartbeat its partner acknowledged was sent, so every acknowledged
+# heartbeat renews it. The partner's copy of that lease runs for LEASE_DURATION from the heartbeat's arrival,
+# which is never earlier: once it has expired there, the server has already stopped writing and the partner
+# can take over its inventory without waiting on the orchestrator's database work (see worker.detect_failures).
+# Pairing and every takeover move the pair to a new authority epoch handed out by the orchestrator (registry
+# Authority_Epoch), heartbeats carry the sender's epoch and ones from an older epoch are refused, so a server
+# that was taken over can never renew its lease again
+
+LEASE_DURATION = float(os.environ.get("ANTIHERO_LEASE_MS", str(3 * HEARTBEAT_INTERVAL * 1000))) / 1000
+
+# Until a heartbeat arrives, the partner may still hold a lease granted before this process started
+LOADED_AT = time.time()
+
+
+def current_epoch():
+    return retrieve_registry("Authority_Epoch", 0) or 0
+
+
+# A request carrying an epoch older than this server's comes from a server that was taken over since
+def stale_epoch(epoch):
+    return epoch is not None and epoch < current_epoch()
+
+
+# Seconds left on this server's own lease
+def own_lease_remaining(now=None):
+    now = time.time() if now is None else now
+    renewed_at = heartbeat_state.last_acknowledged_at()
+    if not renewed_at:
+        return 0.0
+    return max(renewed_at + LEASE_DURATION - now, 0.0)
+
+
+# Seconds left on the partner's lease as seen from here, the partner can be taken over at 0
+def partner_lease_remaining(now=None):
+    now = time.time() if now is None else now
+    renewed_at = heartbeat_state.last_received_at() or LOADED_AT
+    return max(renewed_at + LEASE_DURATION - now, 0.0)
+
+
+# Whether this server may write the inventory it owns, a server without a partner (solo or in backup mode) always may
+def lease_held(now=None):
+    if not retrieve_registry("Partner_ID", None) or retrieve_registry("In_Backup", False):
+        return True
+    return own_lease_remaining(now) > 0
+
+
+metrics.register_gauge("ownership_lease_seconds", own_lease_remaining)
+metrics.register_gauge("partner_lease_seconds", partner_lease_remaining)
+metrics.register_gauge("authority_epoch", current_epoch)
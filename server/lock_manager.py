@@ -0,0 +1,135 @@
+import asyncio
+import itertools
+import os
+import struct
+import time
+import metrics
+from shared_state import SharedRegion
+
+# Striped per-seat locks shared by every API worker on this host
+# A seat id maps to a stripe of SEAT_LOCK_WAYS slots in shared memory, a lock takes one of them and records the seat id,
+# the owner token and a lease expiry, so seats sharing a stripe don't contend and a crashed holder only blocks its seats
+# until the lease runs out. Only when every slot of a stripe holds another live seat is a seat refused without being
+# held (counted in seat_lock_stripe_full). A batch is locked under one region lock and never waits while holding part
+# of it, which keeps it free of deadlocks whatever order callers list their ids in.
+# Reservations use try_lock and drop contended seats immediately, deactivation waits for in-flight reservations
+
+SEAT_LOCK_STRIPES = int(os.environ.get("ANTIHERO_SEAT_LOCK_STRIPES", "65536"))
+SEAT_LOCK_WAYS = int(os.environ.get("ANTIHERO_SEAT_LOCK_WAYS", "4"))
+SEAT_LOCK_LEASE_MS = int(os.environ.get("ANTIHERO_SEAT_LOCK_LEASE_MS", "10000"))
+
+# seat id, owner token (0 when free), lease expiry
+SLOT_FORMAT = "qQQ"
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class StripedLockManager:
+    def __init__(self, name, stripes, ways, lease_ms):
+        self.stripes = stripes
+        self.ways = ways
+        self.lease_ms = lease_ms
+        self.region = SharedRegion(name, stripes * ways * SLOT_SIZE)
+        # Tokens are unique per acquisition across processes: pid in the high bits, a local counter below
+        self.tokens = itertools.count(1)
+
+    def slots_of(self, id):
+        first = (id % self.stripes) * self.ways
+        return range(first, first + self.ways)
+
+    def new_token(self):
+        return (os.getpid() << 32) | next(self.tokens)
+
+    def read(self, slot):
+        return struct.unpack_from(SLOT_FORMAT, self.region.buffer, slot * SLOT_SIZE)
+
+    def write(self, slot, id, owner, expires_at):
+        struct.pack_into(SLOT_FORMAT, self.region.buffer, slot * SLOT_SIZE, id, owner, expires_at)
+
+    # Must be called with the region locked, the slot holding `id` or else a free one, None when the seat is held elsewhere
+    def find_slot(self, id, token, now):
+        free = None
+        for slot in self.slots_of(id):
+            slot_id, owner, expires_at = self.read(slot)
+            live = owner and expires_at > now
+            if owner and slot_id == id:
+                return None if live and owner != token else slot
+            if not live and free is None:
+                free = slot
+        if free is None:
+            metrics.increment("seat_lock_stripe_full")
+        return free
+
+    # Must be called with the region locked
+    def claim(self, id, token, now):
+        slot = self.find_slot(id, token, now)
+        if slot is None:
+            return False
+        _, owner, _ = self.read(slot)
+        if owner and owner != token:
+            metrics.increment("seat_lock_leases_expired")
+        self.write(slot, id, token, now + self.lease_ms)
+        return True
+
+    # Must be called with the region locked
+    def unclaim(self, id, token):
+        for slot in self.slots_of(id):
+            slot_id, owner, _ = self.read(slot)
+            if owner == token and slot_id == id:
+                self.write(slot, 0, 0, 0)
+
+    # Locks whichever of `ids` are free, returns (token, acquired ids), contended ids are left out
+    def try_lock(self, ids):
+        token = self.new_token()
+        now = now_ms()
+        with self.region.locked():
+            held = {id for id in sorted(set(ids)) if self.claim(id, token, now)}
+        acquired = [id for id in ids if id in held]
+        metrics.increment("seat_lock_acquired", len(acquired))
+        metrics.increment("seat_lock_contended", len(ids) - len(acquired))
+        return token, acquired
+
+    # All or nothing, returns the token or None if any seat is held elsewhere
+    def try_lock_all(self, ids):
+        token = self.new_token()
+        now = now_ms()
+        claimed = []
+        with self.region.locked():
+            for id in sorted(set(ids)):
+                if not self.claim(id, token, now):
+                    for claimed_id in claimed:
+                        self.unclaim(claimed_id, token)
+                    return None
+                claimed.append(id)
+        metrics.increment("seat_lock_acquired", len(ids))
+        return token
+
+    # Retries try_lock_all with backoff until `timeout` seconds have passed
+    async def lock_all(self, ids, timeout):
+        token = self.try_lock_all(ids)
+        if token is not None:
+            return token
+        started = time.monotonic()
+        backoff = 0.001
+        while token is None and time.monotonic() - started < timeout:
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 0.05)
+            token = self.try_lock_all(ids)
+        metrics.increment("seat_lock_waits")
+        metrics.increment("seat_lock_wait_seconds", time.monotonic() - started)
+        if token is None:
+            metrics.increment("seat_lock_wait_timeouts")
+        return token
+
+    def release(self, token, ids):
+        if token is None:
+            return
+        with self.region.locked():
+            for id in set(ids):
+                self.unclaim(id, token)
+
+
+seat_locks = StripedLockManager("seat-locks", SEAT_LOCK_STRIPES, SEAT_LOCK_WAYS, SEAT_LOCK_LEASE_MS)
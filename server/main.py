@@ -1,29 +1,81 @@
 from operator import or_
-from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks, status
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Annotated, Optional
+from typing import List, Annotated, Literal, Optional
 from datetime import datetime, timedelta
 import socket
-from database import db_session, engine
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from database import engine, get_session, AsyncSessionLocal
 import models
-import requests
+import migrations
 import time
 import socket
 import random
 import string
-from sqlalchemy import exc
+from sqlalchemy import exc, select, delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import Server, Inventory, Reservation, RegistryEntry
+from registry import store_registry_async, retrieve_registry, refresh_registry
+from partner_client import async_partner_client, address_book, refresh_server_addresses_async
+from statements import tentative_write_statement, prepare_rows, prepare_insert_statement, prepare_update_statement, apply_statement, discard_all_statement, upsert_statement, VERSIONED_STORAGE
+from group_commit import prepare_batcher_for
+from apply_queue import apply_queue_for, discard_queue_for, APPLY_FLUSH_INTERVAL
+from item_cache import item_cache
+from seat_allocator import seat_allocator
+from availability_index import availability_index
+from lock_manager import seat_locks
+from txlog import transaction_log
+from heartbeat import heartbeat_state
+from lease import lease_held, stale_epoch, current_epoch, own_lease_remaining
+from failure_detector import current_suspicion
+from worker import background_worker, WORKER_IN_API
+import metrics
+import wire
+from schemas import JSONResponseClass, dumps_json, InventoryItem, ServerInfo, INVENTORY_MAP_RESPONSES, NDJSON_MEDIA_TYPE
 
 class ForwardedRequest(BaseModel):
     request_time: datetime
     transaction_id: str | None = None
     inventory_ids: List[int]
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Before serving, nothing else runs on the loop yet (see migrations.upgrade)
+    migrations.upgrade(engine)
+    await refresh_registry()
+    async with AsyncSessionLocal() as session:
+        await availability_index.load(session, retrieve_registry("Server_ID"))
+    apply_queue_for(Inventory).start()
+    discard_queue_for(Inventory).start()
+    # Heartbeats and failure detection in this process's event loop (one API worker per host runs it, see worker)
+    if WORKER_IN_API:
+        background_worker.start()
+    yield
+    await background_worker.stop()
+    await apply_queue_for(Inventory).stop()
+    await discard_queue_for(Inventory).stop()
+    await async_partner_client.aclose()
+
+# Every handler runs on the event loop with an AsyncSession (see database.get_session)
+# refresh_registry runs first so registry reads inside handlers never block on the database
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponseClass, dependencies=[Depends(refresh_registry)])
+app.add_middleware(wire.AdvertiseFormats)
 models.Base.metadata.create_all(bind=engine)
 
 TRANSACT_ID_LENGTH = 10
+INVENTORY_PAGE_MAX = 5000
+INVENTORY_STREAM_BATCH = 1000
+INVENTORY_INGEST_CHUNK = 1000
+INVENTORY_SEARCH_DEFAULT = 20
+INVENTORY_SEARCH_MAX = 500
+SEAT_BLOCK_MAX = 20
+SEAT_ALLOCATION_ATTEMPTS = 3
+DEACTIVATION_LOCK_TIMEOUT = 2
+# Long enough for an apply or discard the primary queued just before its prepare to arrive (see write_to_backup)
+PREPARE_CONFLICT_WAIT = 2 * APPLY_FLUSH_INTERVAL
 
 def common_elements(list1, list2):
     set1 = set(list1)
@@ -56,85 +108,108 @@ def list_difference(list1, list2):
 
 # This function starts a new local commit for specified keys and returns references
 # to successfully acquired (locked) keys
-def start_local_commit(model, query_filter):
+async def start_local_commit(session, model, query_filter):
     new_objs = []
-    query = db_session.query(model).filter(query_filter).filter(model.activated == True)
+    query = select(model).filter(query_filter).filter(model.activated == True)
     # if query_filter:
         # query = query.filter(query_filter)
-    objs = query.all()
+    objs = (await session.execute(query)).scalars().all()
 
     for obj in objs:
         try:
             new_obj = model()
             obj.copy(new_obj)
-            db_session.add(new_obj)
-            db_session.commit()
+            session.add(new_obj)
+            await session.commit()
             new_objs.append(new_obj)
         except exc.IntegrityError:
-            db_session.rollback()
+            await session.rollback()
     return new_objs
 
-def read_all_primary(model, query_filters):
-    query = db_session.query(model).filter(model.activated == True, model.committed == True)
+async def read_all_primary(session, model, query_filters):
+    query = select(model).filter(model.activated == True, model.committed == True)
     for curr_filter in query_filters:
         query = query.filter(curr_filter)
     # if query_filter:
         # query = query.filter(query_filter)
-    objs = query.all()
+    objs = (await session.execute(query)).scalars().all()
     return objs
 
 
 # This function is similar to start_local_commit, immediately writes changes
 # to the proposed local commit, if keys are successfully (acquired)
-def write_to_primary(model, query_filters, values):
-    new_objs = []
-    query = db_session.query(model).filter(model.activated == True, model.committed == True)
-    for curr_filter in query_filters:
-        query = query.filter(curr_filter)
-    # if query_filter:
-        # query = query.filter(query_filter)
-    objs = query.all()
-
-    for obj in objs:
-        try:
-            new_obj = model()
-            obj.copy(new_obj)
-
-            for key in values:
-                setattr(new_obj, key, values[key])
-            # Setting last modified date for optimization of recovery process
-            setattr(new_obj, 'last_modified_date', datetime.utcnow())
-            db_session.add(new_obj)
-            db_session.commit()
-            new_objs.append(new_obj.as_dict())
-        except exc.IntegrityError:
-            db_session.rollback()
+# All tentative rows are created by one INSERT ... SELECT with a single commit,
+# keys already locked by another transaction are skipped
+# The prepare is in the transaction log (see txlog) before the rows commit
+async def write_to_primary(session, model, query_filters, values):
+    result = await session.execute(tentative_write_statement(model, query_filters, values))
+    new_objs = [model.row_as_dict(row) for row in result]
+    await transaction_log.prepare(new_objs)
+    try:
+        await session.commit()
+    except:
+        await transaction_log.aborted([obj['id'] for obj in new_objs])
+        raise
     return new_objs
 
 # This function is executed on the backup
 # Can take dictionary inputs from write_local_commit
-def write_to_backup(model, data):
+# The whole batch is inserted with one multi-row INSERT (versioned storage: one UPDATE of the committed rows) and one commit,
+# returns the ids that were accepted (not already locked on this node)
+# The primary only prepares a seat once its previous write on it is applied or dropped there, so a seat still
+# tentative here is waiting for an apply or discard that is on its way (another worker of the primary may be
+# sending it right now): those seats get one more try once it had time to arrive
+async def write_to_backup(session, model, data):
+    accepted_ids = await prepare_on_backup(session, model, data)
+    if len(accepted_ids) < len(data):
+        accepted_set = set(accepted_ids)
+        await asyncio.sleep(PREPARE_CONFLICT_WAIT)
+        metrics.increment("prepare_conflict_retries")
+        accepted_ids += await prepare_on_backup(session, model, [obj for obj in data if obj['id'] not in accepted_set])
+    return accepted_ids
+
+async def prepare_on_backup(session, model, data):
     # Data contains all of the objects in JSON format
-    new_objs = []
-    # if query_filter:
-        # query = query.filter(query_filter)
-
-    for obj in data:
-        try:
-            new_obj = model()
-
-            for key in obj:
-                setattr(new_obj, key, obj[key])
-            
-            db_session.add(new_obj)
-            db_session.commit()
-            new_objs.append(new_obj.as_dict())
-        except exc.IntegrityError:
-            db_session.rollback()
-    return new_objs
-
-def send_write_to_backup(model, data):
-    route_slug = f'/{model.__qualname__.lower()}/prepare'
+    if not data:
+        return []
+    if VERSIONED_STORAGE:
+        result = await session.execute(prepare_update_statement(model, prepare_rows(model, data)))
+    else:
+        result = await session.execute(prepare_insert_statement(model), prepare_rows(model, data))
+    accepted_ids = [row[0] for row in result]
+    accepted_set = set(accepted_ids)
+    await transaction_log.prepare([obj for obj in data if obj['id'] in accepted_set])
+    try:
+        await session.commit()
+    except:
+        await transaction_log.aborted(accepted_ids)
+        raise
+    return accepted_ids
+
+# Inserts the seats of `data` this node doesn't have yet, with a plain INSERT ... ON CONFLICT DO NOTHING in either
+# storage mode: ingested seats are committed rows, not tentative writes, so they never enter the transaction log
+async def insert_missing(session, model, data):
+    if not data:
+        return []
+    result = await session.execute(prepare_insert_statement(model), prepare_rows(model, data))
+    inserted_ids = [row[0] for row in result]
+    await session.commit()
+    return inserted_ids
+
+# Drops tentative rows that will not be applied, logs their abort (see txlog) and invalidates their cached copies
+async def discard_tentative(session, model, ids):
+    if not ids:
+        return
+    print("Deleting tentative commits: " + str(ids))
+    # Not limited to activated rows, the tentative rows prepared on a backup carry no activated flag
+    discarded = (await session.execute(discard_all_statement(model, (model.id.in_(ids),)))).scalars().all()
+    await session.commit()
+    await transaction_log.aborted(ids)
+    item_cache.invalidate(discarded)
+
+# Returns the rows of `data` the partner prepared too, the rest are discarded locally
+# (all of them when the partner can't be reached or answers with an error)
+async def send_write_to_backup(session, model, data):
     # Send data to specific route on backup (if not in backup mode)
     # server_id = retrieve_registry("Server_ID", -1)
     partner_id = retrieve_registry("Partner_ID", 0)
@@ -145,7 +220,7 @@ def send_write_to_backup(model, data):
 
     # Forward Request to Partner (if applicable)
     if not in_backup and partner_id:
-        # objs = db_session.query(model).filter(Inventory.location == server_id).all()
+        # objs = session.query(model).filter(Inventory.location == server_id).all()
         # for item in inventory:
         #     inventory_list.append(item.as_dict())
 
@@ -155,107 +230,68 @@ def send_write_to_backup(model, data):
 
         # Background Worker could be in charge of syncing/cleaning up dirty data... it could check DB periodically to see if a certain threshold of dirty data has been reached
         # Would need to capture dirtying/cleanup time (from orignating server, not the partner)...
-        partner = db_session.query(Server).filter(Server.id == partner_id).first()
-        curr_url = f'http://{partner.ip_address}:{partner.port}' + route_slug
-        request_body = {
-            "request_time": datetime.utcnow().isoformat(),
-            "model": Inventory.__qualname__,
-            "data": data
-        }
+        # Concurrent callers are grouped into one prepare request (see group_commit.PrepareBatcher)
+        # A timeout, a transport error or an error answer doesn't tell whether the partner committed the prepare
+        # before failing: the rows are dropped here and, through the discard queue, on the partner as well
+        # (discarding rows it never prepared changes nothing)
         try:
             print("Sending data to prepare route...")
-            response = requests.request("PUT", curr_url, headers={}, json = request_body, timeout=3)
-            if response.ok:
-                json_payload = response.json()
-                json_data = json_payload['data']
-                print("Parsing successful response...")
-                print(data)
-                requested_ids = [obj['id'] for obj in data]
-                print("Requested IDs: " + str(requested_ids))
-                print(json_data)
-                accepted_ids = [obj['id'] for obj in json_data]
-                print("Accepted IDs: " + str(accepted_ids))
-                # Removing tentative commits not accepted by backup
-                nonaccepted_ids = list_difference(requested_ids, accepted_ids)
-                print("Non-Accepted IDs: " + str(nonaccepted_ids))
-                db_session.query(model).filter(model.id.in_(nonaccepted_ids), model.committed == False, model.activated == True).delete(synchronize_session=False)
-                print("Deleting non-accepted ids...")
-                db_session.commit()
-                print("Committing changes")
-                return json_data
+            accepted_ids = await prepare_batcher_for(model).submit(data)
         except Exception as error:
             # rollback changes tenative changes
             print("An error occurred:", error)
             print("Exception occurred... deleting tentative commits")
-            uncomitted_ids = [obj['id'] for obj in data]
-            print("Uncommitted IDs: " + str(uncomitted_ids))
-            db_session.query(model).filter(model.id.in_(uncomitted_ids), model.committed == False, model.activated == True).delete(synchronize_session=False)
-            print("Deleting non-accepted ids...")
-            db_session.commit()
-            print("Committing changes")
+            await session.rollback()
+            await discard_tentative(session, model, [obj['id'] for obj in data])
+            discard_queue_for(model).enqueue([obj['id'] for obj in data])
             return []
+        if accepted_ids is None:
+            print("Prepare rejected by partner... deleting tentative commits")
+            await discard_tentative(session, model, [obj['id'] for obj in data])
+            discard_queue_for(model).enqueue([obj['id'] for obj in data])
+            return []
+        print("Parsing successful response...")
+        requested_ids = [obj['id'] for obj in data]
+        print("Requested IDs: " + str(requested_ids))
+        print("Accepted IDs: " + str(accepted_ids))
+        accepted_set = set(accepted_ids)
+        json_data = [obj for obj in data if obj['id'] in accepted_set]
+        # Removing tentative commits not accepted by backup
+        nonaccepted_ids = list_difference(requested_ids, accepted_ids)
+        print("Non-Accepted IDs: " + str(nonaccepted_ids))
+        await discard_tentative(session, model, nonaccepted_ids)
+        return json_data
     else:
         return data
 
-def apply_to_primary(model, query_filters):
-    # For all ids with tentatively committed entries, delete the already committed entries
-    # and set the tentative ones to committed
-    query = db_session.query(model.id).filter(model.activated == True, model.committed == False)
-    for curr_filter in query_filters:
-        query = query.filter(curr_filter)
-    uncommitted_objs = query.filter(model.committed == False).all()
-    uncomitted_ids = [obj[0] for obj in uncommitted_objs]
-
+# The lease may have run out while the partner was preparing, the partner can then already be taking this
+# inventory over: the prepared rows are dropped here and on the partner instead of being applied (see lease)
+async def lease_lost_before_apply(session, model, ids):
+    if lease_held():
+        return False
+    metrics.increment("lease_lost_before_apply")
+    await discard_tentative(session, model, ids)
+    discard_queue_for(model).enqueue(ids)
+    return True
+
+async def apply_to_primary(session, model, query_filters):
+    # For all ids with tentatively committed entries, replace the already committed entries
+    # with the tentative ones in a single atomic statement (see apply_statement)
     try:
-        db_session.query(model).filter(model.id.in_(uncomitted_ids), model.committed == True, model.activated == True).delete(synchronize_session=False)
-        db_session.query(model).filter(model.id.in_(uncomitted_ids), model.committed == False, model.activated == True).update({model.committed: True}, synchronize_session=False)
-        db_session.commit()
+        result = await session.execute(apply_statement(model, query_filters))
+        applied = result.all()
+        await session.commit()
+        await transaction_log.applied([row.id for row in applied])
+        item_cache.invalidate(row.id for row in applied)
+        availability_index.mark(applied)
         return True
     except exc.IntegrityError:
-        db_session.rollback()
+        await session.rollback()
     
     return False
 
-def apply_to_backup(model, ids):
-    return apply_to_primary(model, [Inventory.id.in_(ids)])
-
-def send_apply_to_backup(model, ids):
-    # Send apply/commit command to backup (if not in backup mode and has backup)
-    route_slug = f'/{model.__qualname__.lower()}/apply'
-    # Send data to specific route on backup (if not in backup mode)
-    # server_id = retrieve_registry("Server_ID", -1)
-    partner_id = retrieve_registry("Partner_ID", 0)
-    in_backup = retrieve_registry("In_Backup", False)
-    # dirty_ids = ids
-    # If stored on Orchestrator
-    # Create reservation on Orchestrator
-
-    # Forward Request to Partner (if applicable)
-    if not in_backup and partner_id:
-        # objs = db_session.query(model).filter(Inventory.location == server_id).all()
-        # for item in inventory:
-        #     inventory_list.append(item.as_dict())
-
-        # Send forwarded request to partner, if successful commit otherwise rollback
-        # Idea: Could send partner transaction ID and it could log that along with the dirty flag
-        # In the end, 
-
-        # Background Worker could be in charge of syncing/cleaning up dirty data... it could check DB periodically to see if a certain threshold of dirty data has been reached
-        # Would need to capture dirtying/cleanup time (from orignating server, not the partner)...
-        partner = db_session.query(Server).filter(Server.id == partner_id).first()
-        curr_url = f'http://{partner.ip_address}:{partner.port}' + route_slug
-        request_body = {
-            "request_time": datetime.utcnow().isoformat(),
-            "model": model.__qualname__,
-            "ids": ids
-        }
-        try:
-            response = requests.request("PUT", curr_url, headers={}, json = request_body, timeout=3)
-            if response.ok:
-                return True
-        except:
-            pass
-    return False
+async def apply_to_backup(session, model, ids):
+    return await apply_to_primary(session, model, [model.id.in_(ids)])
 
 def invalidate_local_commit():
     # Delete pending commits with specified id
@@ -270,256 +306,265 @@ def generate_random_string(length):
     return random_string
 
 
-def update_server_status(server_id):
-    server = db_session.query(Server).filter(Server.id == server_id).first()
-    if server:
-        url = f'http://{server.ip_address}:{server.port}/status'
-        response = requests.get(url)
-        if response.ok:
-            # If the response status code is 200 (OK), parse the response as JSON
-            json_data = response.json()
-            server.status = json_data['status']
-            server.last_updated = datetime.utcnow()
-
-def store_registry(key, value):
-    registry_entry = db_session.query(RegistryEntry).filter(RegistryEntry.registry_name == key).first()
-    if not registry_entry:
-        registry_entry = RegistryEntry(registry_name=key)
-        db_session.add(registry_entry)
-
-    if value is None:
-        registry_entry.int_value = None
-        registry_entry.string_value = None
-        registry_entry.bool_value = None
-        registry_entry.datetime_value = None
-    else:
-        if isinstance(value, bool):
-            registry_entry.bool_value = value
-        elif isinstance(value, (float, int)):
-            registry_entry.int_value = value
-        elif isinstance(value, str):
-            registry_entry.string_value = value
-        elif isinstance(value, datetime):
-            registry_entry.datetime_value = value
-
-    db_session.commit()
-    db_session.close()
-    return value
-
-def retrieve_registry(key, default=None):
-    registry_entry = db_session.query(RegistryEntry).filter(RegistryEntry.registry_name == key).first()
-    if registry_entry:
-        if registry_entry.int_value is not None:
-            default = registry_entry.int_value
-        
-        if registry_entry.string_value is not None:
-            default = registry_entry.string_value
-        
-        if registry_entry.bool_value is not None:
-            default = registry_entry.bool_value
-        
-        if registry_entry.datetime_value is not None:
-            default = registry_entry.datetime_value
-    
-    db_session.close() 
-    return default
+async def update_server_status(session, server_id):
+    response = await async_partner_client.request("GET", server_id, '/status')
+    if response is not None and response.is_success:
+        server = await session.get(Server, server_id)
+        # If the response status code is 200 (OK), parse the response as JSON
+        json_data = response.json()
+        server.status = json_data['status']
+        server.last_updated = datetime.utcnow()
 
 
-def update_server_map():
+def orchestrator_client():
     orc_ip = retrieve_registry("Orchestrator_IP")
     orc_port = retrieve_registry("Orchestrator_Port")
-    
-    url = f'http://{orc_ip}:{orc_port}/servers'
-    response = requests.request("GET", url)
-    if response.ok:
+    return async_partner_client.client_for(f'http://{orc_ip}:{orc_port}')
+
+
+async def update_server_map(session):
+    response = await orchestrator_client().request("GET", '/servers')
+    if response.is_success:
         # If the response status code is 200 (OK), parse the response as JSON
         json_data = response.json()
         for server_obj in json_data:
-            server = db_session.query(Server).filter(Server.id == server_obj["id"]).first()
+            server = await session.get(Server, server_obj["id"])
             if not server:
                 server = Server()
-                db_session.add(server)
+                session.add(server)
             server.id = server_obj["id"]
             server.hostname = server_obj["hostname"]
             server.port = server_obj["port"]
             server.description = server_obj["description"]
             server.partner_id = server_obj["partner_id"]
-            server.last_updated = server_obj["last_updated"]
+            server.last_updated = datetime.fromisoformat(server_obj["last_updated"]) if server_obj["last_updated"] else None
             server.status = server_obj["status"]
-            db_session.commit()
-            db_session.close()
+            server.epoch = server_obj.get("epoch")
+            await session.commit()
+        await refresh_server_addresses_async()
         return json_data
     else:
         return {}
 
 @app.put("/servers")
-async def update_all_servers(request: Request):
+async def update_all_servers(request: Request, session: AsyncSession = Depends(get_session)):
     json_data = await request.json()
     for server_obj in json_data:
-        server = db_session.query(Server).filter(Server.id == server_obj["id"]).first()
+        server = await session.get(Server, server_obj["id"])
         if not server:
             server = Server()
-            db_session.add(server)
+            session.add(server)
         server.id = server_obj["id"]
         server.ip_address = server_obj["ip_address"]
         server.hostname = server_obj["hostname"]
         server.port = server_obj["port"]
         server.description = server_obj["description"]
         server.partner_id = server_obj["partner_id"]
-        if server_obj["last_updated"] is not None:
-            server.last_updated = datetime.fromisoformat(server_obj["last_updated"])
+        server.last_updated = datetime.fromisoformat(server_obj["last_updated"]) if server_obj["last_updated"] else None
         server.status = server_obj["status"]
-        db_session.commit()
-    db_session.close()
+        server.epoch = server_obj.get("epoch")
+        await session.commit()
+    await refresh_server_addresses_async()
     return {"status": "Success"}
 
 @app.put("/heartbeat")
-def receive_heartbeat():
-    request_time = datetime.utcnow()
+async def receive_heartbeat(epoch: Optional[int] = None):
+    received_at = time.time()
+    request_time = datetime.utcfromtimestamp(received_at)
     status = retrieve_registry("Status")
     partner_id = retrieve_registry("Partner_ID", 0)
     if status == 'Disabled' or not partner_id:
         raise HTTPException(status_code=503, detail="Service unavailable")
-    store_registry("Last_Heartbeat", request_time)
+    # The sender was taken over since, its lease must not be renewed (see lease)
+    if stale_epoch(epoch):
+        raise HTTPException(status_code=409, detail="Stale authority epoch")
+    # Recorded in shared memory for worker.py, the registry only gets a periodic checkpoint (see heartbeat)
+    if heartbeat_state.received(received_at):
+        await store_registry_async("Last_Heartbeat", request_time)
     return {"status": "Success", "received": request_time}
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 @app.get("/status")
-def server_status():
-    return {"status": retrieve_registry("Status", None), "last_heartbeat": retrieve_registry("Last_Heartbeat", None)}
+async def server_status():
+    return {"status": retrieve_registry("Status", None), "last_heartbeat": heartbeat_state.last_received(), "suspicion": current_suspicion(),
+            "epoch": current_epoch(), "lease_remaining": own_lease_remaining()}
 
 @app.put("/disable")
-def server_disable():
-    store_registry("Status", "Disabled")
+async def server_disable():
+    await store_registry_async("Status", "Disabled")
     return {"status": "Disabled"}
 
 @app.put("/enable")
-def server_enable():
-    store_registry("Status", "Available")
+async def server_enable():
+    await store_registry_async("Status", "Available")
     return {"status": "Available"}
 
-@app.put("/partner")
-def pair_servers(partner_id: int):
-    update_server_map()
-    store_registry("Partner_ID", partner_id)
-    store_registry("Last_Heartbeat", None)
-    store_registry("Status", "Available")
-    store_registry("In_Backup", False)
+@app.put("/partner", response_model=Optional[ServerInfo])
+async def pair_servers(partner_id: int, epoch: Optional[int] = None, session: AsyncSession = Depends(get_session)):
+    await update_server_map(session)
+    if epoch is not None:
+        await store_registry_async("Authority_Epoch", epoch)
+    await store_registry_async("Partner_ID", partner_id)
+    heartbeat_state.clear()
+    await store_registry_async("Last_Heartbeat", None)
+    await store_registry_async("Status", "Available")
+    await store_registry_async("In_Backup", False)
 
-    partner = db_session.query(Server).filter(Server.id == partner_id).first()
-    return partner
+    partner = await session.get(Server, partner_id)
+    return partner.as_dict() if partner else None
 
 
 @app.put("/orchestrator")
-def update_orchestrator(ip_address: str, port: str):
-    store_registry("Orchestrator_IP", ip_address)
-    store_registry("Orchestrator_Port", port)
+async def update_orchestrator(ip_address: str, port: str):
+    await store_registry_async("Orchestrator_IP", ip_address)
+    await store_registry_async("Orchestrator_Port", port)
     return {"Status": "Updated"}
 
 @app.post("/orchestrator/register")
-def register_with_orchestrator(port: Optional[str] = "80"):
+async def register_with_orchestrator(port: Optional[str] = "80"):
     orc_ip = retrieve_registry("Orchestrator_IP")
-    orc_port = retrieve_registry("Orchestrator_Port")
     if not orc_ip:
         return {"Error": "Orchestrator location information not specified yet"}
 
     hostname = socket.gethostname()
-    url = f'http://{orc_ip}:{orc_port}/autoregister?hostname={hostname}&port={port}'
-    response = requests.request("POST", url, headers={}, params = {})
+    response = await orchestrator_client().request("POST", '/autoregister', params = {"hostname": hostname, "port": port})
 
-    if response.ok:
+    if response.is_success:
         # If the response status code is 200 (OK), parse the response as JSON
         json_data = response.json()
         print("Autoregister Data:")
         print(json_data)
-        store_registry("Server_ID", json_data['id'])
+        await store_registry_async("Server_ID", json_data['id'])
         return json_data
     else:
         return {}
 
 @app.put("/inventory/apply")
-async def apply_inventory_commits(request: Request):
+async def apply_inventory_commits(request: Request, session: AsyncSession = Depends(get_session)):
     # If not in backup mode, mark data as dirty and respond with success
     in_backup = retrieve_registry("In_Backup")
     status = retrieve_registry("Status")
     if status == "Disabled":
         raise HTTPException(status_code=503, detail="Service unavailable")
     
-    json_data = await request.json()
+    json_data = await wire.read_body(request)
     ids = json_data['ids']
     if not in_backup:
-        applied = apply_to_backup(Inventory, ids)
+        applied = await apply_to_backup(session, Inventory, ids)
         if applied:
             return {"Status": "Success", "Action": "Commits Applied"}
     # Otherwise, don't make any changes and respond with error
     bad_resp = {"Status": "Failed", "Reason": "Server In Backup Mode"}
     return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content=bad_resp)
 
+# Tentative rows the primary dropped after this node prepared them (see apply_queue.discard_queue_for)
+@app.put("/inventory/discard")
+async def discard_inventory_commits(request: Request, session: AsyncSession = Depends(get_session)):
+    in_backup = retrieve_registry("In_Backup")
+    status = retrieve_registry("Status")
+    if status == "Disabled":
+        raise HTTPException(status_code=503, detail="Service unavailable")
+
+    json_data = await wire.read_body(request)
+    if not in_backup:
+        await discard_tentative(session, Inventory, json_data['ids'])
+        return {"Status": "Success", "Action": "Commits Discarded"}
+    bad_resp = {"Status": "Failed", "Reason": "Server In Backup Mode"}
+    return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content=bad_resp)
+
 @app.put("/inventory/prepare")
-async def prepare_inventory_commits(request: Request):
+async def prepare_inventory_commits(request: Request, session: AsyncSession = Depends(get_session)):
     # If not in backup mode, mark data as dirty and respond with success
     in_backup = retrieve_registry("In_Backup")
     status = retrieve_registry("Status")
     if status == "Disabled":
         raise HTTPException(status_code=503, detail="Service unavailable")
-    json_data = await request.json()
+    json_data = await wire.read_body(request)
     if not in_backup:
+        # Discards and applies queued on the partner since its last request, handled first so their
+        # tentative rows don't block the incoming ones
+        discard_ids = json_data.get("discard_ids")
+        if discard_ids:
+            await discard_tentative(session, Inventory, discard_ids)
+        apply_ids = json_data.get("apply_ids")
+        if apply_ids:
+            await apply_to_backup(session, Inventory, apply_ids)
         data = json_data["data"]
-        data = write_to_backup(Inventory, data)
-        return {"Status": "Success", "Action": "Prepare Write", "data": data}
+        accepted_ids = await write_to_backup(session, Inventory, data)
+        return wire.respond(request, {"Status": "Success", "Action": "Prepare Write", "ids": accepted_ids})
     # Otherwise, don't make any changes and respond with error
     else:
         bad_resp = {"Status": "Failed", "Reason": "Server In Backup Mode"}
         return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content=bad_resp)
 
 @app.put("/inventory/update")
-async def update_all_inventory(request: Request):
-    json_data = await request.json()
-    print(json_data)
-    inv_ids = [obj['id'] for obj in json_data]
-    db_session.query(Inventory).filter(Inventory.id.in_(inv_ids), Inventory.committed == False).delete(synchronize_session=False)
-    db_session.commit()
-    for item in json_data:
-        inv_obj = db_session.query(Inventory).filter(Inventory.id == item['id'], Inventory.committed == True).first()
-        if not inv_obj:
-            inv_obj = Inventory()
-            db_session.add(inv_obj)
-        for key in item.keys():
-            setattr(inv_obj, key, item[key])
-        setattr(inv_obj, "last_modified_date", None)
-        # Do I need to commit here ?
-    db_session.commit() 
-    db_session.close()
-    print("Inventory updated/created!")
-    return {"Status": "Updated"} 
+async def update_all_inventory(request: Request, session: AsyncSession = Depends(get_session)):
+    started = time.perf_counter()
+    json_data = await wire.read_body(request)
+    # The whole chunk is written with one INSERT ... ON CONFLICT (id, committed) DO UPDATE,
+    # a later entry for the same id wins as it did when items were applied one by one
+    items = {obj['id']: obj for obj in json_data}
+    inv_ids = list(items)
+    columns = Inventory.__table__.columns
+    keys = {key for item in items.values() for key in item if key in columns} | {"committed", "last_modified_date"}
+    rows = prepare_rows(Inventory, items.values())
+    for row in rows:
+        row["committed"] = True
+        row["last_modified_date"] = None
+
+    discarded = await session.execute(discard_all_statement(Inventory, (Inventory.id.in_(inv_ids),)))
+    discarded_ids = discarded.scalars().all()
+    inserted = 0
+    if rows:
+        result = await session.execute(upsert_statement(Inventory, keys), rows)
+        inserted = sum(1 for row in result if row.inserted)
+    await session.commit()
+    await transaction_log.aborted(discarded_ids)
+    item_cache.invalidate(inv_ids)
+    availability_index.mark((row["id"], row["availability"]) for row in rows)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    metrics.increment("inventory_update_rows", len(rows))
+    print(f"Inventory updated/created: {len(rows)} rows ({inserted} inserted, {len(rows) - inserted} updated) in {elapsed_ms:.1f} ms")
+    return {"Status": "Updated", "rows": len(rows), "inserted": inserted, "updated": len(rows) - inserted, "elapsed_ms": round(elapsed_ms, 1)}
 
 @app.get("/orchestrator/inventory")
-def retrieve_orchestrator_inventory():
-    orc_ip = retrieve_registry("Orchestrator_IP")
-    orc_port = retrieve_registry("Orchestrator_Port")
-    
-    url = f'http://{orc_ip}:{orc_port}/inventory'
-    response = requests.request("GET", url)
-    if response.ok:
-        # If the response status code is 200 (OK), parse the response as JSON
-        json_data = response.json()
-        for item in json_data:
-            inv_obj = db_session.query(Inventory).filter(Inventory.id == item['id']).first()
-            if not inv_obj:
-                inv_obj = Inventory(**item)
-                db_session.add(inv_obj)
-                db_session.commit()
-                db_session.close()
-            
-        return json_data
-    else:
-        return {}
+async def retrieve_orchestrator_inventory(session: AsyncSession = Depends(get_session)):
+    # Streams the orchestrator's map as NDJSON and inserts missing seats a chunk at a time
+    # (one multi-row INSERT ... ON CONFLICT DO NOTHING per chunk, see insert_missing)
+    started = time.perf_counter()
+    received = 0
+    inserted = 0
+    async with orchestrator_client().stream("GET", '/inventory', params={"stream": "true"}) as response:
+        if not response.is_success:
+            return {}
+        chunk = []
+        async for line in response.aiter_lines():
+            if line:
+                chunk.append(json.loads(line))
+            if len(chunk) >= INVENTORY_INGEST_CHUNK:
+                inserted += len(await insert_missing(session, Inventory, chunk))
+                received += len(chunk)
+                chunk = []
+        if chunk:
+            inserted += len(await insert_missing(session, Inventory, chunk))
+            received += len(chunk)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"Orchestrator inventory retrieved: {received} rows ({inserted} inserted) in {elapsed_ms:.1f} ms")
+    return {"Status": "Retrieved", "rows": received, "inserted": inserted, "elapsed_ms": round(elapsed_ms, 1)}
 
 @app.get("/orchestrator/servers")
-def retrieve_orchestrator_servers():
-    return update_server_map()
+async def retrieve_orchestrator_servers(session: AsyncSession = Depends(get_session)):
+    return await update_server_map(session)
 
 @app.put("/inventory/deactivate")
-def deactivate_inventory(ids: List[int], send_data: bool = False, new_location: int = 0):
+async def deactivate_inventory(request: Request, send_data: bool = False, new_location: int = 0, session: AsyncSession = Depends(get_session)):
+    # Body is the list of ids, JSON or msgpack (see wire)
+    ids = await wire.read_body(request)
     return_dict = {"Status": "Deactivated"}
     # transaction_id = generate_random_string(TRANSACT_ID_LENGTH)
     server_id = retrieve_registry("Server_ID", None)
@@ -531,9 +576,17 @@ def deactivate_inventory(ids: List[int], send_data: bool = False, new_location:
     # In other words, the data must not have been touched by either OR it must have been synchronized after a write
     print("Attempting to deactivate...")
     print(ids)
-    db_session.query(Inventory).filter(Inventory.id.in_(ids), ((Inventory.location == 0) | (Inventory.location == server_id))).update({Inventory.location: new_location, Inventory.activated: False}, synchronize_session = False)
-    db_session.commit()
-    db_session.close()
+    # Lets reservations already holding these seats finish first (bounded, deactivation goes ahead after the timeout)
+    lock_token = await seat_locks.lock_all(ids, DEACTIVATION_LOCK_TIMEOUT)
+    try:
+        await session.execute(update(Inventory)
+                              .where(Inventory.id.in_(ids), ((Inventory.location == 0) | (Inventory.location == server_id)))
+                              .values({Inventory.location: new_location, Inventory.activated: False}))
+        await session.commit()
+    finally:
+        seat_locks.release(lock_token, ids)
+    item_cache.invalidate(ids)
+    availability_index.forget(ids)
 
     
 
@@ -541,20 +594,20 @@ def deactivate_inventory(ids: List[int], send_data: bool = False, new_location:
     # Is it necessary to do last_modified_by? What if server crashes? Should this request be idempotent?
     # ! I think last_modified_by should be removed in this instance... only should be used by the Buy function
     if send_data:
-        apply_to_primary(Inventory, [Inventory.id.in_(ids)])
-        deactivated_inventory = db_session.query(Inventory).filter(Inventory.location == new_location,
-                                       Inventory.id.in_(ids)).all()
-        return_dict["deactivated_inventory"] = deactivated_inventory
+        await apply_to_primary(session, Inventory, [Inventory.id.in_(ids)])
+        deactivated_inventory = (await session.execute(select(Inventory).filter(Inventory.location == new_location,
+                                       Inventory.id.in_(ids)))).scalars().all()
+        return_dict["deactivated_inventory"] = [obj.as_dict() for obj in deactivated_inventory]
     else:
         # Send only the IDs (will this be too big?)
-        last_heartbeat = retrieve_registry("Last_Heartbeat", datetime.utcnow())
-        deactivated_inventory = db_session.query(Inventory.id).filter(Inventory.location == new_location,
-                                       Inventory.id.in_(ids)).all()
+        last_heartbeat = heartbeat_state.last_received() or datetime.utcnow()
+        deactivated_inventory = (await session.execute(select(Inventory.id).filter(Inventory.location == new_location,
+                                       Inventory.id.in_(ids)))).all()
         
         # return list of inventory ids that haven't been changed since the last heartbeat was received
-        unchanged_deactivated_data = db_session.query(Inventory.id).filter(Inventory.location == new_location, 
+        unchanged_deactivated_data = (await session.execute(select(Inventory.id).filter(Inventory.location == new_location, 
                                                                            Inventory.id.in_(ids),
-                                                                          ((Inventory.last_modified_date < last_heartbeat) | (Inventory.last_modified_date == None))).all()
+                                                                          ((Inventory.last_modified_date < last_heartbeat) | (Inventory.last_modified_date == None))))).all()
         deactivated_inventory = [record[0] for record in deactivated_inventory]
         unchanged_deactivated_data = [record[0] for record in unchanged_deactivated_data]
         return_dict["deactivated_inventory"] = deactivated_inventory
@@ -572,18 +625,24 @@ def deactivate_inventory(ids: List[int], send_data: bool = False, new_location:
 
     # result_query = db_session.query(Inventory.id).filter(Inventory.location == 0, Inventory.id.in_(ids)).all()
     # reserved_ids = [r[0] for r in result_query]
-    return return_dict
+    return wire.respond(request, return_dict)
 
 @app.put("/inventory/activate")
-async def activate_inventory(request: Request, new_location: int = None):
-    json_data = await request.json()
-    db_session.query(Inventory).filter(Inventory.id.in_(json_data), Inventory.committed == False).delete(synchronize_session=False)
+async def activate_inventory(request: Request, new_location: int = None, session: AsyncSession = Depends(get_session)):
+    json_data = await wire.read_body(request)
+    discarded = await session.execute(discard_all_statement(Inventory, (Inventory.id.in_(json_data),)))
+    discarded_ids = discarded.scalars().all()
     if new_location:
-        db_session.query(Inventory).filter(Inventory.id.in_(json_data), Inventory.committed == True).update({Inventory.activated: True, Inventory.location: new_location}, synchronize_session=False)
+        result = await session.execute(update(Inventory).where(Inventory.id.in_(json_data), Inventory.committed == True).values({Inventory.activated: True, Inventory.location: new_location})
+                                       .returning(Inventory.id, Inventory.availability))
     else:
-        db_session.query(Inventory).filter(Inventory.id.in_(json_data), Inventory.committed == True).update({Inventory.activated: True}, synchronize_session=False)
-    db_session.commit()
-    db_session.close()
+        result = await session.execute(update(Inventory).where(Inventory.id.in_(json_data), Inventory.committed == True).values({Inventory.activated: True})
+                                       .returning(Inventory.id, Inventory.availability))
+    activated = result.all()
+    await session.commit()
+    await transaction_log.aborted(discarded_ids)
+    item_cache.invalidate(json_data)
+    availability_index.mark(activated)
     return {"Status": "Activated"}
 
 
@@ -612,10 +671,12 @@ async def activate_inventory(request: Request, new_location: int = None):
     # db_session.close()
 
 @app.post("/inventory/buy/reserve")
-def buy_inventory(ids: List[int], background_tasks: BackgroundTasks):
+async def buy_inventory(ids: List[int], session: AsyncSession = Depends(get_session)):
     status_reg = retrieve_registry("Status")
     if status_reg == "Disabled":
         raise HTTPException(status_code=503, detail="Service unavailable")
+    if not lease_held():
+        raise HTTPException(status_code=503, detail="Ownership lease expired")
     request_time = datetime.utcnow()
     transaction_id = generate_random_string(TRANSACT_ID_LENGTH)
     reserved_ids = []
@@ -625,47 +686,141 @@ def buy_inventory(ids: List[int], background_tasks: BackgroundTasks):
     # If stored on Orchestrator
     # Create reservation on Orchestrator
 
-    # Forward Request to Partner (if applicable)
-    if not in_backup and partner_id:
-        tentative_data = write_to_primary(Inventory, (Inventory.id.in_(ids), Inventory.availability == 'Available', Inventory.location == server_id), { 'transaction_id': transaction_id, 'availability': 'Reserved' })
-        sent_data = send_write_to_backup(Inventory, tentative_data)
-        if not sent_data:
-            bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
-            return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
+    # Seats already known to be taken are turned away before any transaction is opened
+    ids = availability_index.candidates(ids)
+    if not ids:
+        metrics.increment("availability_rejections")
+        bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Requested seats are unavailable"}
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content=bad_resp)
+
+    # Seats another request is reserving right now are dropped here instead of contending in the database
+    lock_token, ids = seat_locks.try_lock(ids)
+    if not ids:
+        bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Requested seats are being reserved by another request"}
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content=bad_resp)
+
+    try:
+        # Forward Request to Partner (if applicable)
+        if not in_backup and partner_id:
+            tentative_data = await write_to_primary(session, Inventory, (Inventory.id.in_(ids), Inventory.availability == 'Available', Inventory.location == server_id), { 'transaction_id': transaction_id, 'availability': 'Reserved' })
+            sent_data = await send_write_to_backup(session, Inventory, tentative_data)
+            if not sent_data:
+                bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
+                return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
         
-        uncomitted_ids = [obj['id'] for obj in sent_data]
-        commits_applied = apply_to_primary(Inventory, (Inventory.id.in_(uncomitted_ids),))
-        if not commits_applied:
-            bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
-            return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
+            uncomitted_ids = [obj['id'] for obj in sent_data]
+            if await lease_lost_before_apply(session, Inventory, uncomitted_ids):
+                bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Ownership lease expired"}
+                return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=bad_resp)
+            commits_applied = await apply_to_primary(session, Inventory, (Inventory.id.in_(uncomitted_ids),))
+            if not commits_applied:
+                bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
+                return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
 
-        background_tasks.add_task(send_apply_to_backup, Inventory, uncomitted_ids)
+            # Applied on the partner by the next prepare batch or periodic apply flush (see apply_queue)
+            apply_queue_for(Inventory).enqueue(uncomitted_ids)
     
-    else:
-        try:
-            tentative_data = write_to_primary(Inventory, (Inventory.id.in_(ids), Inventory.availability == 'Available', Inventory.location == server_id), { 'transaction_id': transaction_id, 'availability': 'Reserved', 'solo_mode': True })
-            uncomitted_ids = [obj['id'] for obj in tentative_data]
-            commits_applied = apply_to_primary(Inventory, (Inventory.id.in_(uncomitted_ids),))
-            if not commits_applied:
+        else:
+            try:
+                tentative_data = await write_to_primary(session, Inventory, (Inventory.id.in_(ids), Inventory.availability == 'Available', Inventory.location == server_id), { 'transaction_id': transaction_id, 'availability': 'Reserved', 'solo_mode': True })
+                uncomitted_ids = [obj['id'] for obj in tentative_data]
+                commits_applied = await apply_to_primary(session, Inventory, (Inventory.id.in_(uncomitted_ids),))
+                if not commits_applied:
+                    bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to commit to local server"}
+                    return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
+            except:
                 bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to commit to local server"}
                 return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
-        except:
-            bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to commit to local server"}
-            return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
 
-    # Might need some type of pausing feature to allow cleanup/synchronization
-    # Might want to re-design client/add new experiment where initial transaction ID is return immediately
-    # Client then opens new request where they check on the status of their transaction for (10 seconds max)... once they get a successful message back, record request as successful
+        # Might need some type of pausing feature to allow cleanup/synchronization
+        # Might want to re-design client/add new experiment where initial transaction ID is return immediately
+        # Client then opens new request where they check on the status of their transaction for (10 seconds max)... once they get a successful message back, record request as successful
     
-    db_session.commit()
-    db_session.close()
-    return {"Status": "Success: Awaiting Payment Details", "transaction_id": transaction_id, "reserved_ids": uncomitted_ids}
+        return {"Status": "Success: Awaiting Payment Details", "transaction_id": transaction_id, "reserved_ids": uncomitted_ids}
+    finally:
+        seat_locks.release(lock_token, ids)
+
+# Reserves the best block of `quantity` adjacent seats in one row (see seat_allocator), all or nothing
+@app.post("/inventory/buy/block")
+async def buy_seat_block(quantity: int, section: Optional[str] = None, max_price: Optional[int] = None, session: AsyncSession = Depends(get_session)):
+    status_reg = retrieve_registry("Status")
+    if status_reg == "Disabled":
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    if not lease_held():
+        raise HTTPException(status_code=503, detail="Ownership lease expired")
+    if quantity < 1 or quantity > SEAT_BLOCK_MAX:
+        raise HTTPException(status_code=400, detail=f"quantity must be between 1 and {SEAT_BLOCK_MAX}")
+    transaction_id = generate_random_string(TRANSACT_ID_LENGTH)
+    server_id = retrieve_registry("Server_ID", -1)
+    partner_id = retrieve_registry("Partner_ID", 0)
+    in_backup = retrieve_registry("In_Backup", False)
+    values = {'transaction_id': transaction_id, 'availability': 'Reserved'}
+
+    lock_token = None
+    locked_ids = []
+    try:
+        for _ in range(SEAT_ALLOCATION_ATTEMPTS):
+            block = await seat_allocator.best_block(session, server_id, section, quantity, max_price)
+            if block is None:
+                break
+            seat_allocator.claim(block)
+            # Another request (in any worker) is reserving one of these seats, move on to the next best block
+            lock_token = seat_locks.try_lock_all(block["ids"])
+            if lock_token is None:
+                block = None
+                continue
+            locked_ids = block["ids"]
+            tentative_data = await write_to_primary(session, Inventory, (Inventory.id.in_(block["ids"]), Inventory.availability == 'Available', Inventory.location == server_id), values)
+            if len(tentative_data) == quantity:
+                break
+            # Part of the block was taken since the map was loaded, release the rest and try the next best block
+            await discard_tentative(session, Inventory, [obj['id'] for obj in tentative_data])
+            seat_allocator.invalidate(block)
+            seat_locks.release(lock_token, locked_ids)
+            lock_token = None
+            block = None
+        if block is None:
+            bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": f"No block of {quantity} adjacent seats available"}
+            return JSONResponse(status_code=status.HTTP_409_CONFLICT, content=bad_resp)
+
+        if not in_backup and partner_id:
+            sent_data = await send_write_to_backup(session, Inventory, tentative_data)
+            if len(sent_data) < quantity:
+                # All or nothing: the seats the partner did prepare are released here and, through the
+                # discard queue, on the partner (the rest were already discarded by send_write_to_backup)
+                sent_ids = [obj['id'] for obj in sent_data]
+                await discard_tentative(session, Inventory, sent_ids)
+                discard_queue_for(Inventory).enqueue(sent_ids)
+                seat_allocator.invalidate(block)
+                bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
+                return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
+            if await lease_lost_before_apply(session, Inventory, block["ids"]):
+                seat_allocator.invalidate(block)
+                bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Ownership lease expired"}
+                return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=bad_resp)
 
-@app.post("/inventory/buy/payment")
-async def submit_payment_details(request: Request, background_tasks: BackgroundTasks):
+        commits_applied = await apply_to_primary(session, Inventory, (Inventory.id.in_(block["ids"]),))
+        if not commits_applied:
+            seat_allocator.invalidate(block)
+            bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to commit to local server"}
+            return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
+        if not in_backup and partner_id:
+            # Applied on the partner by the next prepare batch or periodic apply flush (see apply_queue)
+            apply_queue_for(Inventory).enqueue(block["ids"])
+        metrics.increment("seat_blocks_reserved")
+
+        return {"Status": "Success: Awaiting Payment Details", "transaction_id": transaction_id, "reserved_ids": block["ids"],
+                "section": block["section"], "row": block["row"], "seats": block["seats"]}
+    finally:
+        seat_locks.release(lock_token, locked_ids)
+
+@app.post("/inventory/buy/payment", response_model=List[InventoryItem])
+async def submit_payment_details(request: Request, session: AsyncSession = Depends(get_session)):
     status_reg = retrieve_registry("Status")
     if status_reg == "Disabled":
         raise HTTPException(status_code=503, detail="Service unavailable")
+    if not lease_held():
+        raise HTTPException(status_code=503, detail="Ownership lease expired")
     
     server_id = retrieve_registry("Server_ID", -1)
     partner_id = retrieve_registry("Partner_ID", 0)
@@ -678,24 +833,28 @@ async def submit_payment_details(request: Request, background_tasks: BackgroundT
         raise HTTPException(status_code=400, detail="Missing payment details or transaction ID")
 
     if not in_backup and partner_id:
-        tentative_data = write_to_primary(Inventory, (Inventory.availability == "Reserved", Inventory.transaction_id == transaction_id, Inventory.location == server_id), {"availability": "Purchased"})
-        sent_data = send_write_to_backup(Inventory, tentative_data)
+        tentative_data = await write_to_primary(session, Inventory, (Inventory.availability == "Reserved", Inventory.transaction_id == transaction_id, Inventory.location == server_id), {"availability": "Purchased"})
+        sent_data = await send_write_to_backup(session, Inventory, tentative_data)
         if not sent_data:
             bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
             return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
         
         uncomitted_ids = [obj['id'] for obj in sent_data]
-        commits_applied = apply_to_primary(Inventory, (Inventory.id.in_(uncomitted_ids),))
+        if await lease_lost_before_apply(session, Inventory, uncomitted_ids):
+            bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Ownership lease expired"}
+            return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=bad_resp)
+        commits_applied = await apply_to_primary(session, Inventory, (Inventory.id.in_(uncomitted_ids),))
         if not commits_applied:
             bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to reach agreement with partner"}
             return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
         
-        background_tasks.add_task(send_apply_to_backup, Inventory, uncomitted_ids)
+        # Applied on the partner by the next prepare batch or periodic apply flush (see apply_queue)
+        apply_queue_for(Inventory).enqueue(uncomitted_ids)
     else:
         try:
-            tentative_data = write_to_primary(Inventory, (Inventory.availability == "Reserved", Inventory.transaction_id == transaction_id), {"availability": "Purchased"})
+            tentative_data = await write_to_primary(session, Inventory, (Inventory.availability == "Reserved", Inventory.transaction_id == transaction_id), {"availability": "Purchased"})
             uncomitted_ids = [obj['id'] for obj in tentative_data]
-            commits_applied = apply_to_primary(Inventory, (Inventory.id.in_(uncomitted_ids),))
+            commits_applied = await apply_to_primary(session, Inventory, (Inventory.id.in_(uncomitted_ids),))
             if not commits_applied:
                 bad_resp = {"Status": "Failed", "Transaction_ID": transaction_id, "Reason": "Unable to commit to local server"}
                 return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
@@ -704,70 +863,157 @@ async def submit_payment_details(request: Request, background_tasks: BackgroundT
             return JSONResponse(status_code=status.HTTP_502_BAD_GATEWAY, content=bad_resp)
 
     # db_session.query(Inventory).filter(Inventory.transaction_id == transaction_id,).all()
-    purchased_tickets = read_all_primary(Inventory, (Inventory.transaction_id == transaction_id,))
-    return purchased_tickets
+    purchased_tickets = await read_all_primary(session, Inventory, (Inventory.transaction_id == transaction_id,))
+    return [ticket.as_dict() for ticket in purchased_tickets]
 
-@app.get("/servers")
-def get_servers():
-    servers = db_session.query(Server).all()
-    return servers
+@app.get("/servers", response_model=List[ServerInfo])
+async def get_servers(session: AsyncSession = Depends(get_session)):
+    servers = (await session.execute(select(Server))).scalars().all()
+    return [server.as_dict() for server in servers]
 
 @app.post("/servers")
-def create_server(host_ip: str, request: Request, hostname: Optional[str] = None, port: Optional[str] = "80"):
+async def create_server(host_ip: str, request: Request, hostname: Optional[str] = None, port: Optional[str] = "80", session: AsyncSession = Depends(get_session)):
     server = Server(hostname=hostname, host_ip=host_ip, port=port)
-    db_session.add(server)
-    db_session.commit()
+    session.add(server)
+    await session.commit()
     return {"host_ip": host_ip, "hostname": hostname, "server_id": server.id}
 
-@app.get("/server/{server_id}")
-def get_server_status(server_id: int):
-    update_server_status(server_id)
-    server = db_session.query(Server).filter(Server.id == server_id).first()
+@app.get("/server/{server_id}", response_model=Optional[ServerInfo])
+async def get_server_status(server_id: int, session: AsyncSession = Depends(get_session)):
+    await update_server_status(session, server_id)
+    server = await session.get(Server, server_id)
     if server:
-        return server
+        return server.as_dict()
     else:
         return None
 
-@app.get("/inventory")
-def get_inventory_map():
-    db_session.commit()
+def inventory_map_statement(after_id, location, section, availability):
+    # Keyset order, a seat's committed and tentative rows sort next to each other
+    statement = select(Inventory.__table__).order_by(Inventory.id, Inventory.committed)
+    if after_id is not None:
+        statement = statement.where(Inventory.id > after_id)
+    if location is not None:
+        statement = statement.where(Inventory.location == location)
+    if section is not None:
+        statement = statement.where(Inventory.section == section)
+    if availability is not None:
+        statement = statement.where(Inventory.availability == availability)
+    return statement
+
+async def stream_inventory_rows(statement, ndjson):
+    # Uses its own session, the request's session is closed before a streaming body is sent
+    async with AsyncSessionLocal() as session:
+        # Server-side cursor, only one batch of rows is held in memory at a time
+        result = await session.stream(statement.execution_options(yield_per=INVENTORY_STREAM_BATCH))
+        separator = b"\n" if ndjson else b","
+        first = True
+        if not ndjson:
+            yield b"["
+        async for partition in result.partitions():
+            chunk = separator.join(dumps_json(Inventory.row_as_dict(row)) for row in partition)
+            if ndjson:
+                yield chunk + b"\n"
+            else:
+                yield chunk if first else b"," + chunk
+            first = False
+        if not ndjson:
+            yield b"]"
+
+# Without limit/stream the whole map is returned as one JSON array (streamed from the cursor),
+# ?limit=N returns one keyset page with the after_id of the next one, ?stream=true returns NDJSON
+# Rows are encoded directly (no per-row validation), INVENTORY_MAP_RESPONSES documents the three shapes
+@app.get("/inventory", response_model=None, responses=INVENTORY_MAP_RESPONSES)
+async def get_inventory_map(request: Request, after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), stream: bool = False,
+                            location: Optional[int] = None, section: Optional[str] = None, availability: Optional[str] = None,
+                            session: AsyncSession = Depends(get_session)):
+    status = retrieve_registry("Status")
+    if status == 'Disabled':
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    statement = inventory_map_statement(after_id, location, section, availability)
+    if limit is not None:
+        limit = min(limit, INVENTORY_PAGE_MAX)
+        rows = (await session.execute(statement.limit(limit + 1))).all()
+        next_after_id = None
+        if len(rows) > limit:
+            # Never end a page between the committed and tentative rows of one seat
+            if rows[limit].id != rows[limit - 1].id:
+                rows = rows[:limit]
+            next_after_id = rows[-1].id
+        return JSONResponseClass({"items": [Inventory.row_as_dict(row) for row in rows], "next_after_id": next_after_id})
+
+    ndjson = stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    media_type = NDJSON_MEDIA_TYPE if ndjson else "application/json"
+    return StreamingResponse(stream_inventory_rows(statement, ndjson), media_type=media_type)
+
+# Top N sellable seats owned by this server, best desirability (or lowest price) first
+# e.g. /inventory/search?max_price=300&limit=4 for the best 4 available seats under $300
+@app.get("/inventory/search", response_model=List[InventoryItem])
+async def search_inventory(section: Optional[str] = None, min_price: Optional[int] = None, max_price: Optional[int] = None,
+                           min_desirability: Optional[int] = None, availability: str = "Available",
+                           sort: Literal["desirability", "price"] = "desirability", limit: int = INVENTORY_SEARCH_DEFAULT,
+                           session: AsyncSession = Depends(get_session)):
     server_id = retrieve_registry("Server_ID")
     status = retrieve_registry("Status")
     if status == 'Disabled':
         raise HTTPException(status_code=503, detail="Service unavailable")
-    inventory = db_session.query(Inventory).all()
-    return inventory
+    # Same leading columns and predicate as the ix_inventory_search_* indexes
+    statement = select(Inventory.__table__).where(Inventory.location == server_id, Inventory.availability == availability,
+                                                  Inventory.committed == True, Inventory.activated == True)
+    if section is not None:
+        statement = statement.where(Inventory.section == section)
+    if min_price is not None:
+        statement = statement.where(Inventory.price >= min_price)
+    if max_price is not None:
+        statement = statement.where(Inventory.price <= max_price)
+    if min_desirability is not None:
+        statement = statement.where(Inventory.desirability >= min_desirability)
+    limit = max(1, min(limit, INVENTORY_SEARCH_MAX))
+    rows = (await session.execute(statement.order_by(*Inventory.search_order(sort)).limit(limit))).all()
+    return [Inventory.row_as_dict(row) for row in rows]
 
 @app.get("/latency/{nil}")
-def latency_test(nil: Optional[str]):
+async def latency_test(nil: Optional[str]):
     return {"row":"1","section":"101","seat":"1","location":1,"availability":"Available","transaction_id":None,"is_dirty":False,"desirability":8,"id":1,"price":457,"description":None,"on_backup":False}
 
-@app.get("/inventory/{item_id}")
-def get_item_status(item_id: int):
-    db_session.commit()
+@app.get("/inventory/{item_id}", response_model=InventoryItem)
+async def get_item_status(item_id: int, session: AsyncSession = Depends(get_session)):
     # Check if server is disabled
     server_id = retrieve_registry("Server_ID")
     status = retrieve_registry("Status")
     if status == 'Disabled':
         raise HTTPException(status_code=503, detail="Service unavailable")
-    inventory = db_session.query(Inventory).filter(Inventory.id == item_id, 
-                                                   Inventory.location == server_id,
-                                                   Inventory.activated == True).first()
-    dirty_inventory = db_session.query(Inventory).filter(Inventory.id == item_id, Inventory.location != server_id).first()
-    if dirty_inventory:
-        ext_server = db_session.query(Server).filter(Server.id == dirty_inventory.location).first()
-        if not ext_server:
+    cached = item_cache.get(item_id, server_id)
+    if cached is None:
+        version = item_cache.version_of(item_id)
+        # Owned (activated) rows and rows held by another server in one query, committed rows only: a tentative
+        # shadow row may still be discarded and must never end up in the cache
+        rows = (await session.execute(select(Inventory).filter(Inventory.id == item_id, Inventory.committed == True,
+                                                               ((Inventory.location == server_id) & (Inventory.activated == True))
+                                                               | (Inventory.location != server_id)))).scalars().all()
+        dirty_inventory = next((row for row in rows if row.location != server_id), None)
+        inventory = next((row for row in rows if row.location == server_id), None)
+        if dirty_inventory:
+            cached = ("owner", dirty_inventory.location)
+        elif inventory:
+            # Encoded through the response model, the cached body is sent as is and must not carry storage columns (version, pending)
+            cached = ("item", InventoryItem.model_validate(inventory.as_dict()).model_dump_json().encode())
+        if cached:
+            item_cache.put(item_id, server_id, *cached, version)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    kind, value = cached
+    if kind == "owner":
+        ext_server_url = await address_book.base_url_async(value)
+        if not ext_server_url:
             raise HTTPException(status_code=404, detail="Item not found")
-        url_slug = f'http://{ext_server.ip_address}:{ext_server.port}/inventory/{item_id}'
+        url_slug = f'{ext_server_url}/inventory/{item_id}'
         response = RedirectResponse(url=url_slug)
         return response
-    if not inventory:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return inventory
+    return Response(content=value, media_type="application/json")
 
 
 @app.put("/reset")
-def reset():
+async def reset(session: AsyncSession = Depends(get_session)):
     default_dict = {
         Inventory.availability: "Available",
         Inventory.location: 0,
@@ -775,9 +1021,12 @@ def reset():
         Inventory.transaction_id: None
     }
 
-    store_registry("Last_Heartbeat", None)
-    store_registry("In_Backup", False)
-    store_registry("Partner_ID", None)
-    db_session.query(Inventory).delete(synchronize_session=False)
-    db_session.commit()
-    db_session.close()
\ No newline at end of file
+    heartbeat_state.clear()
+    await store_registry_async("Last_Heartbeat", None)
+    await store_registry_async("In_Backup", False)
+    await store_registry_async("Partner_ID", None)
+    await session.execute(delete(Inventory))
+    await session.commit()
+    await asyncio.to_thread(transaction_log.reset)
+    item_cache.invalidate_all()
+    availability_index.forget_all()
@@ -0,0 +1,24 @@
+from typing import Callable, Dict, Union
+
+# In-process metrics for this API worker, served by GET /metrics
+# Counters are bumped inline, gauges are callables sampled when the endpoint is read
+
+MetricValue = Union[int, float]
+
+counters: Dict[str, MetricValue] = {}
+gauges: Dict[str, Callable[[], MetricValue]] = {}
+
+
+def increment(name: str, amount: MetricValue = 1):
+    counters[name] = counters.get(name, 0) + amount
+
+
+def register_gauge(name: str, read: Callable[[], MetricValue]):
+    gauges[name] = read
+
+
+def snapshot() -> Dict[str, MetricValue]:
+    values = dict(counters)
+    for name, read in gauges.items():
+        values[name] = read()
+    return values
@@ -0,0 +1,181 @@
+import argparse
+import re
+import sys
+import time
+from sqlalchemy import exc, inspect, select, text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from database import Base, engine
+from models import Inventory
+from statements import tentative_write_statement, apply_statement, discard_all_statement, VERSIONED_STORAGE
+
+# Schema upgrades for databases created by an earlier version
+# create_all only creates missing tables, so columns and indexes added to a model later are created here
+#
+#   python migrations.py                    create any missing indexes
+#   python migrations.py --check-plans      also verify the hot queries use them (against 1M synthetic seats)
+
+
+# One process upgrades at a time, the others poll for the lock instead of waiting inside pg_advisory_lock:
+# CREATE INDEX CONCURRENTLY waits for every open transaction, a session blocked on the lock included
+MIGRATION_LOCK_KEY = 7345001
+MIGRATION_LOCK_POLL = 0.5
+# Versioned storage rewrites rows in place, free space on each page lets prepare/discard stay HOT updates
+VERSIONED_FILLFACTOR = 90
+
+
+# name -> whether the index is valid, a CREATE INDEX CONCURRENTLY that failed leaves an invalid one behind
+def existing_indexes(conn, table_name):
+    rows = conn.execute(text('''
+        SELECT c.relname, i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = to_regclass(:table_name)
+    '''), {"table_name": table_name})
+    return dict(rows.all())
+
+
+# CreateIndex only renders CONCURRENTLY from the index's own dialect options, which create_all must not see
+def create_index_concurrently(conn, index):
+    ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(re.sub(r"^CREATE (UNIQUE )?INDEX", r"CREATE \1INDEX CONCURRENTLY", ddl))
+
+
+# Runs once per deployment in effect: every process calls it when it starts (see the API lifespan), the first to
+# get the advisory lock creates what is missing and the ones after it find nothing left to do. Indexes are built
+# CONCURRENTLY (outside a transaction) so live traffic on the table is never blocked
+def upgrade(bind=engine):
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        while not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}).scalar():
+            time.sleep(MIGRATION_LOCK_POLL)
+        try:
+            for table in Base.metadata.sorted_tables:
+                columns = {column["name"] for column in inspect(conn).get_columns(table.name)}
+                for column in table.columns:
+                    if column.primary_key or column.name in columns:
+                        continue
+                    try:
+                        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {CreateColumn(column).compile(dialect=conn.dialect)}"))
+                    except exc.DBAPIError as error:
+                        print(f"Unable to add column {table.name}.{column.name}:", error)
+                indexes = existing_indexes(conn, table.name)
+                for index in table.indexes:
+                    if indexes.get(index.name):
+                        continue
+                    try:
+                        if index.name in indexes:
+                            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+                        create_index_concurrently(conn, index)
+                    except exc.DBAPIError as error:
+                        print(f"Unable to create index {index.name}:", error)
+            if VERSIONED_STORAGE:
+                reloptions = conn.execute(text("SELECT reloptions FROM pg_class WHERE oid = to_regclass(:table_name)"),
+                                          {"table_name": Inventory.__tablename__}).scalar() or []
+                if f"fillfactor={VERSIONED_FILLFACTOR}" not in reloptions:
+                    conn.execute(text(f"ALTER TABLE {Inventory.__tablename__} SET (fillfactor = {VERSIONED_FILLFACTOR})"))
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def search_query(*query_filters):
+    return select(Inventory.__table__).where(Inventory.availability == 'Available', Inventory.committed == True,
+                                             Inventory.activated == True, *query_filters)
+
+
+# Hot queries and the indexes each one may use
+def hot_queries():
+    pending_index = "ix_inventory_pending" if VERSIONED_STORAGE else "ix_inventory_uncommitted"
+    return [
+        ("reserve tentative write", ("inventory_pkey", "ix_inventory_location"),
+         tentative_write_statement(Inventory, (Inventory.id.in_([101, 102, 103]), Inventory.availability == 'Available', Inventory.location == 1),
+                                   {'transaction_id': 'check', 'availability': 'Reserved'})),
+        ("payment tentative write", ("ix_inventory_transaction_id",),
+         tentative_write_statement(Inventory, (Inventory.availability == "Reserved", Inventory.transaction_id == 'T500', Inventory.location == 0),
+                                   {"availability": "Purchased"})),
+        ("purchased tickets lookup", ("ix_inventory_transaction_id",),
+         select(Inventory).where(Inventory.activated == True, Inventory.committed == True, Inventory.transaction_id == 'T501')),
+        ("bulk apply (update_authority)", (pending_index,), apply_statement(Inventory)),
+        ("tentative cleanup", (pending_index,), discard_all_statement(Inventory)),
+        ("relinquished rows", ("ix_inventory_on_backup",), select(Inventory).where(Inventory.on_backup == True)),
+        ("owned rows", ("ix_inventory_location",), select(Inventory.id).where(Inventory.location == 7)),
+        ("seat search by desirability", ("ix_inventory_search_desirability",),
+         search_query(Inventory.location == 7, Inventory.price <= 300).order_by(*Inventory.search_order("desirability")).limit(4)),
+        ("seat search by price", ("ix_inventory_search_price",),
+         search_query(Inventory.location == 7, Inventory.section == 'S3').order_by(*Inventory.search_order("price")).limit(20)),
+    ]
+
+
+def plan_indexes(plan):
+    names = set()
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        names |= plan_indexes(child)
+    return names
+
+
+# exec_driver_sql skips the type bind processors, e.g. the JSONB encoding of `pending`
+def driver_params(compiled, dialect):
+    params = {}
+    for key, value in compiled.params.items():
+        bind = compiled.binds.get(key)
+        processor = bind.type.bind_processor(dialect) if bind is not None else None
+        params[key] = processor(value) if processor else value
+    return params
+
+
+# Seeds synthetic seats after the existing ones (20 owners, 2% with a transaction, 0.1% tentative/on backup)
+def seed_seats(conn, seats):
+    conn.execute(text('''
+        INSERT INTO inventory (id, section, "row", seat, desirability, location, price, availability, transaction_id,
+                               committed, on_backup, activated, write_locked)
+        SELECT base.max_id + g, 'S' || (g % 50), (g % 40)::text, (g % 30)::text, g % 10, g % 20, 100 + g % 400,
+               CASE WHEN g % 100 = 0 THEN 'Reserved' WHEN g % 100 = 1 THEN 'Purchased' ELSE 'Available' END,
+               CASE WHEN g % 100 < 2 THEN 'T' || g END,
+               true, g % 1000 = 0, true, false
+        FROM generate_series(1, :seats) AS g, (SELECT coalesce(max(id), 0) AS max_id FROM inventory) AS base
+    '''), {"seats": seats})
+    if VERSIONED_STORAGE:
+        conn.execute(text("UPDATE inventory SET pending = jsonb_build_object('availability', availability) WHERE committed AND on_backup"))
+    else:
+        conn.execute(text('''
+            INSERT INTO inventory (id, section, "row", seat, desirability, location, price, availability, transaction_id,
+                                   committed, on_backup, activated, write_locked)
+            SELECT id, section, "row", seat, desirability, location, price, availability, transaction_id,
+                   false, on_backup, activated, write_locked
+            FROM inventory WHERE committed AND on_backup
+        '''))
+    conn.execute(text("ANALYZE inventory"))
+
+
+# Runs EXPLAIN for every hot query inside a transaction that is rolled back,
+# so the synthetic seats (and the statistics gathered on them) never persist
+def check_plans(seats, bind=engine):
+    failures = 0
+    with bind.connect() as conn:
+        transaction = conn.begin()
+        try:
+            if seats:
+                print(f"Seeding {seats} synthetic seats...")
+                seed_seats(conn, seats)
+            for name, expected_indexes, statement in hot_queries():
+                compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+                plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), driver_params(compiled, conn.dialect)).scalar()[0]["Plan"]
+                used = plan_indexes(plan)
+                if used & set(expected_indexes):
+                    print(f"ok      {name}: {', '.join(sorted(used))}")
+                else:
+                    failures += 1
+                    print(f"FAILED  {name}: expected {' or '.join(expected_indexes)}, plan uses {sorted(used) or 'no index'}")
+        finally:
+            transaction.rollback()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check-plans", action="store_true")
+    parser.add_argument("--seats", type=int, default=1000000)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    upgrade()
+    if args.check_plans:
+        sys.exit(1 if check_plans(args.seats) else 0)
@@ -0,0 +1,110 @@
+import os
+from datetime import datetime
+import httpx
+from sqlalchemy import select
+from database import AsyncSessionLocal
+from models import Server
+from registry import store_registry_async, retrieve_registry
+import wire
+
+# Shared RPC client for server-to-server calls (prepare/apply/heartbeat/status)
+# Keeps one keep-alive connection pool per peer and caches peer addresses in memory,
+# so a partner call costs neither a TCP handshake nor a Server lookup
+
+PARTNER_CONNECT_TIMEOUT = float(os.environ.get("ANTIHERO_PARTNER_CONNECT_TIMEOUT", "1"))
+PARTNER_TIMEOUT = float(os.environ.get("ANTIHERO_PARTNER_TIMEOUT", "3"))
+PARTNER_POOL_SIZE = int(os.environ.get("ANTIHERO_PARTNER_POOL_SIZE", "32"))
+PARTNER_KEEPALIVE_EXPIRY = float(os.environ.get("ANTIHERO_PARTNER_KEEPALIVE_EXPIRY", "30"))
+PARTNER_HTTP2 = os.environ.get("ANTIHERO_PARTNER_HTTP2", "false").lower() in ("1", "true", "yes")
+
+if PARTNER_HTTP2:
+    try:
+        import h2  # noqa: F401 (httpx needs the h2 package for HTTP/2)
+    except ImportError:
+        print("ANTIHERO_PARTNER_HTTP2 is set but the h2 package is not installed, falling back to HTTP/1.1")
+        PARTNER_HTTP2 = False
+
+
+def partner_timeout():
+    return httpx.Timeout(PARTNER_TIMEOUT, connect=PARTNER_CONNECT_TIMEOUT)
+
+
+def partner_limits():
+    return httpx.Limits(max_connections=PARTNER_POOL_SIZE,
+                        max_keepalive_connections=PARTNER_POOL_SIZE,
+                        keepalive_expiry=PARTNER_KEEPALIVE_EXPIRY)
+
+
+class ServerAddressBook:
+    # Server id -> base URL, reloaded from the servers table only after the server map changes
+    # The change is published through the registry so every process drops its copy
+    def __init__(self):
+        self.addresses = {}
+        self.loaded_version = None
+
+    def load_servers(self, servers, version):
+        addresses = {}
+        for server in servers:
+            if server.ip_address:
+                addresses[server.id] = f'http://{server.ip_address}:{server.port}'
+        self.addresses = addresses
+        self.loaded_version = version
+
+    def is_stale(self, server_id, version):
+        return version != self.loaded_version or server_id not in self.addresses
+
+    async def base_url_async(self, server_id):
+        version = retrieve_registry("Server_Map_Updated")
+        if self.is_stale(server_id, version):
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(select(Server))
+                self.load_servers(result.scalars().all(), version)
+        return self.addresses.get(server_id)
+
+
+address_book = ServerAddressBook()
+
+
+# Called whenever /servers or /partner changes the server map
+async def refresh_server_addresses_async():
+    await store_registry_async("Server_Map_Updated", datetime.utcnow())
+
+
+class AsyncPartnerClient:
+    # Used by the API event loop, one pooled httpx.AsyncClient per peer base URL
+    # Also used for orchestrator calls through client_for
+    def __init__(self):
+        self.clients = {}
+
+    def client_for(self, base_url):
+        client = self.clients.get(base_url)
+        if client is None:
+            client = httpx.AsyncClient(base_url=base_url, timeout=partner_timeout(), limits=partner_limits(), http2=PARTNER_HTTP2)
+            self.clients[base_url] = client
+        return client
+
+    # `body` is encoded in the format the peer reads (see wire), every response records what the peer advertised
+    async def request(self, method, server_id, path, body=None, **kwargs):
+        base_url = await address_book.base_url_async(server_id)
+        if not base_url:
+            return None
+        if body is not None:
+            kwargs["content"], kwargs["headers"] = wire.encode_body(body, base_url)
+        response = await self.client_for(base_url).request(method, path, **kwargs)
+        wire.note_response(response)
+        return response
+
+    async def partner_request(self, method, path, body=None, **kwargs):
+        partner_id = retrieve_registry("Partner_ID", 0)
+        if not partner_id:
+            return None
+        return await self.request(method, partner_id, path, body, **kwargs)
+
+    async def aclose(self):
+        clients = self.clients
+        self.clients = {}
+        for client in clients.values():
+            await client.aclose()
+
+
+async_partner_client = AsyncPartnerClient()
@@ -0,0 +1,127 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional, Union
+from sqlalchemy import func, select
+from database import AsyncSessionLocal
+from models import RegistryEntry
+from shared_state import SharedCounters
+
+RegistryValue = Union[bool, int, float, str, datetime, None]
+
+# Bumped after every committed registry write (from any process on this host)
+registry_version = SharedCounters("registry-version")
+# Every registry write also sends NOTIFY on this channel (delivered on commit) with the key as payload,
+# the background worker LISTENs to react to status/partner changes (see worker.py)
+REGISTRY_CHANNEL = "antihero_registry"
+
+
+def registry_entry_value(registry_entry: RegistryEntry) -> RegistryValue:
+    value = None
+    if registry_entry.int_value is not None:
+        value = registry_entry.int_value
+
+    if registry_entry.string_value is not None:
+        value = registry_entry.string_value
+
+    if registry_entry.bool_value is not None:
+        value = registry_entry.bool_value
+
+    if registry_entry.datetime_value is not None:
+        value = registry_entry.datetime_value
+    return value
+
+
+def set_registry_entry_value(registry_entry: RegistryEntry, value: RegistryValue):
+    if value is None:
+        registry_entry.int_value = None
+        registry_entry.string_value = None
+        registry_entry.bool_value = None
+        registry_entry.datetime_value = None
+    else:
+        if isinstance(value, bool):
+            registry_entry.bool_value = value
+        elif isinstance(value, (float, int)):
+            registry_entry.int_value = value
+        elif isinstance(value, str):
+            registry_entry.string_value = value
+        elif isinstance(value, datetime):
+            registry_entry.datetime_value = value
+
+
+class RegistryCache:
+    # Per-process copy of the registry_entries table
+    # Any write bumps the shared version counter, refresh_async then reloads the whole table in one query.
+    # Reads never touch the database: they are served from the last loaded copy, so every entry point
+    # (the app-wide refresh_registry dependency, the background loops) refreshes before reading
+    def __init__(self, version_counter: SharedCounters):
+        self.version_counter = version_counter
+        self.values: Dict[str, RegistryValue] = {}
+        self.version: Optional[int] = None
+        # Serializes refresh_async within the event loop it was created for
+        self.async_lock = None
+        self.async_lock_loop = None
+
+    def load_entries(self, registry_entries, version: int):
+        values = {}
+        for registry_entry in registry_entries:
+            # Mirror the previous .first() lookup if a key was ever stored twice
+            if registry_entry.registry_name not in values:
+                values[registry_entry.registry_name] = registry_entry_value(registry_entry)
+        self.values = values
+        self.version = version
+
+    # The API runs one event loop per process, a lock is only reused within the loop it belongs to (tests start new ones)
+    def loop_lock(self):
+        loop = asyncio.get_running_loop()
+        if self.async_lock_loop is not loop:
+            self.async_lock = asyncio.Lock()
+            self.async_lock_loop = loop
+        return self.async_lock
+
+    # Double-checked: requests arriving during a reload wait for it instead of each loading the table,
+    # and a slower reload of an older version can't overwrite a newer one
+    async def refresh_async(self):
+        if self.version_counter.get() != self.version:
+            async with self.loop_lock():
+                # Read before loading so a write landing mid-reload forces another reload
+                version = self.version_counter.get()
+                if version != self.version:
+                    async with AsyncSessionLocal() as session:
+                        result = await session.execute(select(RegistryEntry))
+                        self.load_entries(result.scalars().all(), version)
+
+    def get(self, key: str, default: RegistryValue = None) -> RegistryValue:
+        value = self.values.get(key)
+        return default if value is None else value
+
+    def invalidate(self):
+        self.version_counter.bump()
+
+
+registry_cache = RegistryCache(registry_version)
+
+
+def retrieve_registry(key, default=None):
+    return registry_cache.get(key, default)
+
+
+# FastAPI dependency (installed app-wide in main.py): brings the cache up to date before
+# the handler runs, so the synchronous retrieve_registry calls inside it are memory reads
+async def refresh_registry():
+    await registry_cache.refresh_async()
+
+
+async def store_registry_async(key, value):
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(RegistryEntry).where(RegistryEntry.registry_name == key))
+        registry_entry = result.scalars().first()
+        if not registry_entry:
+            registry_entry = RegistryEntry(registry_name=key)
+            session.add(registry_entry)
+
+        set_registry_entry_value(registry_entry, value)
+        await session.execute(select(func.pg_notify(REGISTRY_CHANNEL, key)))
+        await session.commit()
+    registry_cache.invalidate()
+    await registry_cache.refresh_async()
+    return value
@@ -0,0 +1,85 @@
+import json
+from datetime import datetime
+from typing import List, Optional, Union
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel
+
+# Response models for the endpoints returning rows, and the JSON encoder every response goes through
+# Rows are turned into dicts by the per-model serializers (models.RowSerializer) and encoded with orjson,
+# endpoints returning large lists hand back a ready response so FastAPI skips jsonable_encoder and validation
+# The server and orchestrator copies of this file are identical (checked by server/tests/test_shared_modules.py)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    print("orjson is not installed, falling back to the standard JSON encoder")
+
+
+def encode_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+if orjson is not None:
+    JSONResponseClass = ORJSONResponse
+
+    def dumps_json(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+else:
+    JSONResponseClass = JSONResponse
+
+    def dumps_json(obj):
+        return json.dumps(obj, default=encode_default).encode()
+
+
+class InventoryItem(BaseModel):
+    id: int
+    section: Optional[str] = None
+    row: Optional[str] = None
+    seat: Optional[str] = None
+    desirability: Optional[int] = None
+    location: Optional[int] = None
+    price: Optional[int] = None
+    availability: Optional[str] = None
+    description: Optional[str] = None
+    transaction_id: Optional[str] = None
+    committed: bool
+    on_backup: Optional[bool] = None
+    activated: Optional[bool] = None
+    write_locked: Optional[bool] = None
+    last_modified_by: Optional[str] = None
+    last_modified_date: Optional[datetime] = None
+
+
+class InventoryPage(BaseModel):
+    items: List[InventoryItem]
+    next_after_id: Optional[int] = None
+
+
+# GET /inventory answers in one of three shapes, more than a response_model can declare, so its OpenAPI entry lists them here
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+INVENTORY_MAP_RESPONSES = {
+    200: {
+        "model": Union[InventoryPage, List[InventoryItem]],
+        "description": "With ?limit=N one keyset page (InventoryPage), otherwise every row as one JSON array, "
+                       f"or one row per line with ?stream=true or Accept: {NDJSON_MEDIA_TYPE}",
+        "content": {NDJSON_MEDIA_TYPE: {"schema": {"type": "string", "description": "InventoryItem objects, one per line"}}},
+    },
+}
+
+
+class ServerInfo(BaseModel):
+    id: int
+    hostname: Optional[str] = None
+    ip_address: Optional[str] = None
+    port: Optional[str] = None
+    status: Optional[str] = None
+    last_updated: Optional[datetime] = None
+    partner_id: Optional[int] = None
+    in_backup: Optional[bool] = None
+    in_failure: Optional[bool] = None
+    timeout_reported: Optional[datetime] = None
+    description: Optional[str] = None
+    epoch: Optional[int] = None
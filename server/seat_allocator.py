@@ -0,0 +1,134 @@
+import os
+import time
+from sqlalchemy import select
+import metrics
+from models import Inventory
+
+# Contiguous seat allocation ("best N seats together")
+# The seats this server owns are kept as one availability bitmap per (section, row), bit i is seat number first_seat + i.
+# The maps are only a hint: the block is still reserved through the tentative write, when one of its seats
+# turns out to be taken the section is reloaded and the next best block is tried
+
+SEAT_MAP_TTL = float(os.environ.get("ANTIHERO_SEAT_MAP_TTL", "2"))
+
+
+class RowMap:
+    def __init__(self, section, row, seats):
+        # seats: (seat number, id, desirability, price, available)
+        self.section = section
+        self.row = row
+        self.first_seat = min(seat[0] for seat in seats)
+        length = max(seat[0] for seat in seats) - self.first_seat + 1
+        self.ids = [None] * length
+        self.prices = [None] * length
+        self.available = 0
+        desirability = [0] * length
+        for number, id, seat_desirability, price, available in seats:
+            offset = number - self.first_seat
+            self.ids[offset] = id
+            self.prices[offset] = price
+            desirability[offset] = seat_desirability or 0
+            if available:
+                self.available |= 1 << offset
+        # Prefix sums, the desirability/price of any block is two lookups
+        self.desirability_sums = [0]
+        self.price_sums = [0]
+        for offset in range(length):
+            self.desirability_sums.append(self.desirability_sums[-1] + desirability[offset])
+            self.price_sums.append(self.price_sums[-1] + (self.prices[offset] or 0))
+
+    def price_mask(self, max_price):
+        mask = 0
+        for offset, price in enumerate(self.prices):
+            if price is not None and price <= max_price:
+                mask |= 1 << offset
+        return mask
+
+    # Offsets where `quantity` available seats start, a bit survives the shifted ANDs only if the next quantity - 1 are set too
+    def block_starts(self, quantity, max_price=None):
+        usable = self.available if max_price is None else self.available & self.price_mask(max_price)
+        starts = usable
+        for shift in range(1, quantity):
+            if not starts:
+                break
+            starts &= usable >> shift
+        return starts
+
+    # Best first: highest total desirability, then lowest total price, then lowest seat number
+    def blocks(self, quantity, max_price=None):
+        starts = self.block_starts(quantity, max_price)
+        offset = 0
+        while starts:
+            if starts & 1:
+                yield ((self.desirability_sums[offset + quantity] - self.desirability_sums[offset],
+                        self.price_sums[offset] - self.price_sums[offset + quantity],
+                        -offset),
+                       self, offset)
+            starts >>= 1
+            offset += 1
+
+    def block(self, offset, quantity):
+        return {
+            "section": self.section,
+            "row": self.row,
+            "seats": [str(self.first_seat + index) for index in range(offset, offset + quantity)],
+            "ids": self.ids[offset:offset + quantity],
+        }
+
+    def mark_taken(self, offset, quantity):
+        self.available &= ~(((1 << quantity) - 1) << offset)
+
+
+class SeatAllocator:
+    def __init__(self):
+        # section (None for every section) -> (server id, expiry, row maps)
+        self.maps = {}
+
+    async def row_maps(self, session, server_id, section):
+        entry = self.maps.get(section)
+        if entry is not None and entry[0] == server_id and time.monotonic() < entry[1]:
+            return entry[2]
+        statement = (select(Inventory.id, Inventory.section, Inventory.row, Inventory.seat, Inventory.desirability,
+                            Inventory.price, Inventory.availability)
+                     .where(Inventory.location == server_id, Inventory.committed == True, Inventory.activated == True))
+        if section is not None:
+            statement = statement.where(Inventory.section == section)
+        rows = {}
+        for seat in (await session.execute(statement)).all():
+            # Seats without a numeric seat number have no neighbours to be allocated with
+            if seat.seat is None or not seat.seat.isdigit():
+                continue
+            rows.setdefault((seat.section, seat.row), []).append(
+                (int(seat.seat), seat.id, seat.desirability, seat.price, seat.availability == "Available"))
+        row_maps = [RowMap(row_section, row, seats) for (row_section, row), seats in rows.items()]
+        self.maps[section] = (server_id, time.monotonic() + SEAT_MAP_TTL, row_maps)
+        metrics.increment("seat_map_loads")
+        return row_maps
+
+    # Best contiguous block of `quantity` seats (every seat at most max_price), None if there isn't one
+    async def best_block(self, session, server_id, section, quantity, max_price=None):
+        best = None
+        for row_map in await self.row_maps(session, server_id, section):
+            for candidate in row_map.blocks(quantity, max_price):
+                if best is None or candidate[0] > best[0]:
+                    best = candidate
+        if best is None:
+            return None
+        _, row_map, offset = best
+        return row_map.block(offset, quantity)
+
+    # Clears the block's seats in every cached map holding that row, so concurrent requests in this process pick other seats
+    def claim(self, block):
+        for _, _, row_maps in self.maps.values():
+            for row_map in row_maps:
+                if row_map.section == block["section"] and row_map.row == block["row"]:
+                    row_map.mark_taken(int(block["seats"][0]) - row_map.first_seat, len(block["seats"]))
+
+    # The block couldn't be reserved, the maps holding its row are reloaded on the next allocation
+    def invalidate(self, block):
+        self.maps.pop(block["section"], None)
+        self.maps.pop(None, None)
+        metrics.increment("seat_allocation_conflicts")
+
+
+seat_allocator = SeatAllocator()
@@ -0,0 +1,148 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+# Shared state lives in memory-mapped files so that every process on this host
+# (the gunicorn workers and worker.py) sees the same values without a database round-trip
+SHARED_STATE_DIR = os.environ.get("ANTIHERO_SHM_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+COUNTER_FORMAT = "Q"
+COUNTER_SIZE = struct.calcsize(COUNTER_FORMAT)
+
+
+def shared_state_path(name):
+    return os.path.join(SHARED_STATE_DIR, f'antihero-{name}')
+
+
+class SharedRegion:
+    # Fixed-size memory-mapped region backed by a file in SHARED_STATE_DIR
+    # The file is created (zero-filled) by whichever process opens it first
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.path = shared_state_path(name)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o660)
+        # flock is held per open file, so threads of the same process also need a local lock
+        self._thread_lock = threading.Lock()
+        with self.locked():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        self.buffer = mmap.mmap(self._fd, size)
+
+    def locked(self):
+        return _RegionLock(self)
+
+
+class _RegionLock:
+    def __init__(self, region):
+        self.region = region
+
+    def __enter__(self):
+        self.region._thread_lock.acquire()
+        fcntl.flock(self.region._fd, fcntl.LOCK_EX)
+        return self.region
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.region._fd, fcntl.LOCK_UN)
+        self.region._thread_lock.release()
+        return False
+
+
+class SharedCounters:
+    # Array of 64-bit counters shared by every process on this host
+    # Readers never lock, writers serialize increments through the region lock
+    def __init__(self, name: str, size: int = 1):
+        self.size = size
+        self.region = SharedRegion(name, size * COUNTER_SIZE)
+
+    def get(self, index: int = 0) -> int:
+        return struct.unpack_from(COUNTER_FORMAT, self.region.buffer, index * COUNTER_SIZE)[0]
+
+    def bump(self, index: int = 0) -> int:
+        with self.region.locked():
+            value = self.get(index) + 1
+            struct.pack_into(COUNTER_FORMAT, self.region.buffer, index * COUNTER_SIZE, value)
+        return value
+
+    # Increments several counters under one lock acquisition
+    def bump_many(self, indexes):
+        with self.region.locked():
+            for index in set(indexes):
+                struct.pack_into(COUNTER_FORMAT, self.region.buffer, index * COUNTER_SIZE, self.get(index) + 1)
+
+
+class SharedIdQueue:
+    # Set of ids with the time each was first queued, shared by every process on this host
+    # A count followed by (id, queued at) slots, rewritten whole under the region lock: the queue is drained
+    # every few milliseconds, so it stays short
+    ENTRY_FORMAT = "qd"
+    ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+    def __init__(self, name: str, capacity: int):
+        self.capacity = capacity
+        self.region = SharedRegion(name, COUNTER_SIZE + capacity * self.ENTRY_SIZE)
+
+    def __len__(self):
+        return struct.unpack_from(COUNTER_FORMAT, self.region.buffer)[0]
+
+    # Must be called with the region locked
+    def read(self):
+        count = len(self)
+        entries = struct.iter_unpack(self.ENTRY_FORMAT, self.region.buffer[COUNTER_SIZE:COUNTER_SIZE + count * self.ENTRY_SIZE])
+        return dict(entries)
+
+    def write(self, entries):
+        struct.pack_into(COUNTER_FORMAT, self.region.buffer, 0, len(entries))
+        for index, entry in enumerate(entries.items()):
+            struct.pack_into(self.ENTRY_FORMAT, self.region.buffer, COUNTER_SIZE + index * self.ENTRY_SIZE, *entry)
+
+    # Adds the ids of `entries` (id -> queued at) keeping the earliest time of those already queued,
+    # returns the entries that didn't fit
+    def merge(self, entries):
+        with self.region.locked():
+            merged = self.read()
+            overflow = {}
+            for id, queued_at in entries.items():
+                if id in merged:
+                    merged[id] = min(queued_at, merged[id])
+                elif len(merged) < self.capacity:
+                    merged[id] = queued_at
+                else:
+                    overflow[id] = queued_at
+            self.write(merged)
+        return overflow
+
+    # Removes and returns every queued id (with its queue time)
+    def take(self):
+        with self.region.locked():
+            taken = self.read()
+            if taken:
+                self.write({})
+        return taken
+
+    def oldest(self):
+        with self.region.locked():
+            return min(self.read().values(), default=None)
+
+
+class HostPresence:
+    # Tells a process whether it is the first on this host to use a piece of shared state: every process
+    # holds a shared flock on the file for as long as it runs, so only one arriving alone gets it exclusively
+    def __init__(self, name: str):
+        self._fd = os.open(shared_state_path(name), os.O_RDWR | os.O_CREAT, 0o660)
+
+    # True (holding the lock exclusively until settle) when no other process is present,
+    # otherwise waits for the first process to settle and returns False
+    def arrive(self) -> bool:
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            return False
+
+    def settle(self):
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
@@ -0,0 +1,207 @@
+import os
+from datetime import datetime
+from sqlalchemy import Integer, any_, case, cast, column, delete, func, literal, literal_column, select, update, values
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
+
+# Set-based SQL for the Anti-Hero tentative commit protocol
+# Each builder returns a single statement so callers pay one round-trip per batch instead of one per row
+#
+# Two storage modes (ANTIHERO_STORAGE_MODE):
+#   shadow     a tentative write is a second physical row keyed by committed=False, apply replaces the committed row
+#   versioned  the committed row holds the tentative values in its `pending` column and is updated in place,
+#              prepare/apply/discard are compare-and-set updates guarded by `pending` and bump `version`
+# The rows and ids exchanged between partners are the same in both modes
+
+STORAGE_MODE = os.environ.get("ANTIHERO_STORAGE_MODE", "shadow").lower()
+VERSIONED_STORAGE = STORAGE_MODE == "versioned"
+# Never carried inside `pending`
+VERSION_COLUMNS = ("id", "committed", "version", "pending")
+
+
+# Copies every matching committed row into an uncommitted (tentative) shadow row with `values` applied
+# A row that already has a shadow row is locked by another transaction and is silently skipped
+# through ON CONFLICT DO NOTHING, the RETURNING clause reports which rows were acquired
+def tentative_write_statement(model, query_filters, values):
+    if VERSIONED_STORAGE:
+        return versioned_tentative_write_statement(model, query_filters, values)
+    columns = model.__table__.columns
+    # Keys that aren't columns (e.g. solo_mode) were previously set as plain attributes and never stored
+    overrides = {key: values[key] for key in values if key in columns}
+    overrides["committed"] = False
+    # Setting last modified date for optimization of recovery process
+    overrides["last_modified_date"] = datetime.utcnow()
+
+    selected = []
+    for col in columns:
+        if col.name in overrides:
+            selected.append(literal(overrides[col.name], type_=col.type).label(col.name))
+        else:
+            selected.append(col)
+
+    source = select(*selected).where(model.activated == True, model.committed == True)
+    for curr_filter in query_filters:
+        source = source.where(curr_filter)
+    # Inserted in id order, two batches with overlapping ids then wait on each other's
+    # speculative inserts in the same order instead of deadlocking
+    source = source.order_by(model.id)
+
+    return (insert(model)
+            .from_select([col.name for col in columns], source)
+            .on_conflict_do_nothing()
+            .returning(*columns))
+
+
+# Converts the JSON rows sent to /inventory/prepare into insert parameters
+# Every row carries the same keys so the whole batch can go out as one multi-row INSERT
+def prepare_rows(model, data):
+    columns = model.__table__.columns
+    rows = []
+    for obj in data:
+        row = {}
+        for col in columns:
+            if col.name in obj:
+                row[col.name] = obj[col.name]
+            elif col.default is not None and col.default.is_scalar:
+                row[col.name] = col.default.arg
+            else:
+                row[col.name] = None
+        if isinstance(row.get("last_modified_date"), str):
+            row["last_modified_date"] = datetime.fromisoformat(row["last_modified_date"])
+        rows.append(row)
+    return rows
+
+
+# Executed with a list of rows from prepare_rows, SQLAlchemy batches them into multi-row VALUES
+# Rows whose (id, committed) already exists are locked on this node and are not accepted
+# Also inserts the seats ingested from the orchestrator (main.insert_missing) in either storage mode
+def prepare_insert_statement(model):
+    # Versioned storage prepares with prepare_update_statement, which takes the rows itself
+    return insert(model.__table__).on_conflict_do_nothing().returning(model.__table__.c.id)
+
+
+# Promotes tentative rows matching `query_filters` to committed in one atomic statement
+# The tentative rows are deleted in a data-modifying CTE and upserted over their committed versions,
+# so other transactions see either the old committed row or the new one, never neither
+# With no filters every tentative row is promoted (used in bulk by update_authority)
+# RETURNING reports the id and new availability of every promoted row
+def apply_statement(model, query_filters=()):
+    if VERSIONED_STORAGE:
+        return versioned_apply_statement(model, query_filters)
+    table = model.__table__
+    columns = table.columns
+    pending = delete(table).where(table.c.committed == False, table.c.activated == True)
+    for curr_filter in query_filters:
+        pending = pending.where(curr_filter)
+    pending = pending.returning(*columns).cte("pending")
+
+    promoted = select(*[literal(True).label(col.name) if col.name == "committed" else pending.c[col.name] for col in columns])
+    statement = insert(table).from_select([col.name for col in columns], promoted)
+    statement = statement.on_conflict_do_update(
+        index_elements=[col for col in columns if col.primary_key],
+        set_={col.name: statement.excluded[col.name] for col in columns if not col.primary_key})
+    return statement.returning(table.c.id, table.c.availability)
+
+
+# Drops every tentative write matching `query_filters` (all of them without filters), e.g. before a row is overwritten,
+# RETURNING the ids that had one
+def discard_all_statement(model, query_filters=()):
+    if VERSIONED_STORAGE:
+        return versioned_discard_statement(model, query_filters).returning(model.__table__.c.id)
+    statement = delete(model.__table__).where(model.committed == False)
+    for curr_filter in query_filters:
+        statement = statement.where(curr_filter)
+    return statement.returning(model.__table__.c.id)
+
+
+# id = ANY(array) with the ids sent as one array parameter, in_() sends one bind parameter per id
+# which gets slow (and hits the driver's parameter limit) for the large id sets of a failover
+def ids_filter(model, ids):
+    return model.__table__.c.id == any_(literal(list(ids), ARRAY(Integer)))
+
+
+# Contiguous runs of the ids matching `query_filters` as (first, last) rows in id order: an id minus its rank
+# is the same for every id of a run (gaps and islands), so a block of seats costs one row however large it is
+def id_ranges_statement(model, query_filters=()):
+    ids = select(model.__table__.c.id).distinct()
+    for curr_filter in query_filters:
+        ids = ids.where(curr_filter)
+    ids = ids.subquery()
+    runs = select(ids.c.id, (ids.c.id - func.row_number().over(order_by=ids.c.id)).label("run")).subquery()
+    return select(func.min(runs.c.id), func.max(runs.c.id)).group_by(runs.c.run).order_by(func.min(runs.c.id))
+
+
+# Tentative values as stored in `pending` (JSON, datetimes as ISO strings)
+def pending_values(row):
+    return {key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in row.items() if key not in VERSION_COLUMNS}
+
+
+# Versioned counterpart of tentative_write_statement: one in-place UPDATE of the committed rows that have
+# no pending write, RETURNING the rows as the tentative shadow rows would look so send_write_to_backup is unchanged
+def versioned_tentative_write_statement(model, query_filters, values):
+    table = model.__table__
+    overrides = {key: values[key] for key in values if key in table.columns}
+    overrides["last_modified_date"] = datetime.utcnow()
+    # UPDATE has no ORDER BY, the rows are locked in id order by a subquery (see tentative_write_statement)
+    locked = select(table.c.id).where(table.c.activated == True, table.c.committed == True, table.c.pending == None)
+    for curr_filter in query_filters:
+        locked = locked.where(curr_filter)
+    locked = locked.order_by(table.c.id).with_for_update()
+    statement = update(table).where(table.c.id.in_(locked), table.c.committed == True, table.c.pending == None)
+    overrides_returned = dict(overrides, committed=False, pending=None)
+    returned = [literal(overrides_returned[col.name], type_=col.type).label(col.name) if col.name in overrides_returned else col
+                for col in table.columns]
+    return (statement
+            .values({table.c.pending: pending_values(overrides), table.c.version: table.c.version + 1})
+            .returning(*returned))
+
+
+# Versioned counterpart of prepare_insert_statement, the backup records the primary's tentative rows as pending
+# on its committed copies in one UPDATE ... FROM (VALUES ...), RETURNING the ids that were accepted
+def prepare_update_statement(model, rows):
+    table = model.__table__
+    incoming = values(column("id", Integer), column("pending", JSONB), name="incoming").data(
+        [(row["id"], pending_values(row)) for row in rows])
+    # Rows locked in id order first (see tentative_write_statement)
+    locked = (select(table.c.id, incoming.c.pending)
+              .where(table.c.id == incoming.c.id, table.c.committed == True, table.c.pending == None)
+              .order_by(table.c.id)
+              .with_for_update(of=table)
+              .cte("locked"))
+    return (update(table)
+            .where(table.c.id == locked.c.id, table.c.committed == True, table.c.pending == None)
+            .values({table.c.pending: locked.c.pending, table.c.version: table.c.version + 1})
+            .returning(table.c.id))
+
+
+# Versioned counterpart of apply_statement: copies every column present in `pending` onto the row and clears it
+def versioned_apply_statement(model, query_filters=()):
+    table = model.__table__
+    pending = table.c.pending
+    assignments = {col: case((pending.has_key(col.name), cast(pending[col.name].astext, col.type)), else_=col)
+                   for col in table.columns if col.name not in VERSION_COLUMNS}
+    assignments[pending] = None
+    assignments[table.c.version] = table.c.version + 1
+    statement = update(table).where(table.c.committed == True, pending != None)
+    for curr_filter in query_filters:
+        statement = statement.where(curr_filter)
+    return statement.values(assignments).returning(table.c.id, table.c.availability)
+
+
+def versioned_discard_statement(model, query_filters=()):
+    table = model.__table__
+    statement = update(table).where(table.c.pending != None)
+    for curr_filter in query_filters:
+        statement = statement.where(curr_filter)
+    return statement.values({table.c.pending: None, table.c.version: table.c.version + 1})
+
+
+# Upserts whole rows (e.g. the orchestrator's send_and_activate chunks) in one statement
+# Only the columns in `keys` are overwritten on conflict, RETURNING reports whether each row was inserted
+def upsert_statement(model, keys):
+    table = model.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[col for col in table.columns if col.primary_key],
+        set_={key: statement.excluded[key] for key in keys if not table.columns[key].primary_key})
+    return statement.returning(table.c.id, literal_column("xmax = 0").label("inserted"))
@@ -0,0 +1,54 @@
+import multiprocessing
+import unittest
+from apply_queue import ApplyQueue
+from models import Inventory
+
+# The apply and discard queues are shared by every API worker on this host: ids one worker queues
+# ride along with whichever worker sends next
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+
+def enqueue_from_process(ids):
+    ApplyQueue(Inventory).enqueue(ids)
+
+
+class ApplyQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = ApplyQueue(Inventory)
+        self.queue.take()
+
+    def test_ids_queued_by_another_worker_are_taken_here(self):
+        process = multiprocessing.get_context("fork").Process(target=enqueue_from_process, args=([1, 2, 3],))
+        process.start()
+        process.join(10)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(self.queue.depth(), 3)
+        self.assertEqual(sorted(self.queue.take()), [1, 2, 3])
+        self.assertEqual(self.queue.depth(), 0)
+
+    def test_requeue_keeps_the_earliest_queue_time(self):
+        self.queue.enqueue([1])
+        taken = self.queue.take()
+        self.queue.enqueue([1, 2])
+        self.queue.requeue(taken)
+        requeued = self.queue.take()
+        self.assertEqual(requeued[1], taken[1])
+        self.assertGreaterEqual(requeued[2], taken[1])
+
+    def test_ids_past_capacity_stay_with_this_worker(self):
+        queue = ApplyQueue(Inventory)
+        queue.pending.capacity = 2
+        queue.enqueue([1, 2, 3])
+        self.assertEqual(len(queue.pending), 2)
+        self.assertEqual(queue.depth(), 3)
+        self.assertEqual(sorted(queue.take()), [1, 2, 3])
+
+    def test_discards_are_kept_apart_from_applies(self):
+        ApplyQueue(Inventory, "discard").enqueue([7])
+        self.assertEqual(self.queue.take(), {})
+        self.assertEqual(list(ApplyQueue(Inventory, "discard").take()), [7])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+from unittest import mock
+import httpx
+from apply_queue import apply_queue_for, discard_queue_for
+from group_commit import PrepareBatcher
+from models import Inventory
+from partner_client import async_partner_client
+
+# Prepare batches: every caller gets back its own accepted ids, and a batch the partner fails on is
+# sent again one caller at a time so the other callers still go through
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+BROKEN_ID = 13
+
+
+# Stands in for the partner: accepts every row, fails the whole request on BROKEN_ID
+async def partner(method, path, body):
+    ids = [obj["id"] for obj in body["data"]]
+    if BROKEN_ID in ids:
+        raise httpx.ReadTimeout("partner timed out")
+    return httpx.Response(200, json={"Status": "Success", "ids": ids})
+
+
+class PrepareBatcherTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.batcher = PrepareBatcher(Inventory)
+        self.requests = []
+        async def request(method, path, body):
+            self.requests.append(body)
+            return await partner(method, path, body)
+        patcher = mock.patch.object(async_partner_client, "partner_request", side_effect=request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for queue in (apply_queue_for(Inventory), discard_queue_for(Inventory)):
+            queue.take()
+            self.addCleanup(queue.take)
+
+    async def submit_all(self, *callers):
+        tasks = [asyncio.create_task(self.batcher.submit([{"id": id} for id in ids])) for ids in callers]
+        # Every caller is waiting in the batch before it goes out
+        await asyncio.sleep(0)
+        self.batcher.flush()
+        results = []
+        for task in tasks:
+            try:
+                results.append(await task)
+            except Exception as error:
+                results.append(error)
+        return results
+
+    async def test_callers_share_one_request(self):
+        results = await self.submit_all([1, 2], [3])
+        self.assertEqual(results, [[1, 2], [3]])
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_failed_batch_fails_only_the_caller_it_failed_on(self):
+        results = await self.submit_all([1, 2], [BROKEN_ID], [4])
+        self.assertEqual(results[0], [1, 2])
+        self.assertIsInstance(results[1], httpx.ReadTimeout)
+        self.assertEqual(results[2], [4])
+        self.assertEqual(len(self.requests), 4)
+
+    async def test_failed_batch_keeps_piggybacked_applies(self):
+        apply_queue_for(Inventory).enqueue([50])
+        results = await self.submit_all([BROKEN_ID])
+        self.assertIsInstance(results[0], httpx.ReadTimeout)
+        self.assertEqual(list(apply_queue_for(Inventory).take()), [50])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import unittest
+from unittest import mock
+import lock_manager
+from lock_manager import StripedLockManager
+
+# Seat locks keyed by seat id: seats sharing a stripe only contend once every slot of it is taken
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+STRIPES = 8
+WAYS = 2
+
+
+class StripedLockManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.locks = StripedLockManager(f"test-seat-locks-{os.getpid()}", STRIPES, WAYS, 10000)
+        self.locks.region.buffer[:] = bytes(self.locks.region.size)
+
+    def tearDown(self):
+        self.locks.region.buffer.close()
+        os.close(self.locks.region._fd)
+        os.remove(self.locks.region.path)
+
+    def test_same_stripe_different_seats_do_not_contend(self):
+        self.locks.try_lock([1, 2])
+        self.assertEqual(self.locks.try_lock([1 + STRIPES])[1], [1 + STRIPES])
+        self.assertIsNotNone(self.locks.try_lock_all([2 + STRIPES]))
+
+    def test_same_seat_contends_until_released(self):
+        token, _ = self.locks.try_lock([5])
+        self.assertEqual(self.locks.try_lock([5, 6])[1], [6])
+        self.assertIsNone(self.locks.try_lock_all([5]))
+        self.locks.release(token, [5])
+        self.assertEqual(self.locks.try_lock([5])[1], [5])
+
+    def test_full_stripe_refuses_other_seats(self):
+        self.locks.try_lock([3, 3 + STRIPES])
+        self.assertEqual(self.locks.try_lock([3 + 2 * STRIPES])[1], [])
+
+    def test_try_lock_all_takes_nothing_when_one_seat_is_held(self):
+        self.locks.try_lock([4])
+        self.assertIsNone(self.locks.try_lock_all([7, 4]))
+        self.assertEqual(self.locks.try_lock([7])[1], [7])
+
+    def test_expired_lease_is_taken_over(self):
+        self.locks.try_lock([2])
+        with mock.patch.object(lock_manager, "now_ms", return_value=lock_manager.now_ms() + 20000):
+            self.assertEqual(self.locks.try_lock([2])[1], [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+from tests import TEST_DATABASE_URL
+
+if not TEST_DATABASE_URL:
+    raise unittest.SkipTest("ANTIHERO_TEST_DATABASE_URL is not set")
+
+import time
+from unittest import mock
+import httpx
+from sqlalchemy import delete, text
+from apply_queue import discard_queue_for
+from database import AsyncSessionLocal, async_engine
+from group_commit import prepare_batcher_for
+from heartbeat import heartbeat_state
+from main import app
+from models import Inventory
+from partner_client import async_partner_client
+from registry import refresh_registry, retrieve_registry, store_registry_async
+from txlog import transaction_log
+
+# /inventory/buy/block when the partner doesn't prepare the whole block: nothing may stay tentative here
+# (or in flight in the transaction log) and the seats the partner did prepare are queued for discard there
+# Runs against the throwaway database of ANTIHERO_TEST_DATABASE_URL (see tests/__init__), only ever
+# touching the seats it seeds
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+FIRST_ID = 900000
+SEATS = 4
+SEAT_IDS = list(range(FIRST_ID, FIRST_ID + SEATS))
+SECTION = "TEST-BLOCK"
+SERVER_ID = 1
+REGISTRY_KEYS = ("Server_ID", "Partner_ID", "In_Backup", "Status")
+
+
+class SeatBlockPartnerFailureTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await refresh_registry()
+        self.saved_registry = {key: retrieve_registry(key) for key in REGISTRY_KEYS}
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Inventory).where(Inventory.id.in_(SEAT_IDS)))
+            for seat, id in enumerate(SEAT_IDS):
+                session.add(Inventory(id=id, section=SECTION, row="1", seat=str(seat), location=SERVER_ID,
+                                      price=10, availability="Available", committed=True, activated=True))
+            await session.commit()
+        await store_registry_async("Server_ID", SERVER_ID)
+        await store_registry_async("Partner_ID", 999)
+        await store_registry_async("In_Backup", False)
+        await store_registry_async("Status", "Available")
+        # Holding the ownership lease (see lease)
+        heartbeat_state.acknowledged(time.time())
+        self.lifespan = app.router.lifespan_context(app)
+        await self.lifespan.__aenter__()
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        await self.lifespan.__aexit__(None, None, None)
+        discard_queue_for(Inventory).take()
+        heartbeat_state.clear()
+        for key, value in self.saved_registry.items():
+            await store_registry_async(key, value)
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(Inventory).where(Inventory.id.in_(SEAT_IDS)))
+            await session.commit()
+        # Every test runs in its own event loop, pooled connections can't be carried over
+        await async_partner_client.aclose()
+        await async_engine.dispose()
+
+    # Returns the response, the ids sent to the partner and the ids queued for discard on the partner
+    async def reserve_block(self, accepted):
+        submit = mock.AsyncMock(side_effect=lambda data: accepted(data))
+        discarded = []
+        with mock.patch.object(prepare_batcher_for(Inventory), "submit", submit), \
+             mock.patch.object(discard_queue_for(Inventory), "enqueue", side_effect=discarded.extend):
+            response = await self.client.post("/inventory/buy/block", params={"quantity": 3, "section": SECTION})
+        submit.assert_awaited_once()
+        return response, [obj["id"] for obj in submit.await_args.args[0]], discarded
+
+    async def assert_nothing_tentative(self, ids):
+        async with AsyncSessionLocal() as session:
+            tentative = (await session.execute(text(
+                "SELECT count(*) FROM inventory WHERE id = ANY(:ids) AND (committed = false OR pending IS NOT NULL)"),
+                {"ids": SEAT_IDS})).scalar()
+            available = (await session.execute(text(
+                "SELECT count(*) FROM inventory WHERE id = ANY(:ids) AND committed AND availability = 'Available'"),
+                {"ids": SEAT_IDS})).scalar()
+        self.assertEqual(tentative, 0)
+        self.assertEqual(available, SEATS)
+        self.assertFalse(set(ids) & set(transaction_log.in_flight()))
+
+    async def test_partner_error_discards_whole_block(self):
+        response, ids, discarded = await self.reserve_block(lambda data: None)
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(len(ids), 3)
+        await self.assert_nothing_tentative(ids)
+        # The partner may have prepared them before failing
+        self.assertEqual(sorted(discarded), sorted(ids))
+
+    async def test_partial_accept_discards_on_both_sides(self):
+        response, ids, discarded = await self.reserve_block(lambda data: [obj["id"] for obj in data[:2]])
+        self.assertEqual(response.status_code, 502)
+        await self.assert_nothing_tentative(ids)
+        self.assertEqual(sorted(discarded), sorted(ids[:2]))
+
+    async def test_lease_lost_while_preparing_discards_on_both_sides(self):
+        def lease_expires(data):
+            heartbeat_state.clear()
+            return [obj["id"] for obj in data]
+        response, ids, discarded = await self.reserve_block(lease_expires)
+        self.assertEqual(response.status_code, 503)
+        await self.assert_nothing_tentative(ids)
+        self.assertEqual(sorted(discarded), sorted(ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
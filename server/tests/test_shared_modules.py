@@ -0,0 +1,25 @@
+import os
+import unittest
+
+# Modules the server and the orchestrator each keep a copy of (every service runs from its own directory),
+# the copies must stay byte-identical: change one, copy it over to the other
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORCHESTRATOR_DIR = os.path.join(os.path.dirname(SERVER_DIR), "orchestrator")
+SHARED_MODULES = ("wire.py", "schemas.py")
+
+
+class SharedModulesTest(unittest.TestCase):
+    def test_copies_are_identical(self):
+        for module in SHARED_MODULES:
+            with self.subTest(module=module):
+                with open(os.path.join(SERVER_DIR, module), "rb") as server_copy, \
+                     open(os.path.join(ORCHESTRATOR_DIR, module), "rb") as orchestrator_copy:
+                    self.assertEqual(server_copy.read(), orchestrator_copy.read(),
+                                     f"server/{module} and orchestrator/{module} differ")
+
+
+if __name__ == "__main__":
+    unittest.main()
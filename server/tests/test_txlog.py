@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import txlog
+from txlog import TransactionLog, decode_records, encode_record, in_flight_of, PREPARE, APPLY, ABORT
+
+# Transaction log records, in-flight tracking and compaction, each test on a fresh log in a temporary directory
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+WRITERS = 4
+WRITES_PER_WRITER = 200
+
+
+# One process appending to the shared log: a prepare per id, every even id applied, the log synced (and
+# compacted once it grows past TXLOG_SEGMENT_BYTES) after each prepare
+def write_from_process(directory, first_id):
+    log = TransactionLog(directory)
+    for id in range(first_id, first_id + WRITES_PER_WRITER):
+        log.write(encode_record(PREPARE, [id], f"T{id}"))
+        log.sync()
+        if id % 2 == 0:
+            log.write(encode_record(APPLY, [id]))
+
+
+class TransactionLogTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="antihero-txlog-")
+        self.log = TransactionLog(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_decode_records_round_trip(self):
+        data = encode_record(PREPARE, [1, 2, 3], "T1") + encode_record(APPLY, [2]) + encode_record(ABORT, [3])
+        *records, valid_length = decode_records(data)
+        self.assertEqual(records, [(PREPARE, "T1", (1, 2, 3)), (APPLY, None, (2,)), (ABORT, None, (3,))])
+        self.assertEqual(valid_length, len(data))
+
+    def test_decode_records_stops_at_torn_or_corrupt_record(self):
+        complete = encode_record(PREPARE, [1], "T1")
+        torn = encode_record(PREPARE, [2, 3], "T2")
+        *records, valid_length = decode_records(complete + torn[:-4])
+        self.assertEqual(records, [(PREPARE, "T1", (1,))])
+        self.assertEqual(valid_length, len(complete))
+
+        corrupt = bytearray(torn)
+        corrupt[-1] ^= 0xFF
+        *records, valid_length = decode_records(complete + bytes(corrupt) + encode_record(APPLY, [1]))
+        self.assertEqual(records, [(PREPARE, "T1", (1,))])
+        self.assertEqual(valid_length, len(complete))
+
+    def test_in_flight_of(self):
+        records = [(PREPARE, "T1", (1, 2)), (PREPARE, "T2", (3,)), (APPLY, None, (1,)), (ABORT, None, (3,)),
+                   (PREPARE, "T3", (3,))]
+        self.assertEqual(in_flight_of(records), {2: "T1", 3: "T3"})
+
+    async def test_prepare_abort_leaves_nothing_in_flight(self):
+        await self.log.prepare([{"id": 1, "transaction_id": "T1"}, {"id": 2, "transaction_id": "T1"}])
+        self.assertEqual(self.log.in_flight(), {1: "T1", 2: "T1"})
+        await self.log.aborted([1])
+        self.assertEqual(self.log.in_flight(), {2: "T1"})
+        await self.log.applied([2])
+        self.assertEqual(self.log.in_flight(), {})
+
+    async def test_event_loop_runs_while_another_process_holds_the_log(self):
+        # Another process compacting: its own handle on the same log, holding the lock
+        other = TransactionLog(self.directory)
+        with other.locked():
+            write = asyncio.create_task(self.log.prepare([{"id": 1, "transaction_id": "T1"}]))
+            await asyncio.sleep(0.05)
+            self.assertFalse(write.done())
+        await write
+        await self.log.aborted([1])
+        self.assertEqual(self.log.in_flight(), {})
+
+    def test_torn_tail_truncated_when_opened(self):
+        # The log a crash left behind, in a directory no process has opened since the boot
+        directory = tempfile.mkdtemp(prefix="antihero-txlog-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        complete = encode_record(PREPARE, [1], "T1")
+        with open(os.path.join(directory, "antihero-txlog"), "wb") as log_file:
+            log_file.write(complete + encode_record(PREPARE, [2], "T2")[:-3])
+
+        log = TransactionLog(directory)
+        self.assertEqual(os.path.getsize(log.path), len(complete))
+        log.write(encode_record(APPLY, [1]))
+        self.assertEqual(log.in_flight(), {})
+
+    @unittest.skipUnless(txlog.current_boot_id(), "the kernel exposes no boot id")
+    def test_torn_tail_checked_once_per_boot(self):
+        length = os.path.getsize(self.log.path)
+        with mock.patch.object(TransactionLog, "truncate_torn_tail") as truncate_torn_tail:
+            TransactionLog(self.directory)
+        truncate_torn_tail.assert_not_called()
+        self.assertEqual(os.path.getsize(self.log.path), length)
+
+    def test_compact_keeps_only_in_flight_prepares(self):
+        self.log.write(encode_record(PREPARE, [1, 2], "T1") + encode_record(PREPARE, [3], "T2") +
+                       encode_record(APPLY, [1]) + encode_record(ABORT, [3]))
+        with self.log.locked():
+            self.log.compact()
+        records, valid_length, length = self.log.read_records()
+        self.assertEqual(records, [(PREPARE, "T1", (2,))])
+        self.assertEqual(valid_length, length)
+        # Appends after a compaction land in the new file
+        self.log.write(encode_record(APPLY, [2]))
+        self.assertEqual(self.log.in_flight(), {})
+
+    def test_compaction_under_concurrent_writers(self):
+        context = multiprocessing.get_context("fork")
+        # Small enough that every writer compacts the shared log many times over
+        with mock.patch.object(txlog, "TXLOG_SEGMENT_BYTES", 512):
+            writers = [context.Process(target=write_from_process, args=(self.directory, writer * WRITES_PER_WRITER))
+                       for writer in range(WRITERS)]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join(60)
+        self.assertEqual([writer.exitcode for writer in writers], [0] * WRITERS)
+
+        records, valid_length, length = self.log.read_records()
+        self.assertEqual(valid_length, length)
+        expected = {id: f"T{id}" for id in range(WRITERS * WRITES_PER_WRITER) if id % 2 == 1}
+        self.assertEqual(self.log.in_flight(), expected)
+        # Compacted well below everything that was written
+        self.assertLess(length, WRITERS * WRITES_PER_WRITER * len(encode_record(PREPARE, [0], "T000")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+import httpx
+from fastapi import FastAPI, Request
+import wire
+
+# Wire format negotiation: requests to a peer are JSON until the peer advertised it reads msgpack
+#
+#   python -m unittest discover -s tests -t .      (from server/)
+
+PEER = "http://10.0.0.7:8000"
+ROWS = [{"id": 1, "section": "A"}, {"id": 2, "section": "A"}]
+
+
+def response_from(url, advertised):
+    return httpx.Response(200, json={}, headers={wire.ADVERTISE_HEADER: advertised},
+                          request=httpx.Request("PUT", f"{url}/inventory/update"))
+
+
+@unittest.skipUnless(wire.msgpack is not None, "msgpack is not installed")
+@mock.patch.object(wire, "WIRE_FORMAT", "msgpack")
+class WireNegotiationTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        wire.msgpack_peers.clear()
+        self.addCleanup(wire.msgpack_peers.clear)
+
+    def test_json_until_the_peer_advertises_msgpack(self):
+        content, headers = wire.encode_body(ROWS, PEER)
+        self.assertEqual(headers["Content-Type"], wire.JSON_MEDIA_TYPE)
+        self.assertEqual(wire.json.loads(content), ROWS)
+
+        wire.note_response(response_from(PEER, wire.READABLE_MEDIA_TYPES))
+        content, headers = wire.encode_body(ROWS, f"{PEER}/inventory/prepare")
+        self.assertEqual(headers["Content-Type"], wire.MSGPACK_MEDIA_TYPE)
+        self.assertEqual(wire.loads(content), ROWS)
+        # Other peers are still sent JSON
+        self.assertEqual(wire.media_type_for("http://10.0.0.8:8000"), wire.JSON_MEDIA_TYPE)
+
+    def test_peer_that_stops_advertising_msgpack_gets_json_again(self):
+        wire.note_response(response_from(PEER, wire.READABLE_MEDIA_TYPES))
+        wire.note_response(response_from(PEER, wire.JSON_MEDIA_TYPE))
+        self.assertEqual(wire.media_type_for(PEER), wire.JSON_MEDIA_TYPE)
+
+    def test_encode_bodies_encodes_once_per_format(self):
+        wire.note_response(response_from(PEER, wire.READABLE_MEDIA_TYPES))
+        with mock.patch.object(wire, "dumps", wraps=wire.dumps) as dumps:
+            bodies = wire.encode_bodies(ROWS, (PEER, PEER, "http://10.0.0.8:8000"))
+        dumps.assert_called_once()
+        self.assertIs(bodies[0], bodies[1])
+        self.assertEqual(bodies[2][1]["Content-Type"], wire.JSON_MEDIA_TYPE)
+
+    async def test_every_response_advertises_the_formats_read(self):
+        app = FastAPI()
+        app.add_middleware(wire.AdvertiseFormats)
+
+        @app.put("/inventory/update")
+        async def update(request: Request):
+            return {"rows": len(await wire.read_body(request))}
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url=PEER) as client:
+            content, headers = wire.encode_body(ROWS, PEER)
+            response = await client.put("/inventory/update", content=content, headers=headers)
+            self.assertEqual(response.json(), {"rows": 2})
+            self.assertEqual(response.headers[wire.ADVERTISE_HEADER], wire.READABLE_MEDIA_TYPES)
+            wire.note_response(response)
+            content, headers = wire.encode_body(ROWS, PEER)
+            self.assertEqual(headers["Content-Type"], wire.MSGPACK_MEDIA_TYPE)
+            response = await client.put("/inventory/update", content=content, headers=headers)
+            self.assertEqual(response.json(), {"rows": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import fcntl
+import os
+import struct
+import threading
+import zlib
+import metrics
+
+# Append-only log of the tentative commit protocol on this host (primary and backup side)
+#
+#   PREPARE  tentative rows were written for these ids (logged and fsynced before the write commits)
+#   APPLY    the tentative rows for these ids were applied
+#   ABORT    the tentative rows for these ids were discarded
+#
+# Ids whose last record is PREPARE are the in-flight tentative writes, failover replays (update_authority)
+# or discards (relinquish_inventory) only those instead of scanning the table for committed == False.
+# Applies travel between partners by id (see apply_queue), so records are matched by id, the transaction id
+# of a prepare is kept for inspection (python txlog.py). APPLY/ABORT records are written before their caller
+# goes on but never fsynced for: losing one only makes failover redo an apply/discard that finds nothing left to do.
+# Every process on the host appends to the same file, and the file is compacted down to its in-flight prepares
+# once it grows past TXLOG_SEGMENT_BYTES. Records are queued in order and written by a thread (the file lock can
+# be held for a while by another process's compaction, the event loop never waits on it), records queued
+# together share one write and PREPAREs one fsync
+
+TXLOG_DIR = os.environ.get("ANTIHERO_TXLOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "txlog"))
+TXLOG_SEGMENT_BYTES = int(os.environ.get("ANTIHERO_TXLOG_SEGMENT_BYTES", str(8 << 20)))
+
+PREPARE = 1
+APPLY = 2
+ABORT = 3
+KIND_NAMES = {PREPARE: "PREPARE", APPLY: "APPLY", ABORT: "ABORT"}
+
+# crc32 of the rest of the record, kind, transaction id length, id count
+HEADER_FORMAT = "<IBHI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+# Identifies this boot of the host (None where the kernel doesn't expose one)
+def current_boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id", "rb") as boot_id_file:
+            return boot_id_file.read().strip()
+    except OSError:
+        return None
+
+
+def encode_record(kind, ids, transaction_id=None):
+    txid = (transaction_id or "").encode()
+    body = struct.pack("<BHI", kind, len(txid), len(ids)) + txid + struct.pack(f"<{len(ids)}q", *ids)
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+# Yields (kind, transaction id, ids) and finally the offset where the valid records end (a torn or corrupt tail stops the scan)
+def decode_records(data):
+    offset = 0
+    while offset + HEADER_SIZE <= len(data):
+        crc, kind, txid_length, count = struct.unpack_from(HEADER_FORMAT, data, offset)
+        end = offset + HEADER_SIZE + txid_length + 8 * count
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+            break
+        txid_start = offset + HEADER_SIZE
+        ids = struct.unpack_from(f"<{count}q", data, txid_start + txid_length)
+        yield kind, data[txid_start:txid_start + txid_length].decode() or None, ids
+        offset = end
+    yield offset
+
+
+# id -> transaction id of every prepare without a later apply/abort
+def in_flight_of(records):
+    in_flight = {}
+    for kind, transaction_id, ids in records:
+        if kind == PREPARE:
+            for id in ids:
+                in_flight[id] = transaction_id
+        else:
+            for id in ids:
+                in_flight.pop(id, None)
+    return in_flight
+
+
+class TransactionLog:
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "antihero-txlog")
+        os.makedirs(directory, exist_ok=True)
+        # The log file is replaced on compaction, so processes serialize on a lock file that never moves
+        self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o660)
+        self._thread_lock = threading.Lock()
+        self._fd = None
+        self._inode = None
+        # (records, durable, future) waiting for the next group write, and the write currently running
+        self.queued = []
+        self.writing = None
+        with self.locked():
+            self.reopen()
+            # A torn tail is left by a crash, so only the first process to open the log after a boot scans for it
+            # (and reports it), the lock file remembers the boot that was checked
+            boot_id = current_boot_id()
+            if boot_id is None or os.pread(self._lock_fd, len(boot_id) + 1, 0) != boot_id:
+                self.truncate_torn_tail()
+                if boot_id is not None:
+                    os.ftruncate(self._lock_fd, 0)
+                    os.pwrite(self._lock_fd, boot_id, 0)
+
+    def locked(self):
+        return _LogLock(self)
+
+    # Must be called with the log locked, picks up a file replaced by another process's compaction
+    def reopen(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self._fd is not None and inode == self._inode:
+            return
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o660)
+        self._inode = os.fstat(self._fd).st_ino
+
+    def read_records(self):
+        with open(self.path, "rb") as log_file:
+            data = log_file.read()
+        *records, valid_length = decode_records(data)
+        return records, valid_length, len(data)
+
+    # A crash mid-write leaves a partial record, later records would be unreadable behind it
+    def truncate_torn_tail(self):
+        _, valid_length, length = self.read_records()
+        if valid_length < length:
+            print(f"Transaction log: dropping {length - valid_length} bytes of torn records")
+            os.ftruncate(self._fd, valid_length)
+            os.fsync(self._fd)
+
+    def write(self, data):
+        self.write_records(data, False)
+
+    def sync(self):
+        self.write_records(b"", True)
+
+    # Blocking, run in a thread by group_write (and by sync callers outside the event loop)
+    def write_records(self, data, durable):
+        with self.locked():
+            self.reopen()
+            if data:
+                os.write(self._fd, data)
+            if durable:
+                os.fsync(self._fd)
+                if os.fstat(self._fd).st_size > TXLOG_SEGMENT_BYTES:
+                    self.compact()
+        if data:
+            metrics.increment("txlog_bytes_written", len(data))
+        if durable:
+            metrics.increment("txlog_fsyncs")
+
+    # Must be called with the log locked, rewrites the log as one PREPARE per in-flight transaction
+    def compact(self):
+        records, _, _ = self.read_records()
+        by_transaction = {}
+        for id, transaction_id in in_flight_of(records).items():
+            by_transaction.setdefault(transaction_id, []).append(id)
+        temp_path = self.path + ".compact"
+        with open(temp_path, "wb") as temp_file:
+            for transaction_id, ids in by_transaction.items():
+                temp_file.write(encode_record(PREPARE, ids, transaction_id))
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, self.path)
+        directory_fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        self.reopen()
+        metrics.increment("txlog_compactions")
+
+    def prepare_records(self, rows):
+        by_transaction = {}
+        for row in rows:
+            by_transaction.setdefault(row.get("transaction_id"), []).append(row["id"])
+        return b"".join(encode_record(PREPARE, ids, transaction_id) for transaction_id, ids in by_transaction.items())
+
+    # Durably records tentative rows (dicts with id and transaction_id), call before committing them
+    async def prepare(self, rows):
+        if rows:
+            await self.queue(self.prepare_records(rows), True)
+
+    async def applied(self, ids):
+        if ids:
+            await self.queue(encode_record(APPLY, list(ids)), False)
+
+    async def aborted(self, ids):
+        if ids:
+            await self.queue(encode_record(ABORT, list(ids)), False)
+
+    # Returns once the records are written (and fsynced when durable)
+    async def queue(self, records, durable):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queued.append((records, durable, future))
+        if self.writing is None:
+            self.writing = loop.create_task(self.group_write())
+        await future
+
+    # One write (and at most one fsync) in a thread for everything queued so far, repeated while more arrives during it
+    async def group_write(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.queued:
+                queued = self.queued
+                self.queued = []
+                data = b"".join(records for records, _, _ in queued)
+                durable = any(durable for _, durable, _ in queued)
+                try:
+                    await loop.run_in_executor(None, self.write_records, data, durable)
+                except Exception as error:
+                    for _, _, future in queued:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                if durable:
+                    metrics.increment("txlog_fsync_waiters", sum(1 for _, durable, _ in queued if durable))
+                for _, _, future in queued:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            self.writing = None
+
+    # id -> transaction id of the in-flight tentative writes
+    def in_flight(self):
+        with self.locked():
+            self.reopen()
+            records, _, _ = self.read_records()
+        return in_flight_of(records)
+
+    def reset(self):
+        with self.locked():
+            self.reopen()
+            os.ftruncate(self._fd, 0)
+            os.fsync(self._fd)
+
+
+class _LogLock:
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        self.log._thread_lock.acquire()
+        fcntl.flock(self.log._lock_fd, fcntl.LOCK_EX)
+        return self.log
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.log._lock_fd, fcntl.LOCK_UN)
+        self.log._thread_lock.release()
+        return False
+
+
+transaction_log = TransactionLog(TXLOG_DIR)
+
+
+if __name__ == "__main__":
+    # python txlog.py [--records]     in-flight transactions (and every record) in this host's log
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", action="store_true")
+    args = parser.parse_args()
+    records, valid_length, length = transaction_log.read_records()
+    if args.records:
+        for kind, transaction_id, ids in records:
+            print(KIND_NAMES.get(kind, kind), transaction_id or "-", list(ids))
+    by_transaction = {}
+    for id, transaction_id in transaction_log.in_flight().items():
+        by_transaction.setdefault(transaction_id, []).append(id)
+    print(f"{len(records)} records, {length} bytes ({length - valid_length} torn), {len(by_transaction)} transactions in flight")
+    for transaction_id, ids in by_transaction.items():
+        print(f"  {transaction_id or '-'}: {sorted(ids)}")
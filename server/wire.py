@@ -0,0 +1,160 @@
+import json
+import os
+from datetime import datetime
+from urllib.parse import urlsplit
+from fastapi import HTTPException
+from fastapi.responses import Response
+from schemas import JSONResponseClass
+
+# Negotiated wire format for inter-node inventory traffic (prepare batches, /inventory/update chunks,
+# deactivation responses). Lists of rows are sent as msgpack with the column names once per batch,
+# JSON stays the fallback: receivers pick the decoder from Content-Type and answer in the format the caller Accepts.
+# Every response advertises the formats its node reads (ADVERTISE_HEADER, see AdvertiseFormats), requests to a
+# peer go out as JSON until one of its responses said it reads msgpack, so a node without msgpack is never sent any
+# The server and orchestrator copies of this file are identical (checked by server/tests/test_shared_modules.py)
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+JSON_MEDIA_TYPE = "application/json"
+WIRE_FORMAT = os.environ.get("ANTIHERO_WIRE_FORMAT", "msgpack").lower()
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if WIRE_FORMAT == "msgpack" and msgpack is None:
+    print("ANTIHERO_WIRE_FORMAT is msgpack but the msgpack package is not installed, falling back to JSON")
+    WIRE_FORMAT = "json"
+
+ADVERTISE_HEADER = "x-antihero-accept"
+READABLE_MEDIA_TYPES = f"{MSGPACK_MEDIA_TYPE}, {JSON_MEDIA_TYPE}" if msgpack is not None else JSON_MEDIA_TYPE
+
+# host:port of every peer that advertised msgpack
+msgpack_peers = set()
+
+# msgpack extension for a list of dicts sharing the same keys, packed as [keys, values of row 1, values of row 2, ...]
+TABLE_EXT = 1
+
+
+def encode_default(obj):
+    # Same representation the JSON encoder produces
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def pack_value(obj):
+    if isinstance(obj, dict):
+        return {key: pack_value(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        if obj and isinstance(obj[0], dict):
+            keys = obj[0].keys()
+            if all(isinstance(item, dict) and item.keys() == keys for item in obj):
+                columns = list(keys)
+                table = [columns] + [[item[key] for key in columns] for item in obj]
+                return msgpack.ExtType(TABLE_EXT, msgpack.packb(table, default=encode_default))
+        return [pack_value(item) for item in obj]
+    return obj
+
+
+def unpack_ext(code, data):
+    if code == TABLE_EXT:
+        table = msgpack.unpackb(data, ext_hook=unpack_ext, raw=False)
+        columns = table[0]
+        return [dict(zip(columns, values)) for values in table[1:]]
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    return msgpack.packb(pack_value(obj), default=encode_default)
+
+
+def loads(data):
+    return msgpack.unpackb(data, ext_hook=unpack_ext, raw=False, strict_map_key=False)
+
+
+def is_msgpack(content_type):
+    return bool(content_type) and content_type.split(";")[0].strip() == MSGPACK_MEDIA_TYPE
+
+
+def peer_of(url):
+    return urlsplit(str(url)).netloc
+
+
+# Media type of requests to `url` (any URL of the peer): the configured format once the peer advertised
+# it reads msgpack, JSON until then
+def media_type_for(url):
+    if WIRE_FORMAT == "msgpack" and peer_of(url) in msgpack_peers:
+        return MSGPACK_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+# Body and headers for an outgoing request to `url`
+def encode_body(obj, url):
+    media_type = media_type_for(url)
+    headers = {"Content-Type": media_type, "Accept": READABLE_MEDIA_TYPES}
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return dumps(obj), headers
+    return json.dumps(obj, default=encode_default).encode(), headers
+
+
+# encode_body for each of `urls`, `obj` is encoded once per format
+def encode_bodies(obj, urls):
+    encoded = {}
+    bodies = []
+    for url in urls:
+        media_type = media_type_for(url)
+        if media_type not in encoded:
+            encoded[media_type] = encode_body(obj, url)
+        bodies.append(encoded[media_type])
+    return bodies
+
+
+# Records what the peer that sent `response` advertised, works for both httpx and requests responses
+def note_response(response):
+    advertised = response.headers.get(ADVERTISE_HEADER)
+    if advertised is not None:
+        peer = peer_of(response.request.url)
+        if MSGPACK_MEDIA_TYPE in advertised:
+            msgpack_peers.add(peer)
+        else:
+            msgpack_peers.discard(peer)
+
+
+def decode_response(response):
+    note_response(response)
+    if is_msgpack(response.headers.get("content-type")):
+        return loads(response.content)
+    return response.json()
+
+
+async def read_body(request):
+    body = await request.body()
+    if is_msgpack(request.headers.get("content-type")):
+        if msgpack is None:
+            raise HTTPException(status_code=415, detail="msgpack is not supported by this node")
+        return loads(body)
+    return json.loads(body)
+
+
+# Encodes `content` as msgpack when the caller accepts it, otherwise as JSON
+def respond(request, content):
+    if msgpack is not None and MSGPACK_MEDIA_TYPE in request.headers.get("accept", ""):
+        return Response(content=dumps(content), media_type=MSGPACK_MEDIA_TYPE)
+    return JSONResponseClass(content)
+
+
+# ASGI middleware (app.add_middleware) adding ADVERTISE_HEADER to every response of this node
+class AdvertiseFormats:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_advertised(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(ADVERTISE_HEADER.encode(), READABLE_MEDIA_TYPES.encode())]
+            await send(message)
+        await self.app(scope, receive, send_advertised)
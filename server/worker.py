@@ -1,237 +1,306 @@
-import threading
+import asyncio
+import fcntl
+import os
 import time
-from pydantic import BaseModel
-from typing import List, Annotated, Optional
-from datetime import datetime, timedelta
-import socket
-from database import db_session, engine
-import models
-import requests
-import time
-from models import Server, Inventory, Reservation, RegistryEntry
-
-HEARTBEAT_TIMEOUT = 10
-HEARTBEAT_INTERVAL = 2
-
-def store_registry(key, value):
-    registry_entry = db_session.query(RegistryEntry).filter(RegistryEntry.registry_name == key).first()
-    if not registry_entry:
-        registry_entry = RegistryEntry(registry_name=key)
-        db_session.add(registry_entry)
-
-    if value is None:
-        registry_entry.int_value = None
-        registry_entry.string_value = None
-        registry_entry.bool_value = None
-        registry_entry.datetime_value = None
-    else:
-        if isinstance(value, bool):
-            registry_entry.bool_value = value
-        elif isinstance(value, (float, int)):
-            registry_entry.int_value = value
-        elif isinstance(value, str):
-            registry_entry.string_value = value
-        elif isinstance(value, datetime):
-            registry_entry.datetime_value = value
-
-    db_session.commit()
-    db_session.close()
-    return value
-
-def retrieve_registry(key, default=None):
-    registry_entry = db_session.query(RegistryEntry).filter(RegistryEntry.registry_name == key).first()
-    if registry_entry:
-        if registry_entry.int_value is not None:
-            default = registry_entry.int_value
-        
-        if registry_entry.string_value is not None:
-            default = registry_entry.string_value
-        
-        if registry_entry.bool_value is not None:
-            default = registry_entry.bool_value
-        
-        if registry_entry.datetime_value is not None:
-            default = registry_entry.datetime_value
-    
-    db_session.close() 
-    return default
-
-    
-def send_heartbeat():
-    while True:
-        time.sleep(HEARTBEAT_INTERVAL)
-        status = retrieve_registry("Status")
-        in_backup = retrieve_registry("In_Backup")
-        if status != 'Disabled' and not in_backup:
-            partner_id = retrieve_registry("Partner_ID")
-            if partner_id:
-                partner = db_session.query(Server).filter(Server.id == partner_id).first()
-                print("Sending heartbeat")
-                try:
-                    url = f'http://{partner.ip_address}:{partner.port}/heartbeat'
-                    requests.request("PUT", url)
-                except requests.exceptions.HTTPError as errh:
-                    print ("Http Error:",errh)
-                except requests.exceptions.ConnectionError as errc:
-                    print ("Error Connecting:",errc)
-                except requests.exceptions.Timeout as errt:
-                    print ("Timeout Error:",errt)
-                except requests.exceptions.RequestException as err:
-                    print ("Oops: Something Else",err)
-            else:
-                print("No Heartbeat Sent: No partner found")
-        db_session.close()
+import asyncpg
+import httpx
+from sqlalchemy import update
+from database import AsyncSessionLocal, SQLALCHEMY_DATABASE_URL
+from models import Inventory
+from registry import store_registry_async, retrieve_registry, refresh_registry, REGISTRY_CHANNEL
+from statements import apply_statement, discard_all_statement, ids_filter, id_ranges_statement
+from partner_client import async_partner_client
+import wire
+from item_cache import item_cache
+from txlog import transaction_log
+from heartbeat import heartbeat_state, HEARTBEAT_INTERVAL
+from failure_detector import partner_failed, seconds_until_suspected, FAILURE_CHECK_INTERVAL
+from lease import current_epoch, partner_lease_remaining
+from shared_state import shared_state_path
 
-def request_authority():
+# Background worker: sends heartbeats to the partner and fails over when the partner is suspected
+# Runs as an asyncio service, either on its own (python worker.py) or inside one API worker's event loop
+# (ANTIHERO_WORKER_IN_API=1, see main.lifespan) where it shares the registry cache and connection pools.
+# Only one instance per host is active, whichever process holds the worker lock file.
+# Nothing is polled: registry writes (status, partner, backup mode) arrive through LISTEN/NOTIFY,
+# heartbeats are sent every HEARTBEAT_INTERVAL (renewing this server's ownership lease, see lease) and the
+# failure check sleeps until the detector's deadline or the partner's lease expiry, whichever is later
+
+WORKER_IN_API = os.environ.get("ANTIHERO_WORKER_IN_API", "0") == "1"
+# How often a process that isn't running the worker checks whether the active one went away
+WORKER_LOCK_RETRY = 5
+ORCHESTRATOR_RETRY = 10
+# The partner's lease already expired when authority is requested, so retries are quick
+AUTHORITY_RETRY = float(os.environ.get("ANTIHERO_AUTHORITY_RETRY_MS", "500")) / 1000
+LISTEN_RETRY = 1
+RANGES_PER_FETCH = 10000
+
+
+def orchestrator_client():
+    orc_ip = retrieve_registry("Orchestrator_IP")
+    orc_port = retrieve_registry("Orchestrator_Port")
+    return async_partner_client.client_for(f'http://{orc_ip}:{orc_port}')
+
+
+async def request_authority():
     print("Failure detected! Requesting authority from Orchestrator")
     server_id = retrieve_registry("Server_ID")
     partner_id = retrieve_registry("Partner_ID")
-    orc_ip = retrieve_registry("Orchestrator_IP")
-    orc_port = retrieve_registry("Orchestrator_Port")
-    curr_url = f'http://{orc_ip}:{orc_port}/failure?failed_server_id={partner_id}&backup_server_id={server_id}'
-    
+
     while True:
         try:
-            response = requests.request("PUT", curr_url)
+            response = await orchestrator_client().request("PUT", '/failure', params = {"failed_server_id": partner_id, "backup_server_id": server_id})
             break
-        except requests.exceptions.HTTPError as errh:
-            print ("Http Error:",errh)
-        except requests.exceptions.ConnectionError as errc:
+        except httpx.ConnectError as errc:
             print ("Error Connecting:",errc)
-        except requests.exceptions.Timeout as errt:
+        except httpx.TimeoutException as errt:
             print ("Timeout Error:",errt)
-        except requests.exceptions.RequestException as err:
+        except httpx.HTTPError as err:
             print ("Oops: Something Else",err)
-        time.sleep(10)
+        await asyncio.sleep(AUTHORITY_RETRY)
 
-    if response.ok:
-        store_registry("In_Backup", True)
+    if response.is_success:
+        # The orchestrator moved the pair to a new epoch, heartbeats from the old owner are refused from now on
+        epoch = response.json().get("epoch")
+        if epoch is not None:
+            await store_registry_async("Authority_Epoch", epoch)
+        await store_registry_async("In_Backup", True)
         return True
     else:
         # Need to set self as failed and request recovery/healing
         return False
 
-def update_authority():
+# Applies the in-flight tentative writes and moves the partner's inventory to this server, as two set-based
+# statements in the caller's transaction (the benchmark in failover_benchmark.py runs the same code)
+async def take_over_inventory(session, server_id, partner_id, in_flight_ids):
+    if in_flight_ids:
+        await session.execute(apply_statement(Inventory, (ids_filter(Inventory, in_flight_ids),)))
+    # Set location as self + commit any pending transactions
+    # ! Might be a problem if there's still trash records
+    await session.execute(update(Inventory).where(Inventory.location == partner_id).values({Inventory.location: server_id}))
+
+async def update_authority():
     partner_id = retrieve_registry("Partner_ID")
     server_id = retrieve_registry("Server_ID")
 
-    uncommitted_objs = db_session.query(Inventory.id).filter(Inventory.committed == False, Inventory.activated == True).all()
-    uncomitted_ids = [obj[0] for obj in uncommitted_objs]
-
-    # Committing uncommitted records
-    db_session.query(Inventory).filter(Inventory.id.in_(uncomitted_ids), Inventory.committed == True, Inventory.activated == True).delete(synchronize_session=False)
-    db_session.query(Inventory).filter(Inventory.id.in_(uncomitted_ids), Inventory.committed == False, Inventory.activated == True).update({Inventory.committed: True}, synchronize_session=False)
-    db_session.commit()
-
-    # Set location as self + commit any pending transactions
-    # ! Might be a problem if there's still trash records
-    db_session.query(Inventory).filter(Inventory.location == partner_id).update({Inventory.location: server_id}, synchronize_session = False)
-    db_session.commit()
-    db_session.close()
-    store_registry("Partner_ID", None)
+    # Committing uncommitted records: the transactions still in flight in the log (see txlog), in one statement
+    in_flight_ids = list(await asyncio.to_thread(transaction_log.in_flight))
+    print(f"Replaying {len(in_flight_ids)} in-flight tentative writes")
+    async with AsyncSessionLocal() as session:
+        await take_over_inventory(session, server_id, partner_id, in_flight_ids)
+        await session.commit()
+    await transaction_log.applied(in_flight_ids)
+    # Ownership of the partner's whole inventory moved, drop every cached item/owner in the API workers
+    item_cache.invalidate_all()
+    await store_registry_async("Partner_ID", None)
     return True
 
-def attempt_recovery(relinquished_ids):
+async def attempt_recovery(relinquished_ranges):
     print("Requesting Orchestrator to initiate recovery...")
     # Send initiate recovery request
     server_id = retrieve_registry("Server_ID")
-    # partner_id = retrieve_registry("Partner_ID")
-    orc_ip = retrieve_registry("Orchestrator_IP")
-    orc_port = retrieve_registry("Orchestrator_Port")
-
-    curr_url = f'http://{orc_ip}:{orc_port}/initiate-recovery'
     request_body = {}
-    request_body["relinquished_ids"] = relinquished_ids
+    request_body["relinquished_ranges"] = relinquished_ranges
     request_body["server_id"] = server_id
-    
+    client = orchestrator_client()
+    content, headers = wire.encode_body(request_body, client.base_url)
+
     while True:
         try:
-            response = requests.request("PUT", curr_url, json=request_body)
+            response = await client.request("PUT", '/initiate-recovery', content=content, headers=headers)
+            wire.note_response(response)
             break
-        except requests.exceptions.HTTPError as errh:
-            print ("Http Error:",errh)
-        except requests.exceptions.ConnectionError as errc:
+        except httpx.ConnectError as errc:
             print ("Error Connecting:",errc)
-        except requests.exceptions.Timeout as errt:
+        except httpx.TimeoutException as errt:
             print ("Timeout Error:",errt)
-        except requests.exceptions.RequestException as err:
+        except httpx.HTTPError as err:
             print ("Oops: Something Else",err)
-    
-    if response.ok:
+        await asyncio.sleep(ORCHESTRATOR_RETRY)
+
+    if response.is_success:
         print("Recovery process approved by Orchestrator...returning to normal operation")
     return
 
-def relinquish_inventory():
+# Hands this server's inventory to the partner and discards its in-flight tentative writes in the caller's transaction,
+# returning every relinquished id (this server's rows and the ones relinquished before) as [[first, last], ...] runs
+async def release_inventory(session, server_id, partner_id, in_flight_ids):
+    # Move all unlocked inventory to Orchestrator with a special backup marker
+    # to denote relinquished inventory
+    # Mark as inventory for self or partner as belonging to partner + deactivate
+    await session.execute(update(Inventory).where(Inventory.location == server_id)
+                          .values({Inventory.location: partner_id, Inventory.activated: False, Inventory.on_backup: True}))
+    await session.execute(update(Inventory).where(Inventory.location == partner_id)
+                          .values({Inventory.location: partner_id, Inventory.activated: False}))
+    # Discarding this server's in-flight tentative writes (see txlog)
+    if in_flight_ids:
+        await session.execute(discard_all_statement(Inventory, (ids_filter(Inventory, in_flight_ids),)))
+    # The backup marker now covers both, read back as runs through a server-side cursor
+    relinquished_ranges = []
+    result = await session.stream(id_ranges_statement(Inventory, (Inventory.on_backup == True,)).execution_options(yield_per=RANGES_PER_FETCH))
+    async for first, last in result:
+        relinquished_ranges.append([first, last])
+    return relinquished_ranges
+
+async def relinquish_inventory():
     server_id = retrieve_registry("Server_ID")
     partner_id = retrieve_registry("Partner_ID")
-    local_inv_query = db_session.query(Inventory).filter(Inventory.location == server_id)
-    partner_inv_query = db_session.query(Inventory).filter(Inventory.location == partner_id)
+    in_flight_ids = list(await asyncio.to_thread(transaction_log.in_flight))
+    async with AsyncSessionLocal() as session:
+        relinquished_ranges = await release_inventory(session, server_id, partner_id, in_flight_ids)
+        await session.commit()
+    await transaction_log.aborted(in_flight_ids)
+    item_cache.invalidate_all()
+    return relinquished_ranges
 
-    prev_relinquished_ids = db_session.query(Inventory).filter(Inventory.on_backup == True).all()
-    # Get IDs of unlocked inventory (this will be requested later)
-    relinquished_ids = local_inv_query.all()
-    relinquished_ids = [record.id for record in relinquished_ids]
 
-    prev_relinquished_ids = [record.id for record in prev_relinquished_ids]
+class BackgroundWorker:
+    def __init__(self):
+        # Replaced (and the old one set) on every registry change, so every waiter wakes up
+        self.registry_event = asyncio.Event()
+        self.lock_fd = None
+        self.task = None
 
+    def registry_changed(self, *args):
+        event = self.registry_event
+        self.registry_event = asyncio.Event()
+        event.set()
 
-    # Move all unlocked inventory to Orchestrator with a special backup marker
-    # to denote relinquished inventory
-    # Mark as inventory for self or partner as belonging to partner + deactivate
-    local_inv_query.update({ Inventory.location: partner_id, Inventory.activated: False, Inventory.on_backup: True }, synchronize_session=False)
-    partner_inv_query.update({ Inventory.location: partner_id, Inventory.activated: False }, synchronize_session=False)
-    db_session.query(Inventory).filter(Inventory.committed == False).delete(synchronize_session=False)
-    db_session.commit()
-    return relinquished_ids + prev_relinquished_ids
-
-def failure_detection():
-    print("Background failure detection is running...")
-    while True:
-        time.sleep(HEARTBEAT_TIMEOUT)
-        partner_id = retrieve_registry("Partner_ID")
-        if partner_id:
-            print("Checking for timeout")
+    # Waits for the next registry change, at most `timeout` seconds (forever if None)
+    async def wait_for_change(self, timeout=None):
+        try:
+            await asyncio.wait_for(self.registry_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def try_lock(self):
+        fd = os.open(shared_state_path("worker.lock"), os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+    async def listen(self):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(SQLALCHEMY_DATABASE_URL)
+                await connection.add_listener(REGISTRY_CHANNEL, self.registry_changed)
+                # Changes made while no listener was connected
+                self.registry_changed()
+                while not connection.is_closed():
+                    await asyncio.sleep(LISTEN_RETRY)
+            except (OSError, asyncpg.PostgresError) as error:
+                print("Registry listener error:", error)
+            finally:
+                if connection is not None:
+                    await connection.close()
+            await asyncio.sleep(LISTEN_RETRY)
+
+    async def send_heartbeats(self):
+        while True:
+            await refresh_registry()
+            status = retrieve_registry("Status")
+            in_backup = retrieve_registry("In_Backup")
+            partner_id = retrieve_registry("Partner_ID")
+            if status != 'Disabled' and not in_backup and partner_id:
+                sent_at = time.time()
+                try:
+                    response = await async_partner_client.request("PUT", partner_id, '/heartbeat', params={"epoch": current_epoch()})
+                    if response is not None and response.is_success:
+                        heartbeat_state.acknowledged(sent_at)
+                    elif response is not None and response.status_code == 409:
+                        print("Heartbeat refused, the partner has taken over this server's inventory")
+                except httpx.ConnectError as errc:
+                    print ("Error Connecting:",errc)
+                except httpx.TimeoutException as errt:
+                    print ("Timeout Error:",errt)
+                except httpx.HTTPError as err:
+                    print ("Oops: Something Else",err)
+            # A new partner gets its first heartbeat right away
+            await self.wait_for_change(HEARTBEAT_INTERVAL)
+
+    async def detect_failures(self):
+        print("Background failure detection is running...")
+        while True:
+            await refresh_registry()
+            partner_id = retrieve_registry("Partner_ID")
             in_backup = retrieve_registry("In_Backup")
             status = retrieve_registry("Status")
-            if not in_backup and status != "Disabled":
-                # Check heartbeat
-                last_heartbeat = retrieve_registry("Last_Heartbeat", datetime.utcnow())
-                expiry = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT)
-                # In the instance of a self-failure, this expiry should already be passed
-                if last_heartbeat < expiry:
-                    authority = request_authority()
-                    if authority:
-                        print("Authority granted.. updating data")
-                        update_authority()
-                    else:
-                        print("Authority denied... attempting recovery")
-                        store_registry("Status", "Disabled")
-                        relinquished_ids = relinquish_inventory()
-                        # Set to Solo Mode
-                        store_registry("Partner_ID", None)
-                        attempt_recovery(relinquished_ids)
-            db_session.close()
+            if not partner_id or in_backup or status == "Disabled":
+                # Nothing to watch until the registry changes
+                await self.wait_for_change()
+                continue
+            # Check heartbeat (see failure_detector), the partner is only taken over once its lease expired too
+            # In the instance of a self-failure, the partner's heartbeats stop arriving here too
+            lease_remaining = partner_lease_remaining()
+            if not lease_remaining and partner_failed():
+                await self.fail_over()
+                continue
+            wait = seconds_until_suspected()
+            await self.wait_for_change(FAILURE_CHECK_INTERVAL if wait is None else min(max(wait, lease_remaining), FAILURE_CHECK_INTERVAL))
+
+    async def fail_over(self):
+        authority = await request_authority()
+        if authority:
+            print("Authority granted.. updating data")
+            await update_authority()
         else:
-            print("No Timeout: No partner found...")
+            print("Authority denied... attempting recovery")
+            await store_registry_async("Status", "Disabled")
+            relinquished_ranges = await relinquish_inventory()
+            # Set to Solo Mode
+            await store_registry_async("Partner_ID", None)
+            await attempt_recovery(relinquished_ranges)
 
+    # Restarts a loop that failed (e.g. the database was briefly unreachable) instead of leaving it dead
+    async def supervise(self, loop):
+        while True:
+            try:
+                await loop()
+            except Exception as error:
+                print(f"Background worker {loop.__name__} error:", error)
+            await asyncio.sleep(LISTEN_RETRY)
 
-        # Send heartbeat
-        # Check for received heartbeat
-        # Request authority from orchestrator
-        # Update DB to show new location for taken inventory
+    async def run(self):
+        while not self.try_lock():
+            await asyncio.sleep(WORKER_LOCK_RETRY)
+        print("Background worker is running in process", os.getpid())
+        try:
+            await asyncio.gather(self.supervise(self.listen), self.supervise(self.send_heartbeats), self.supervise(self.detect_failures))
+        finally:
+            os.close(self.lock_fd)
+            self.lock_fd = None
 
-# Start the background worker in a separate thread
-worker_thread = threading.Thread(target=failure_detection)
-worker_thread2 = threading.Thread(target=send_heartbeat)
-worker_thread.daemon = True  # This allows the worker thread to exit when the main program ends
-worker_thread2.daemon = True  # This allows the worker thread to exit when the main program ends
-worker_thread.start()
-worker_thread2.start()
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
 
-# Main program
-try:
-    while True:
-        print("Main program is running...")
-        time.sleep(60)
-except KeyboardInterrupt:
-    print("Exiting...")
\ No newline at end of file
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+background_worker = BackgroundWorker()
+
+
+async def main():
+    try:
+        await background_worker.run()
+    finally:
+        await async_partner_client.aclose()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Exiting...")